@@ -0,0 +1,71 @@
+import math
+
+from scheduler import SAMPLE_RATE, SAMPLES_PER_FRAME, MAX_FRAMES, INTERACTIVE, BATCH
+from utils import metrics
+
+
+class AdmissionController:
+    """Load shedding in front of a `DecodeScheduler`.
+
+    A turn's cost is set by its prefill length T, which the uploaded PCM duration gives away: one whisper
+    frame per 20 ms plus the prompt tokens. The predicted time-to-first-audio adds up the prefills queued
+    ahead, the wait for a free pair of KV rows when all of them are taken, and the decode steps until the
+    first audio chunk, all from timings the scheduler measures as it runs. Turns whose prediction exceeds
+    `ttfa_slo` seconds, or that would make the queue deeper than `max_queue`, are turned away with the
+    number of seconds after which a retry is expected to fit.
+
+    Batch turns have no time-to-first-audio to keep and are only held to `max_queue` batch turns waiting.
+    Interactive turns go ahead of them, so they do not count towards an interactive turn's prediction.
+    """
+
+    def __init__(self, scheduler, ttfa_slo=2.0, max_queue=16):
+        self.scheduler = scheduler
+        self.ttfa_slo = ttfa_slo
+        self.max_queue = max_queue
+        self.num_rejected = 0
+
+    @staticmethod
+    def prompt_length(audio_seconds):
+        samples = int(audio_seconds * SAMPLE_RATE)
+        return min(samples // SAMPLES_PER_FRAME + 1, MAX_FRAMES) + 3
+
+    def predict_ttfa(self, audio_seconds, stream_stride=4):
+        """Seconds from now until the first audio chunk of a turn with `audio_seconds` of input.
+        Streamed turns pass 0, their audio is prefilled while it arrives."""
+        s = self.scheduler
+        ahead = s.pending_prompt_lengths(INTERACTIVE)
+        T = self.prompt_length(audio_seconds) if audio_seconds else 2
+
+        prefill = sum(s.encode_time + n * s.prefill_token_time for n in ahead + [T])
+        # with every row pair taken, turns finish at a rate of max_sessions per turn time
+        waiting = len(ahead) + 1 - s.num_free
+        wait = max(0, waiting) * s.turn_time / s.max_sessions
+        # the first chunk is emitted once 7 + stream_stride audio layers' worth of steps are in
+        first_chunk = (6 + stream_stride) * s.step_time
+        return wait + prefill + first_chunk
+
+    def check(self, audio_seconds, stream_stride=4, req_id=None, priority=INTERACTIVE):
+        """Returns None when the turn is admitted, otherwise the Retry-After value in seconds."""
+        if priority == BATCH:
+            return self._check_batch(req_id)
+        depth = len(self.scheduler.pending_prompt_lengths(INTERACTIVE))
+        ttfa = self.predict_ttfa(audio_seconds, stream_stride)
+        if depth < self.max_queue and ttfa <= self.ttfa_slo:
+            return None
+        self.num_rejected += 1
+        metrics.REQUESTS_REJECTED.inc()
+        retry_after = max(1, math.ceil(ttfa - self.ttfa_slo))
+        print(f"[shed] id={req_id} queue={depth} predicted_ttfa={ttfa:.2f}s retry_after={retry_after}s")
+        return retry_after
+
+    def _check_batch(self, req_id):
+        s = self.scheduler
+        depth = len(s.pending_prompt_lengths(BATCH))
+        if depth < self.max_queue:
+            return None
+        self.num_rejected += 1
+        metrics.REQUESTS_REJECTED.inc()
+        # the queue has to drain by one turn, at best max_sessions turns per turn time
+        retry_after = max(1, math.ceil(s.turn_time / s.max_sessions))
+        print(f"[shed] id={req_id} priority=batch queue={depth} retry_after={retry_after}s")
+        return retry_after
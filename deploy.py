@@ -0,0 +1,164 @@
+"""Draining and hot reloading of the model behind a server."""
+
+import threading
+import time
+import traceback
+
+from scheduler import StreamRequest
+
+
+WARM = "warm"
+LOADING = "loading"
+DRAINING = "draining"
+
+
+class Draining(RuntimeError):
+    pass
+
+
+class Deployment:
+    """Stands in for a server's `DecodeScheduler` (or `ReplicaPool`) so that it can be replaced while streams
+    are running.
+
+    `factory(ckpt_dir)` builds a warmed-up scheduler. `reload` builds the next one on a background thread
+    while the current one keeps serving, then switches over in a single assignment: turns submitted after
+    that go to the new scheduler, turns already running finish on the old one, which is closed once its
+    last turn is done. `drain` stops taking new turns, submitting raises `Draining`, and lets the running
+    ones finish so the process can be stopped without cutting a stream. Turns submitted with `accepted`
+    belong to work taken before the drain, the inputs of a job, and still go in. `undrain` takes turns
+    again. A reload with `drain` stops taking turns while it loads and takes them again once its model is
+    serving; a node that was drained by itself stays drained.
+
+    Everything else (timings, capacity, queue lengths) is read from the current scheduler.
+    """
+
+    def __init__(self, factory, ckpt_dir):
+        self._factory = factory
+        self.ckpt_dir = ckpt_dir
+        self.current = factory(ckpt_dir)
+        self.draining = False
+        # the drain was set by the running reload, which lifts it
+        self._reload_drained = False
+        self.loading = False
+        self._retired = []
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.current, name)
+
+    @property
+    def state(self):
+        if self.draining:
+            return DRAINING
+        return LOADING if self.loading else WARM
+
+    @property
+    def accepting(self):
+        return not self.draining
+
+    @property
+    def reloadable(self):
+        """False when serving a `ReplicaPool`, whose workers cannot be forked from the running server."""
+        return getattr(self.current, "reloadable", True)
+
+    def report(self):
+        schedulers = [self.current] + self._retired
+        return {
+            "state": self.state,
+            "ckpt_dir": self.ckpt_dir,
+            "open": sum(s.num_open for s in schedulers),
+            "retiring": len(self._retired),
+        }
+
+    def submit(self, *args, accepted=False, **kwargs):
+        scheduler = self._serving(accepted)
+        return self._own(scheduler, scheduler.submit(*args, **kwargs))
+
+    def submit_text(self, *args, accepted=False, **kwargs):
+        scheduler = self._serving(accepted)
+        return self._own(scheduler, scheduler.submit_text(*args, **kwargs))
+
+    def open_stream(self, *args, **kwargs):
+        scheduler = self._serving()
+        return self._own(scheduler, scheduler.open_stream(*args, **kwargs))
+
+    def append_audio(self, req, audio):
+        req.owner.append_audio(req, audio)
+
+    def end_audio(self, req):
+        req.owner.end_audio(req)
+
+    def cancel(self, req):
+        if isinstance(req, StreamRequest):
+            return req.owner.cancel(req)
+        return any(s.cancel(req) for s in [self.current] + self._retired)
+
+    def drain(self):
+        if not self.draining:
+            print(f"[drain] no new turns, {self.report()['open']} still open")
+        self.draining = True
+        self._reload_drained = False
+
+    def undrain(self):
+        if self.draining:
+            print("[drain] taking new turns again")
+        self.draining = False
+        self._reload_drained = False
+
+    def reload(self, ckpt_dir=None, drain=False):
+        """Load `ckpt_dir` (the current checkpoint by default) in the background, with `drain` taking no new
+        turns until it serves. False if a load is running."""
+        if not self.reloadable:
+            raise RuntimeError("a replica pool cannot be reloaded, restart the server instead")
+        with self._lock:
+            if self.loading:
+                return False
+            self.loading = True
+        if drain and not self.draining:
+            self.drain()
+            self._reload_drained = True
+        threading.Thread(
+            target=self._reload, args=(ckpt_dir or self.ckpt_dir,), name="model-reload", daemon=True
+        ).start()
+        return True
+
+    def close(self):
+        for scheduler in [self.current] + self._retired:
+            scheduler.close()
+
+    def _serving(self, accepted=False):
+        if self.draining and not accepted:
+            raise Draining("the server is draining")
+        return self.current
+
+    def _own(self, scheduler, req):
+        # later calls for the turn go to the scheduler that holds its rows, even after a switch
+        req.owner = scheduler
+        return req
+
+    def _reload(self, ckpt_dir):
+        t0 = time.perf_counter()
+        print(f"[reload] loading {ckpt_dir}")
+        try:
+            scheduler = self._factory(ckpt_dir)
+        except Exception as e:
+            print(f"[reload] {ckpt_dir} failed, still serving {self.ckpt_dir}: {e}")
+            print(traceback.format_exc())
+            self.loading = False
+            self._end_reload_drain()
+            return
+        old, self.current = self.current, scheduler
+        self.ckpt_dir = ckpt_dir
+        self._retired.append(old)
+        self.loading = False
+        self._end_reload_drain()
+        print(f"[reload] serving {ckpt_dir} after {time.perf_counter() - t0:.1f}s, {old.num_open} turns left on the old model")
+        while old.num_open:
+            time.sleep(0.5)
+        old.close()
+        self._retired.remove(old)
+        print("[reload] old model closed")
+
+    def _end_reload_drain(self):
+        if self._reload_drained:
+            self.undrain()
@@ -8,15 +8,7 @@ from litgpt import Tokenizer
 from litgpt.utils import (
     num_parameters,
 )
-from litgpt.generate.base import (
-    generate_AA,
-    generate_ASR,
-    generate_TA,
-    generate_TT,
-    generate_AT,
-    generate_TA_BATCH,
-    next_token_batch
-)
+from litgpt.generate.base import generate, generate_stream
 import soundfile as sf
 from litgpt.model import GPT, Config
 from lightning.fabric.utilities.load import _lazy_load as lazy_load
@@ -51,6 +43,13 @@ _input_a = audio_vocabsize + 2
 _answer_a = audio_vocabsize + 3
 _split = audio_vocabsize + 4
 
+# sampling and stop tokens of the offline entry points
+GENERATE_KWARGS = dict(
+    max_returned_tokens=2048, temperature=0.9, top_k=1, eos_id_a=_eoa, eos_id_t=_eot, pad_id_t=_pad_t,
+)
+# kv positions leased for an answer on top of its prompt, the cache grows past them in chunks
+KV_ANSWER_BUDGET = 512
+
 
 def get_input_ids_TA(text, text_tokenizer):
     input_ids_item = [[] for _ in range(8)]
@@ -138,7 +137,8 @@ def get_input_ids_whisper_ATBatch(mel, leng, whispermodel, device):
 
 
 def load_audio(path):
-    audio = whisper.load_audio(path)
+    """`path` is an audio file or 16 kHz mono float32 samples that were decoded already."""
+    audio = whisper.load_audio(path) if isinstance(path, str) else path
     duration_ms = (len(audio) / 16000) * 1000
     audio = whisper.pad_or_trim(audio)
     mel = whisper.log_mel_spectrogram(audio)
@@ -148,23 +148,8 @@ def load_audio(path):
 def A1_A2_batch(fabric, audio_feature, input_ids, leng, model, text_tokenizer, step,
                 snacmodel, out_dir=None):
     with fabric.init_tensor():
-        model.set_kv_cache(batch_size=2)
-    tokenlist = generate_TA_BATCH(
-        model,
-        audio_feature,
-        input_ids,
-        [leng, leng],
-        ["A1A2", "A1T2"],
-        max_returned_tokens=2048,
-        temperature=0.9,
-        top_k=1,
-        eos_id_a=_eoa,
-        eos_id_t=_eot,
-        pad_id_t=_pad_t,
-        shift=padded_text_vocabsize,
-        include_prompt=True,
-        generate_text=True,
-    )
+        model.set_kv_cache(batch_size=2, length=input_ids[0].size(1) + KV_ANSWER_BUDGET)
+    tokenlist = generate(model, "A1A2_BATCH", input_ids, audio_feature, **GENERATE_KWARGS)
     text_tokenlist = tokenlist[-1]
     if text_vocabsize in text_tokenlist:
         text_tokenlist = text_tokenlist[: text_tokenlist.index(text_vocabsize)]
@@ -192,46 +177,16 @@ def A1_A2_batch(fabric, audio_feature, input_ids, leng, model, text_tokenizer, s
 
 def A1_T2(fabric, audio_feature, input_ids, leng, model, text_tokenizer, step):
     with fabric.init_tensor():
-        model.set_kv_cache(batch_size=1)
-    tokenlist = generate_AT(
-        model,
-        audio_feature,
-        input_ids,
-        [leng],
-        ["AT"],
-        max_returned_tokens=2048,
-        temperature=0.9,
-        top_k=1,
-        eos_id_a=_eoa,
-        eos_id_t=_eot,
-        pad_id_t=_pad_t,
-        shift=padded_text_vocabsize,
-        include_prompt=True,
-        generate_text=True,
-    )
+        model.set_kv_cache(batch_size=1, length=input_ids[0].size(1) + KV_ANSWER_BUDGET)
+    tokenlist = generate(model, "A1T2", input_ids, audio_feature, **GENERATE_KWARGS)
     return text_tokenizer.decode(torch.tensor(tokenlist)).strip()
 
 
 def A1_A2(fabric, audio_feature, input_ids, leng, model, text_tokenizer, step,
           snacmodel, out_dir=None):
     with fabric.init_tensor():
-        model.set_kv_cache(batch_size=1)
-    tokenlist = generate_AA(
-        model,
-        audio_feature,
-        input_ids,
-        [leng],
-        ["A1T2"],
-        max_returned_tokens=2048,
-        temperature=0.9,
-        top_k=1,
-        eos_id_a=_eoa,
-        eos_id_t=_eot,
-        pad_id_t=_pad_t,
-        shift=padded_text_vocabsize,
-        include_prompt=True,
-        generate_text=True,
-    )
+        model.set_kv_cache(batch_size=1, length=input_ids[0].size(1) + KV_ANSWER_BUDGET)
+    tokenlist = generate(model, "A1A2", input_ids, audio_feature, **GENERATE_KWARGS)
     audiolist = reconscruct_snac(tokenlist)
     tokenlist = tokenlist[-1]
     if text_vocabsize in tokenlist:
@@ -257,23 +212,8 @@ def A1_A2(fabric, audio_feature, input_ids, leng, model, text_tokenizer, step,
 
 def A1_T1(fabric, audio_feature, input_ids, leng, model, text_tokenizer, step):
     with fabric.init_tensor():
-        model.set_kv_cache(batch_size=1)
-    tokenlist = generate_ASR(
-        model,
-        audio_feature,
-        input_ids,
-        [leng],
-        ["A1T1"],
-        max_returned_tokens=2048,
-        temperature=0.9,
-        top_k=1,
-        eos_id_a=_eoa,
-        eos_id_t=_eot,
-        pad_id_t=_pad_t,
-        shift=padded_text_vocabsize,
-        include_prompt=True,
-        generate_text=True,
-    )
+        model.set_kv_cache(batch_size=1, length=input_ids[0].size(1) + KV_ANSWER_BUDGET)
+    tokenlist = generate(model, "A1T1", input_ids, audio_feature, **GENERATE_KWARGS)
     model.clear_kv_cache()
     return text_tokenizer.decode(torch.tensor(tokenlist)).strip()
 
@@ -281,23 +221,8 @@ def A1_T1(fabric, audio_feature, input_ids, leng, model, text_tokenizer, step):
 def T1_A2(fabric, input_ids, model, text_tokenizer, step,
           snacmodel, out_dir=None):
     with fabric.init_tensor():
-        model.set_kv_cache(batch_size=1)
-    tokenlist = generate_TA(
-        model,
-        None,
-        input_ids,
-        None,
-        ["T1A2"],
-        max_returned_tokens=2048,
-        temperature=0.9,
-        top_k=1,
-        eos_id_a=_eoa,
-        eos_id_t=_eot,
-        pad_id_t=_pad_t,
-        shift=padded_text_vocabsize,
-        include_prompt=True,
-        generate_text=True,
-    )
+        model.set_kv_cache(batch_size=1, length=input_ids[0].size(1) + KV_ANSWER_BUDGET)
+    tokenlist = generate(model, "T1A2", input_ids, None, **GENERATE_KWARGS)
 
     audiolist = reconscruct_snac(tokenlist)
     tokenlist = tokenlist[-1]
@@ -326,23 +251,8 @@ def T1_A2(fabric, input_ids, model, text_tokenizer, step,
 def T1_T2(fabric, input_ids, model, text_tokenizer, step):
 
     with fabric.init_tensor():
-        model.set_kv_cache(batch_size=1)
-    tokenlist = generate_TT(
-        model,
-        None,
-        input_ids,
-        None,
-        ["T1T2"],
-        max_returned_tokens=2048,
-        temperature=0.9,
-        top_k=1,
-        eos_id_a=_eoa,
-        eos_id_t=_eot,
-        pad_id_t=_pad_t,
-        shift=padded_text_vocabsize,
-        include_prompt=True,
-        generate_text=True,
-    )
+        model.set_kv_cache(batch_size=1, length=input_ids[0].size(1) + KV_ANSWER_BUDGET)
+    tokenlist = generate(model, "T1T2", input_ids, None, **GENERATE_KWARGS)
     model.clear_kv_cache()
     return text_tokenizer.decode(torch.tensor(tokenlist)).strip()
 
@@ -481,8 +391,9 @@ def download_model(ckpt_dir):
     
 class OmniInference:
 
-    def __init__(self, ckpt_dir='./checkpoint', device='cuda:0'):
+    def __init__(self, ckpt_dir='./checkpoint', device='cuda:0', kv_answer_budget=KV_ANSWER_BUDGET):
         self.device = device
+        self.kv_answer_budget = kv_answer_budget
         print(f"Initializing OmniInference with checkpoint: {ckpt_dir}, device: {device}")
         
         if not os.path.exists(ckpt_dir):
@@ -515,109 +426,51 @@ class OmniInference:
         assert os.path.exists(audio_path), f"audio file {audio_path} not found"
         model = self.model
 
-        with self.fabric.init_tensor():
-            model.set_kv_cache(batch_size=2,device=self.device)
-
         mel, leng = load_audio(audio_path)
         audio_feature, input_ids = get_input_ids_whisper_ATBatch(mel, leng, self.whispermodel, self.device)
-        T = input_ids[0].size(1)
-        device = input_ids[0].device
-
-        assert max_returned_tokens > T, f"max_returned_tokens {max_returned_tokens} should be greater than audio length {T}"
-
-        if model.max_seq_length < max_returned_tokens - 1:
-            raise NotImplementedError(
-                f"max_seq_length {model.max_seq_length} needs to be >= {max_returned_tokens - 1}"
-            )
-
-        input_pos = torch.tensor([T], device=device)
-        list_output = [[] for i in range(8)]
-        tokens_A, token_T = next_token_batch(
+        with self.fabric.init_tensor():
+            model.set_kv_cache(batch_size=2, device=self.device, length=input_ids[0].size(1) + self.kv_answer_budget)
+        stream = generate_stream(
             model,
-            audio_feature.to(torch.float32).to(model.device),
+            "A1A2_BATCH",
             input_ids,
-            [T - 3, T - 3],
-            ["A1T2", "A1T2"],
-            input_pos=torch.arange(0, T, device=device),
+            audio_feature,
+            max_returned_tokens,
             temperature=temperature,
             top_k=top_k,
             top_p=top_p,
+            eos_id_a=eos_id_a,
+            eos_id_t=eos_id_t,
+            pad_id_t=_pad_t,
+            # read the tokens when an audio chunk is due
+            read_every=stream_stride,
+            read_offset=6 + stream_stride,
         )
 
-        for i in range(7):
-            list_output[i].append(tokens_A[i].tolist()[0])
-        list_output[7].append(token_T.tolist()[0])
-
-        model_input_ids = [[] for i in range(8)]
-        for i in range(7):
-            tokens_A[i] = tokens_A[i].clone() + padded_text_vocabsize + i * padded_audio_vocabsize
-            model_input_ids[i].append(tokens_A[i].clone().to(device).to(torch.int32))
-            model_input_ids[i].append(torch.tensor([layershift(4097, i)], device=device))
-            model_input_ids[i] = torch.stack(model_input_ids[i])
-
-        model_input_ids[-1].append(token_T.clone().to(torch.int32))
-        model_input_ids[-1].append(token_T.clone().to(torch.int32))
-        model_input_ids[-1] = torch.stack(model_input_ids[-1])
-
-        text_end = False
-        index = 1
+        list_output = [[] for i in range(8)]
         nums_generate = stream_stride
-        begin_generate = False
         current_index = 0
-        for _ in tqdm(range(2, max_returned_tokens - T + 1)):
-            tokens_A, token_T = next_token_batch(
-                model,
-                None,
-                model_input_ids,
-                None,
-                None,
-                input_pos=input_pos,
-                temperature=temperature,
-                top_k=top_k,
-                top_p=top_p,
-            )
-
-            if text_end:
-                token_T = torch.tensor([_pad_t], device=device)
-
-            if tokens_A[-1] == eos_id_a:
-                break
-
-            if token_T == eos_id_t:
-                text_end = True
-
-            for i in range(7):
-                list_output[i].append(tokens_A[i].tolist()[0])
-            list_output[7].append(token_T.tolist()[0])
-
-            model_input_ids = [[] for i in range(8)]
+        kv_total = kv_peak = 0
+        for index, (tokens_A, token_T) in enumerate(tqdm(stream)):
+            kv_total += model.kv_bytes
+            kv_peak = max(kv_peak, model.kv_bytes)
             for i in range(7):
-                tokens_A[i] = tokens_A[i].clone() +padded_text_vocabsize + i * padded_audio_vocabsize
-                model_input_ids[i].append(tokens_A[i].clone().to(device).to(torch.int32))
-                model_input_ids[i].append(
-                    torch.tensor([layershift(4097, i)], device=device)
-                )
-                model_input_ids[i] = torch.stack(model_input_ids[i])
-
-            model_input_ids[-1].append(token_T.clone().to(torch.int32))
-            model_input_ids[-1].append(token_T.clone().to(torch.int32))
-            model_input_ids[-1] = torch.stack(model_input_ids[-1])
-
-            if index == 7:
-                begin_generate = True
-
-            if begin_generate:
-                current_index += 1
-                if current_index == nums_generate:
-                    current_index = 0
-                    snac = get_snac(list_output, index, nums_generate)
-                    audio_stream = generate_audio_data(snac, self.snacmodel, self.device)
-                    yield audio_stream
+                list_output[i].append(tokens_A[i])
+            list_output[7].append(token_T)
+
+            # the 7 layers of a SNAC frame are staggered over 7 positions, audio starts after them
+            if index < 7:
+                continue
+            current_index += 1
+            if current_index == nums_generate:
+                current_index = 0
+                snac = get_snac(list_output, index, nums_generate)
+                audio_stream = generate_audio_data(snac, self.snacmodel, self.device)
+                yield audio_stream
 
-            input_pos = input_pos.add_(1)
-            index += 1
         text = self.text_tokenizer.decode(torch.tensor(list_output[-1]))
         print(f"text output: {text}")
+        print(f"kv cache: peak {kv_peak / 2**20:.1f} MiB, average {kv_total / max(1, len(list_output[-1])) / 2**20:.1f} MiB")
         model.clear_kv_cache()
         return list_output
 
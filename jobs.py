@@ -0,0 +1,235 @@
+"""Offline batch jobs.
+
+A job is a list of inputs answered with the same task: spoken answers to speech (A1A2), spoken answers to
+text (T1A2) or transcripts (A1T1). The inputs become batch priority turns of the `DecodeScheduler`, which
+packs them into its batched decode steps next to the live conversations, so a job never needs a KV cache
+of its own. Each finished input writes `<id>.wav` and/or `<id>.txt` to the job's directory and a line
+to its `results.jsonl`, and `job.json` holds the job's state.
+"""
+
+import base64
+import io
+import json
+import os
+import re
+import threading
+import time
+import uuid
+import zipfile
+from collections import deque
+
+import numpy as np
+import soundfile as sf
+
+from scheduler import BATCH, TASKS
+from utils.audio_decode import decode_audio, pcm16_to_float
+
+
+# input ids and file names: no path separators and no leading dot
+_ID = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{0,127}$")
+_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{0,159}$")
+
+
+class Job:
+    def __init__(self, job_id, task, directory, total):
+        self.id = job_id
+        self.task = task
+        self.directory = directory
+        self.total = total
+        self.completed = 0
+        self.failed = 0
+        self.created = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    @property
+    def status(self):
+        if self.finished is not None:
+            return "done"
+        return "running" if self.completed + self.failed else "queued"
+
+    def report(self):
+        return {
+            "id": self.id,
+            "task": self.task,
+            "status": self.status,
+            "total": self.total,
+            "completed": self.completed,
+            "failed": self.failed,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+class JobManager:
+    """Runs jobs through a server's `Deployment` with at most `max_inflight` of their turns submitted at
+    a time, by default as many as the scheduler currently serving has row pairs: enough to keep the rows
+    batch turns may use busy without flooding the queue. Each input goes through `admission` as a batch
+    turn first and waits out its Retry-After when turned away."""
+
+    def __init__(self, scheduler, results_dir="./output/jobs", max_inflight=None, stream_stride=4,
+                 max_returned_tokens=2048, admission=None):
+        self.scheduler = scheduler
+        self.admission = admission
+        self.results_dir = results_dir
+        self.stream_stride = stream_stride
+        self.max_returned_tokens = max_returned_tokens
+        self._max_inflight = max_inflight
+        self._jobs = {}
+        # inputs waiting to be submitted, and the ones submitted and not finished
+        self._queue = deque()
+        self._inflight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def max_inflight(self):
+        # read from the scheduler each time, a reload can change its rows
+        return self._max_inflight or self.scheduler.max_sessions
+
+    def create(self, payload):
+        """Start a job from `{"task": ..., "inputs": [{"id": ..., "text" | "pcm16" | "audio": ...}, ...]}`.
+        `pcm16` is base64 raw 16 kHz PCM16 and `audio` a base64 compressed recording. Returns the `Job`."""
+        if not isinstance(payload, dict):
+            raise ValueError("expected a JSON object")
+        task = payload.get("task", "A1A2")
+        if task not in TASKS:
+            raise ValueError(f"task must be one of {TASKS}, got {task}")
+        inputs = payload.get("inputs")
+        if not isinstance(inputs, list) or not inputs:
+            raise ValueError("inputs must be a non-empty list")
+        field = ("text",) if task == "T1A2" else ("pcm16", "audio")
+        items, seen = [], set()
+        for index, item in enumerate(inputs):
+            if not isinstance(item, dict):
+                raise ValueError(f"input {index}: expected an object")
+            item_id = str(item.get("id", f"{index:06d}"))
+            if not _ID.match(item_id) or item_id in seen:
+                raise ValueError(f"input {index}: id {item_id!r} is not a unique file-safe name")
+            if not any(item.get(name) for name in field):
+                raise ValueError(f"input {index}: {task} inputs need {' or '.join(field)}")
+            seen.add(item_id)
+            items.append((item_id, item))
+
+        job_id = uuid.uuid4().hex
+        job = Job(job_id, task, os.path.join(self.results_dir, job_id), len(items))
+        os.makedirs(job.directory)
+        self._jobs[job.id] = job
+        self._save(job)
+        print(f"[job] id={job.id} task={task} inputs={len(items)}")
+        with self._lock:
+            self._queue.extend((job, item_id, item) for item_id, item in items)
+        self._pump()
+        return job
+
+    def get(self, job_id):
+        """The job's report, also for jobs of an earlier run found in the results directory. None if unknown."""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.report()
+        path = self.path(job_id, "job.json")
+        if path is None:
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def path(self, job_id, name):
+        """Path of one of the job's files, None if there is no such file."""
+        if not _ID.match(job_id) or not _NAME.match(name):
+            return None
+        path = os.path.join(self.results_dir, job_id, name)
+        return path if os.path.isfile(path) else None
+
+    def archive(self, job_id):
+        """All of the job's files as a zip archive, None for an unknown job."""
+        directory = os.path.join(self.results_dir, job_id)
+        if not _ID.match(job_id) or not os.path.isdir(directory):
+            return None
+        out = io.BytesIO()
+        with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as archive:
+            for name in sorted(os.listdir(directory)):
+                archive.write(os.path.join(directory, name), arcname=f"{job_id}/{name}")
+        return out.getvalue()
+
+    def _pump(self):
+        with self._lock:
+            while self._queue and self._inflight < self.max_inflight:
+                self._inflight += 1
+                threading.Thread(target=self._run, args=self._queue.popleft(), name="omni-job", daemon=True).start()
+
+    def _run(self, job, item_id, item):
+        try:
+            self._answer(job, item_id, item)
+        finally:
+            with self._lock:
+                self._inflight -= 1
+            self._pump()
+
+    def _answer(self, job, item_id, item):
+        result = {"id": item_id}
+        try:
+            req = self._submit(job, item_id, item)
+            pcm, text = [], []
+            for chunk in req:
+                if isinstance(chunk, str):
+                    text.append(chunk)
+                else:
+                    pcm.append(chunk)
+            if pcm:
+                samples = np.frombuffer(b"".join(pcm), dtype="<i2")
+                sf.write(os.path.join(job.directory, f"{item_id}.wav"), samples, 24000, subtype="PCM_16")
+                result["audio"] = f"{item_id}.wav"
+                result["seconds"] = round(len(samples) / 24000, 3)
+            result["text"] = "".join(text).strip()
+            with open(os.path.join(job.directory, f"{item_id}.txt"), "w") as f:
+                f.write(result["text"])
+        except Exception as e:
+            print(f"[job] id={job.id} input={item_id} failed: {e}")
+            result["error"] = str(e)
+        self._done(job, result)
+
+    def _submit(self, job, item_id, item):
+        options = dict(
+            stream_stride=self.stream_stride,
+            max_returned_tokens=self.max_returned_tokens,
+            req_id=f"{job.id}-{item_id}",
+            text=True,
+            priority=BATCH,
+            # a drain that started after the job was accepted does not fail its remaining inputs
+            accepted=True,
+        )
+        if job.task == "T1A2":
+            self._admit(0, options["req_id"])
+            return self.scheduler.submit_text(item["text"], **options)
+        if item.get("pcm16"):
+            audio = pcm16_to_float(base64.b64decode(item["pcm16"]))
+        else:
+            audio = decode_audio(base64.b64decode(item["audio"]))
+        self._admit(len(audio) / 16000, options["req_id"])
+        return self.scheduler.submit(audio, task=job.task, **options)
+
+    def _admit(self, audio_seconds, req_id):
+        # the job was accepted already, its inputs wait for room instead of failing
+        while self.admission is not None:
+            retry_after = self.admission.check(audio_seconds, self.stream_stride, req_id=req_id, priority=BATCH)
+            if retry_after is None:
+                return
+            time.sleep(retry_after)
+
+    def _done(self, job, result):
+        with job._lock:
+            if "error" in result:
+                job.failed += 1
+            else:
+                job.completed += 1
+            with open(os.path.join(job.directory, "results.jsonl"), "a") as f:
+                f.write(json.dumps(result) + "\n")
+            if job.completed + job.failed == job.total:
+                job.finished = time.time()
+                print(f"[job] id={job.id} done completed={job.completed} failed={job.failed}")
+            self._save(job)
+
+    def _save(self, job):
+        path = os.path.join(job.directory, "job.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(job.report(), f)
+        os.replace(path + ".tmp", path)
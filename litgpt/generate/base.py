@@ -1,6 +1,6 @@
 # Copyright Lightning AI. Licensed under the Apache License 2.0, see LICENSE file.
 
-from typing import Any, Literal, Optional
+from typing import Any, Iterator, List, NamedTuple, Optional, Tuple
 
 import torch
 # import torch._dynamo.config
@@ -8,7 +8,6 @@ import torch
 
 from litgpt.model import GPT
 from utils.snac_utils import layershift, snac_config
-from tqdm import tqdm
 
 
 def multinomial_num_samples_1(probs: torch.Tensor) -> torch.Tensor:
@@ -62,140 +61,183 @@ def sample(
     return torch.argmax(logits, dim=-1, keepdim=True)
 
 
-def next_token(
-    model: GPT, input_pos: torch.Tensor, x: list, **kwargs: Any
-) -> torch.Tensor:
-    input_pos = input_pos.to(model.device)
-    logits_a, logit_t = model(x, input_pos)
-
-    next_audio_tokens = []
-    for logit_a in logits_a:
-        next_a = sample(logit_a, **kwargs).to(dtype=x[0].dtype)
-        next_audio_tokens.append(next_a)
-    next_t = sample(logit_t, **kwargs).to(dtype=x[0].dtype)
-    return next_audio_tokens, next_t
-
-
-def next_token_asr(
-    model: GPT,
-    input_pos: torch.Tensor,
-    audio_features: torch.tensor,
-    lens: int,
-    input_ids: list,
-    **kwargs: Any,
+def sample_rows(
+    logits: torch.Tensor,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+    top_p: float = 1.0,
 ) -> torch.Tensor:
-    input_pos = input_pos.to(model.device)
-    input_ids = [input_id.to(model.device) for input_id in input_ids]
-    logits_a, logit_t = model(audio_features, input_ids, input_pos, whisper_lens=lens)
-
-    next_audio_tokens = []
-    for logit_a in logits_a:
-        next_a = sample(logit_a, **kwargs).to(dtype=input_ids[0].dtype)
-        next_audio_tokens.append(next_a)
-    next_t = sample(logit_t, **kwargs).to(dtype=input_ids[0].dtype)
-    return next_audio_tokens, next_t
+    """Same as `sample`, applied independently to every row of `logits` of shape (N, vocab). Returns (N, 1)."""
+    if top_p < 0.0 or top_p > 1.0:
+        raise ValueError(f"top_p must be in [0, 1], got {top_p}")
+    if top_k is not None:
+        v, i = torch.topk(logits, min(top_k, logits.size(-1)))
+        logits = torch.full_like(logits, float("-inf")).scatter_(-1, i, v)
+    if temperature > 0.0 or top_p > 0.0:
+        if temperature > 0.0:
+            logits = logits / temperature
+        if top_p < 1.0:
+            logits = torch.stack([sample_top_p(row, top_p) for row in logits])
+        probs = torch.nn.functional.softmax(logits, dim=-1)
+        return multinomial_num_samples_1(probs)
+    return torch.argmax(logits, dim=-1, keepdim=True)
 
 
-def next_token_A1T2(
-    model: GPT,
-    audio_features: torch.tensor,
-    input_ids: list,
-    whisper_lens: int,
-    task: list,
-    input_pos: torch.Tensor,
-    **kwargs: Any,
-) -> torch.Tensor:
-    input_pos = input_pos.to(model.device)
-    input_ids = [input_id.to(model.device) for input_id in input_ids]
-    logits_a, logit_t = model(
-        audio_features, input_ids, input_pos, whisper_lens=whisper_lens, task=task
-    )
+class DecodeTask(NamedTuple):
+    """How the answer of one of the model's tasks is decoded.
 
-    next_audio_tokens = []
-    for logit_a in logits_a:
-        next_a = sample(logit_a, **kwargs).to(dtype=input_ids[0].dtype)
-        next_audio_tokens.append(next_a)
-    next_t = sample(logit_t, **kwargs).to(dtype=input_ids[0].dtype)
-    return next_audio_tokens, next_t
+    `audio_out` tasks sample all eight layers and feed the audio tokens back; the others only sample the
+    text layer and feed padding on the audio layers. `rows=2` decodes the answer on two kv rows at once,
+    the first producing audio and the second text, as in `OmniInference.run_AT_batch_stream`.
+    `model_task` tells the whisper adapter how to read the features of a spoken prompt.
 
+    A step can decode several answers of a task side by side, one group of `rows` kv rows each, as the
+    `DecodeScheduler` does with its row pairs.
+    """
 
-def next_token_A1T1(
-    model: GPT,
-    audio_features: torch.tensor,
-    input_ids: list,
-    whisper_lens: int,
-    task: list,
-    input_pos: torch.Tensor,
-    **kwargs: Any,
-) -> torch.Tensor:
-    input_pos = input_pos.to(model.device)
-    input_ids = [input_id.to(model.device) for input_id in input_ids]
-    logits_a, logit_t = model(
-        audio_features, input_ids, input_pos, whisper_lens=whisper_lens, task=task
+    name: str
+    audio_out: bool
+    rows: int = 1
+    model_task: Optional[str] = None
+
+
+DECODE_TASKS = {
+    task.name: task
+    for task in (
+        DecodeTask("A1A2", audio_out=True, model_task="A1T2"),
+        DecodeTask("A1A2_BATCH", audio_out=True, rows=2, model_task="A1T2"),
+        DecodeTask("T1A2", audio_out=True),
+        DecodeTask("A1T2", audio_out=False, model_task="AT"),
+        DecodeTask("A1T1", audio_out=False, model_task="asr"),
+        DecodeTask("A1T1_BATCH", audio_out=False, rows=2, model_task="asr"),
+        DecodeTask("T1T2", audio_out=False),
     )
-    next_t = sample(logit_t, **kwargs).to(dtype=input_ids[0].dtype)
-    return next_t
+}
 
 
-def next_token_batch(
+def decode_step(
     model: GPT,
-    audio_features: torch.tensor,
+    task: DecodeTask,
+    audio_features: Optional[torch.Tensor],
     input_ids: list,
-    whisper_lens: int,
-    task: list,
     input_pos: torch.Tensor,
+    whisper_lens: Optional[list] = None,
+    kv_rows: Optional[slice] = None,
     **kwargs: Any,
-) -> torch.Tensor:
-    input_pos = input_pos.to(model.device)
-    input_ids = [input_id.to(model.device) for input_id in input_ids]
+) -> Tuple[Optional[torch.Tensor], torch.Tensor]:
+    """One forward pass and the sampled answer tokens of every group of `task.rows` rows: the audio tokens
+    (7, groups) of the first row of each group, None for text-only tasks, and the text tokens (1, groups)
+    of the last row."""
+    model_task = [task.model_task] * input_ids[0].size(0) if audio_features is not None else None
     logits_a, logit_t = model(
-        audio_features, input_ids, input_pos, whisper_lens=whisper_lens, task=task
+        audio_features, input_ids, input_pos, whisper_lens=whisper_lens, task=model_task, kv_rows=kv_rows
     )
+    token_t = sample_rows(logit_t[task.rows - 1 :: task.rows, -1], **kwargs).view(1, -1)
+    if not task.audio_out:
+        return None, token_t
+    logits_a = torch.stack([logit_a[:: task.rows, -1] for logit_a in logits_a])
+    tokens_a = sample_rows(logits_a.flatten(0, 1), **kwargs).view(7, -1)
+    return tokens_a, token_t
+
+
+def stop_rules(
+    tokens_a: Optional[torch.Tensor],
+    token_t: torch.Tensor,
+    text_end: torch.Tensor,
+    audio_out: Any,
+    eos_id_a: Optional[int] = None,
+    eos_id_t: Optional[int] = None,
+    pad_id_t: Optional[int] = None,
+    live: Optional[torch.Tensor] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """When the answers decoded in a step end, evaluated on the device. Shapes as returned by `decode_step`.
+
+    Audio answers end once the last audio layer samples `eos_id_a`, and after their text sampled `eos_id_t`
+    it goes on as `pad_id_t`; `text_end` (1, groups) records that in place. Text-only answers end once
+    their text samples `eos_id_t`. `audio_out` is the kind of all answers, or a (1, groups) mask of them.
+    Only the answers in the `live` mask are updated, the others were not decoded. Returns the text tokens
+    with the padding applied and whether each answer ended.
+    """
+    if not isinstance(audio_out, torch.Tensor):
+        audio_out = torch.full_like(text_end, audio_out)
+    token_t = token_t.masked_fill(text_end & audio_out, pad_id_t if pad_id_t is not None else 0)
+    no = torch.zeros_like(text_end)
+    audio_end = tokens_a[-1:] == eos_id_a if tokens_a is not None and eos_id_a is not None else no
+    text_eos = token_t == eos_id_t if eos_id_t is not None else no
+    ended = torch.where(audio_out, audio_end, text_eos)
+    text_eos = text_eos & audio_out
+    if live is not None:
+        ended &= live
+        text_eos &= live
+    text_end |= text_eos
+    return token_t, ended
+
+
+class DecodeInput:
+    """The input ids of the decode steps, a persistent (8, rows, 1) buffer the model reads every step.
+
+    The audio layers hold the `end_of_audio` padding from the start. Only the sampled tokens are written
+    in place: shifted into their layers on the first row of each group for audio tasks, and the text token
+    on every row of its group.
+    """
 
-    for i in range(7):
-        logits_a[i] = logits_a[i][0].unsqueeze(0)
-    logit_t = logit_t[1].unsqueeze(0)
+    def __init__(self, task: DecodeTask, device: torch.device, groups: int = 1) -> None:
+        self.ids = torch.empty(8, task.rows * groups, 1, dtype=torch.int32, device=device)
+        self.ids[:7] = torch.tensor(
+            [layershift(snac_config.end_of_audio, i) for i in range(7)], dtype=torch.int32, device=device
+        ).view(7, 1, 1)
+        self.offsets = layershift(0, torch.arange(7, device=device)).view(7, 1)
+        self.audio = self.ids[:7, :: task.rows, 0] if task.audio_out else None
+        self.text = self.ids[7].view(groups, task.rows)
+        self.layers = list(self.ids)
 
-    next_audio_tokens = []
-    for logit_a in logits_a:
-        next_a = sample(logit_a, **kwargs).to(dtype=input_ids[0].dtype)
-        next_audio_tokens.append(next_a)
-    next_t = sample(logit_t, **kwargs).to(dtype=input_ids[0].dtype)
-    return next_audio_tokens, next_t
+    def update(self, tokens_a: Optional[torch.Tensor], token_t: torch.Tensor) -> list:
+        if self.audio is not None:
+            torch.add(tokens_a, self.offsets, out=self.audio)
+        self.text.copy_(token_t.view(-1, 1))
+        return self.layers
 
 
 # torch._dynamo.config.automatic_dynamic_shapes = True
 # torch._inductor.config.triton.unique_kernel_names = True
 # torch._inductor.config.coordinate_descent_tuning = True
-# next_token = torch.compile(next_token, mode="reduce-overhead")
+# decode_step = torch.compile(decode_step, mode="reduce-overhead")
 
 
 @torch.inference_mode()
-def generate(
+def generate_stream(
     model: GPT,
+    task: str,
     input_ids: list,
-    max_returned_tokens: int,
+    audio_features: Optional[torch.Tensor] = None,
+    max_returned_tokens: int = 2048,
     *,
     temperature: float = 1.0,
     top_k: Optional[int] = None,
     top_p: float = 1.0,
     eos_id_a: Optional[int] = None,
     eos_id_t: Optional[int] = None,
-    pad_id: Optional[int] = None,
-    shift: Optional[int] = None,
-    include_prompt: bool = True,
-    generate_text=False,
-) -> torch.Tensor:
-    # print("eos_id_a:", eos_id_a)
-    # print("eos_id_t:", eos_id_t)
-    # print("pad_id:", pad_id)
+    pad_id_t: Optional[int] = None,
+    read_every: int = 4,
+    read_offset: int = 0,
+) -> Iterator[Tuple[Optional[List[int]], int]]:
     """
-    Takes a conditioning sequence (prompt) as input and continues to generate as many tokens as requested.
-    The implementation of this function is modified from A. Karpathy's nanoGPT.
+    Decodes the answer to a prompt built by one of the `get_input_ids_*` helpers of `inference.py`, with
+    the kv cache set up for `DECODE_TASKS[task].rows` rows. A cache sized for less than the whole answer
+    grows as the answer gets longer. Yields the answer position by position as
+    (audio tokens, text token), the 7 audio tokens unshifted and None for text-only tasks.
+
+    The sampled tokens stay on the device, in a token history filled in place, and the stop rules are
+    evaluated there too, so decode steps are queued without waiting for the previous one. The host reads
+    the history only after the positions `read_offset + k * read_every`. A host copy of whether the answer
+    stopped is also filled without waiting; once it lands, no further step is queued. At most
+    `read_every - 1` steps past the end of the answer are decoded before the stop is seen; they are dropped.
 
     Args:
         model: The model to use.
-        prompt: Tensor of shape (T) with indices of the prompt sequence.
+        task: A key of `DECODE_TASKS`.
+        input_ids: The 8 prompt layers, each of shape (rows, T).
+        audio_features: Whisper features of a spoken prompt, (rows, T - 3, dim). None for text prompts.
         max_returned_tokens: The maximum number of tokens to return (given plus generated).
         temperature: Scales the predicted logits by 1 / temperature.
         top_k: If specified, only sample among the tokens with the k highest probabilities.
@@ -213,12 +255,18 @@ def generate(
 
             For more details, see https://arxiv.org/abs/1904.09751
             or https://huyenchip.com/2024/01/16/sampling.html#top_p
-        eos_id: If specified, stop generating any more token once the <eos> token is triggered.
-        include_prompt: If true (default) prepends the prompt (after applying the prompt style) to the output.
+        eos_id_a: Audio tasks stop once the last audio layer samples it.
+        eos_id_t: Text-only tasks stop once the text layer samples it. Audio tasks go on with `pad_id_t`
+            as their text until the audio ends.
+        pad_id_t: The text token of audio tasks after their text ended.
+        read_every: Positions decoded between two reads of the token history.
+        read_offset: A position after which the history is read, e.g. the first one that completes an audio chunk.
     """
-    T = input_ids[0].size(0)
-    device = input_ids[0].device
-    assert max_returned_tokens > T
+    task = DECODE_TASKS[task]
+    sampling = dict(temperature=temperature, top_k=top_k, top_p=top_p)
+    device = model.device
+    T = input_ids[0].size(1)
+    assert max_returned_tokens > T, f"max_returned_tokens {max_returned_tokens} should be greater than the prompt length {T}"
     if model.max_seq_length < max_returned_tokens - 1:
         # rolling the kv cache based on the `input_pos` value would be necessary. However, doing so would introduce a
         # data dependency on the `input_pos` tensor and impact model compilation. Since this setting is uncommon, we do
@@ -227,569 +275,66 @@ def generate(
             f"max_seq_length {model.max_seq_length} needs to be >= {max_returned_tokens - 1}"
         )
 
-    for input_id in input_ids:
-        input_id = [input_id]
-    (
-        tokens_A1,
-        tokens_A2,
-        tokens_A3,
-        tokens_A4,
-        tokens_A5,
-        tokens_A6,
-        tokens_A7,
-        tokens_T,
-    ) = input_ids
-
-    tokens_A1_output = [tokens_A1]
-    tokens_A2_output = [tokens_A2]
-    tokens_A3_output = [tokens_A3]
-    tokens_A4_output = [tokens_A4]
-    tokens_A5_output = [tokens_A5]
-    tokens_A6_output = [tokens_A6]
-    tokens_A7_output = [tokens_A7]
-    tokens_T_output = [tokens_T]
-
-    list_output = [
-        tokens_A1_output,
-        tokens_A2_output,
-        tokens_A3_output,
-        tokens_A4_output,
-        tokens_A5_output,
-        tokens_A6_output,
-        tokens_A7_output,
-        tokens_T_output,
-    ]
-
-    input_pos = torch.tensor([T], device=device)
-    model_input_ids = [
-        tokens_A1.view(1, -1),
-        tokens_A2.view(1, -1),
-        tokens_A3.view(1, -1),
-        tokens_A4.view(1, -1),
-        tokens_A5.view(1, -1),
-        tokens_A6.view(1, -1),
-        tokens_A7.view(1, -1),
-        tokens_T.view(1, -1),
-    ]
-
-    tokens_A, token_T = next_token(
-        model,
-        torch.arange(0, T, device=device),
-        model_input_ids,
-        temperature=temperature,
-        top_k=top_k,
-        top_p=top_p,
+    input_ids = [input_id.to(device) for input_id in input_ids]
+    whisper_lens = None
+    if audio_features is not None:
+        audio_features = audio_features.to(torch.float32).to(device)
+        whisper_lens = [T - 3] * task.rows
+    model.grow_kv_cache(T + 1)
+    tokens_a, token_t = decode_step(
+        model, task, audio_features, input_ids, torch.arange(0, T, device=device), whisper_lens, **sampling
     )
-    for i in range(7):
-        list_output[i].append(tokens_A[i].clone())
-    list_output[7].append(token_T.clone())
-
-    # prepare the input for the next iteration
-    for i in range(7):
-        tokens_A[i] = tokens_A[i].clone() + shift + i * snac_config.padded_vocab_size
-    token_T = token_T.clone()
-
-    text_end = False
-    max_returned_tokens = 1000
-    for _ in tqdm(range(2, max_returned_tokens - T + 1)):
-        model_input_ids = [
-            token_a.view(1, -1).to(torch.int32) for token_a in tokens_A
-        ] + [token_T.view(1, -1).to(torch.int32)]
-        tokens_A, token_T = next_token(
-            model,
-            input_pos,
-            model_input_ids,
-            temperature=temperature,
-            top_k=top_k,
-            top_p=top_p,
-        )
-        if text_end:
-            token_T = torch.tensor([pad_id], device=device)
-
-        for i in range(7):
-            list_output[i].append(tokens_A[i].clone())
-        list_output[7].append(token_T.clone())
-
-        if tokens_A[-1] == eos_id_a:
-            break
-        if token_T == eos_id_t:
-            if generate_text:
-                break
-            text_end = True
-
-        for i in range(7):
-            tokens_A[i] = tokens_A[i].clone() + shift + i * snac_config.padded_vocab_size
-        token_T = token_T.clone()
-        input_pos = input_pos.add_(1)
-
-    for i in range(len(list_output)):
-        list_output[i] = torch.cat(list_output[i])
-    return list_output
-
-
-@torch.inference_mode()
-def generate_TA_BATCH(
-    model: GPT,
-    audio_features: torch.Tensor,
-    input_ids: list,
-    leng,
-    task,
-    max_returned_tokens: int = 1000,
-    *,
-    temperature: float = 1.0,
-    top_k: Optional[int] = None,
-    top_p: float = 1.0,
-    eos_id_a: Optional[int] = None,
-    eos_id_t: Optional[int] = None,
-    pad_id_t: Optional[int] = None,
-    shift: Optional[int] = None,
-    include_prompt: bool = True,
-    generate_text=False,
-) -> torch.Tensor:
-
-    T = input_ids[0].size(1)
-    device = input_ids[0].device
-    assert max_returned_tokens > T
-    if model.max_seq_length < max_returned_tokens - 1:
-        raise NotImplementedError(
-            f"max_seq_length {model.max_seq_length} needs to be >= {max_returned_tokens - 1}"
-        )
 
+    n = max_returned_tokens - T
+    # the answer so far, one column per position (only the text row for text-only tasks), and whether
+    # the answer stopped at a position
+    history = torch.empty(8 if task.audio_out else 1, n, dtype=torch.long, device=device)
+    ended = torch.zeros(n, dtype=torch.bool, device=device)
+    text_end = torch.zeros(1, 1, dtype=torch.bool, device=device)
+    done = torch.zeros((), dtype=torch.bool, device=device)
+    # only ever goes from False to True, so reading it before the copy landed is merely late
+    done_host = torch.zeros((), dtype=torch.bool, pin_memory=device.type == "cuda")
+    inputs = DecodeInput(task, device)
     input_pos = torch.tensor([T], device=device)
-    model_input_ids = input_ids
-
-    list_output = [[] for i in range(8)]
-
-    tokens_A, token_T = next_token_batch(
-        model,
-        audio_features.to(torch.float32).to(model.device),
-        input_ids,
-        [T - 3, T - 3],
-        ["A1T2", "A1T2"],
-        input_pos=torch.arange(0, T, device=device),
-        temperature=temperature,
-        top_k=top_k,
-        top_p=top_p,
-    )
-
-    for i in range(7):
-        list_output[i].append(tokens_A[i].tolist()[0])
-    list_output[7].append(token_T.tolist()[0])
-
-    model_input_ids = [[] for i in range(8)]
-    for i in range(7):
-        tokens_A[i] = tokens_A[i].clone() + shift + i * snac_config.padded_vocab_size
-        model_input_ids[i].append(tokens_A[i].clone().to(device).to(torch.int32))
-        model_input_ids[i].append(torch.tensor([layershift(snac_config.end_of_audio, i)], device=device))
-        model_input_ids[i] = torch.stack(model_input_ids[i])
-
-    model_input_ids[-1].append(token_T.clone().to(torch.int32))
-    model_input_ids[-1].append(token_T.clone().to(torch.int32))
-    model_input_ids[-1] = torch.stack(model_input_ids[-1])
-
-    text_end = False
-
-    for _ in range(2, max_returned_tokens - T + 1):
-        tokens_A, token_T = next_token_batch(
-            model,
-            None,
-            model_input_ids,
-            None,
-            None,
-            input_pos=input_pos,
-            temperature=temperature,
-            top_k=top_k,
-            top_p=top_p,
-        )
-
-        if text_end:
-            token_T = torch.tensor([pad_id_t], device=device)
-
-        if tokens_A[-1] == eos_id_a:
-            break
-        if token_T == eos_id_t:
-            text_end = True
-
-        for i in range(7):
-            list_output[i].append(tokens_A[i].tolist()[0])
-        list_output[7].append(token_T.tolist()[0])
-
-        model_input_ids = [[] for i in range(8)]
-        for i in range(7):
-            tokens_A[i] = tokens_A[i].clone() + shift + i * snac_config.padded_vocab_size
-            model_input_ids[i].append(tokens_A[i].clone().to(device).to(torch.int32))
-            model_input_ids[i].append(
-                torch.tensor([layershift(snac_config.end_of_audio, i)], device=device)
-            )
-            model_input_ids[i] = torch.stack(model_input_ids[i])
-
-        model_input_ids[-1].append(token_T.clone().to(torch.int32))
-        model_input_ids[-1].append(token_T.clone().to(torch.int32))
-        model_input_ids[-1] = torch.stack(model_input_ids[-1])
-
-        input_pos = input_pos.add_(1)
-
-    return list_output
-
-
-@torch.inference_mode()
-def generate_TT(
-    model: GPT,
-    audio_features: torch.Tensor,
-    input_ids: list,
-    leng,
-    task,
-    max_returned_tokens: int = 2048,
-    *,
-    temperature: float = 1.0,
-    top_k: Optional[int] = None,
-    top_p: float = 1.0,
-    eos_id_a: Optional[int] = None,
-    eos_id_t: Optional[int] = None,
-    pad_id_t: Optional[int] = None,
-    shift: Optional[int] = None,
-    include_prompt: bool = True,
-    generate_text=False,
-) -> torch.Tensor:
-
-    T = input_ids[0].size(1)
-    device = input_ids[0].device
-
-    output = []
-    token_T = next_token_A1T1(
-        model,
-        None,
-        input_ids,
-        None,
-        None,
-        input_pos=torch.arange(0, T, device=device),
-        temperature=temperature,
-        top_k=top_k,
-        top_p=top_p,
-    )
-
-    output.append(token_T.clone().tolist()[0])
-    input_pos = torch.tensor([T], device=device)
-
-    for _ in tqdm(range(2, max_returned_tokens - T + 1)):
-        model_input_ids = []
-        for i in range(7):
-            model_input_ids.append(
-                torch.tensor([layershift(snac_config.end_of_audio, i)])
-                .view(1, -1)
-                .to(torch.int32)
-                .to(device)
-            )
-        model_input_ids.append(token_T.clone().view(1, -1).to(torch.int32).to(device))
-        token_T = next_token_A1T1(
-            model,
-            None,
-            model_input_ids,
-            None,
-            None,
-            input_pos=input_pos,
-            temperature=temperature,
-            top_k=top_k,
-            top_p=top_p,
-        )
-        if token_T == eos_id_t:
-            break
-        output.append(token_T.clone().tolist()[0])
-        input_pos = input_pos.add_(1)
-    return output
-
-
-@torch.inference_mode()
-def generate_AT(
-    model: GPT,
-    audio_features: torch.Tensor,
-    input_ids: list,
-    leng,
-    task,
-    max_returned_tokens: int = 2048,
-    *,
-    temperature: float = 1.0,
-    top_k: Optional[int] = None,
-    top_p: float = 1.0,
-    eos_id_a: Optional[int] = None,
-    eos_id_t: Optional[int] = None,
-    pad_id_t: Optional[int] = None,
-    shift: Optional[int] = None,
-    include_prompt: bool = True,
-    generate_text=False,
-) -> torch.Tensor:
-
-    T = input_ids[0].size(1)
-    device = input_ids[0].device
-
-    output = []
-    token_T = next_token_A1T1(
-        model,
-        audio_features.to(torch.float32).to(model.device),
-        input_ids,
-        [T - 3],
-        ["AT"],
-        input_pos=torch.arange(0, T, device=device),
-        temperature=temperature,
-        top_k=top_k,
-        top_p=top_p,
-    )
-    output.append(token_T.clone().tolist()[0])
-    input_pos = torch.tensor([T], device=device)
-    text_end = False
-    for _ in tqdm(range(2, max_returned_tokens - T + 1)):
-        model_input_ids = []
-        for i in range(7):
-            model_input_ids.append(
-                torch.tensor([layershift(snac_config.end_of_audio, i)])
-                .view(1, -1)
-                .to(torch.int32)
-                .to(device)
-            )
-        model_input_ids.append(token_T.clone().view(1, -1).to(torch.int32).to(device))
-        token_T = next_token_A1T1(
-            model,
-            None,
-            model_input_ids,
-            None,
-            None,
-            input_pos=input_pos,
-            temperature=temperature,
-            top_k=top_k,
-            top_p=top_p,
-        )
-        if token_T == eos_id_t:
-            break
-        output.append(token_T.clone().tolist()[0])
-        input_pos = input_pos.add_(1)
-    return output
-
-
-@torch.inference_mode()
-def generate_TA(
-    model: GPT,
-    audio_features: torch.Tensor,
-    input_ids: list,
-    leng,
-    task,
-    max_returned_tokens: int = 2048,
-    *,
-    temperature: float = 1.0,
-    top_k: Optional[int] = None,
-    top_p: float = 1.0,
-    eos_id_a: Optional[int] = None,
-    eos_id_t: Optional[int] = None,
-    pad_id_t: Optional[int] = None,
-    shift: Optional[int] = None,
-    include_prompt: bool = True,
-    generate_text=False,
-) -> torch.Tensor:
-
-    T = input_ids[0].size(1)
-    device = input_ids[0].device
-
-    output = [[] for _ in range(8)]
-    tokens_A, token_T = next_token_A1T2(
-        model,
-        None,
-        input_ids,
-        None,
-        None,
-        input_pos=torch.arange(0, T, device=device),
-        temperature=temperature,
-        top_k=top_k,
-        top_p=top_p,
-    )
-    for i in range(7):
-        output[i].append(tokens_A[i].clone().tolist()[0])
-    output[7].append(token_T.clone().tolist()[0])
-
-    input_pos = torch.tensor([T], device=device)
-    text_end = False
-    for _ in tqdm(range(2, max_returned_tokens - T + 1)):
-
-        model_input_ids = []
-        for i in range(7):
-            model_input_ids.append(
-                layershift(tokens_A[i].clone(), i)
-                .view(1, -1)
-                .to(torch.int32)
-                .to(device)
-            )
-        model_input_ids.append(token_T.clone().view(1, -1).to(torch.int32).to(device))
-
-        tokens_A, token_T = next_token_A1T2(
-            model,
-            None,
-            model_input_ids,
-            None,
-            None,
-            input_pos=input_pos,
-            temperature=temperature,
-            top_k=top_k,
-            top_p=top_p,
-        )
-
-        if text_end:
-            token_T = torch.tensor([pad_id_t], device=device)
-
-        if tokens_A[-1] == eos_id_a:
-            break
-
-        if token_T == eos_id_t:
-            text_end = True
-
-        for i in range(7):
-            output[i].append(tokens_A[i].clone().tolist()[0])
-        output[7].append(token_T.clone().tolist()[0])
-        input_pos = input_pos.add_(1)
-
-    return output
-
-
-@torch.inference_mode()
-def generate_AA(
-    model: GPT,
-    audio_features: torch.Tensor,
-    input_ids: list,
-    leng,
-    task,
-    max_returned_tokens: int = 2048,
-    *,
-    temperature: float = 1.0,
-    top_k: Optional[int] = None,
-    top_p: float = 1.0,
-    eos_id_a: Optional[int] = None,
-    eos_id_t: Optional[int] = None,
-    pad_id_t: Optional[int] = None,
-    shift: Optional[int] = None,
-    include_prompt: bool = True,
-    generate_text=False,
-) -> torch.Tensor:
-
-    T = input_ids[0].size(1)
-    device = input_ids[0].device
-
+    read = 0
+    for p in range(n):
+        # the prompt's own answer token is never checked
+        if p > 0:
+            token_t, stop = stop_rules(tokens_a, token_t, text_end, task.audio_out, eos_id_a, eos_id_t, pad_id_t)
+            ended[p] = stop.view(())
+            done |= ended[p]
+            done_host.copy_(done, non_blocking=True)
+        if task.audio_out:
+            history[:7, p] = tokens_a.view(7)
+        history[-1, p] = token_t.view(())
+
+        stopped = bool(done_host)
+        # queue the next step before the history is read, so the host read overlaps it
+        if p + 1 < n and not stopped:
+            if T + p + 1 > model.kv_length:
+                model.grow_kv_cache(T + p + 1)
+            tokens_a, token_t = decode_step(model, task, None, inputs.update(tokens_a, token_t), input_pos, **sampling)
+            input_pos = input_pos.add_(1)
+
+        if stopped or (p - read_offset) % read_every == 0 or p + 1 == n:
+            tokens = history[:, read : p + 1].T.tolist()
+            stops = ended[read : p + 1].tolist()
+            read = p + 1
+            for position, stop in zip(tokens, stops):
+                if stop:
+                    return
+                yield (position[:7] if task.audio_out else None), position[-1]
+
+
+def generate(model: GPT, task: str, input_ids: list, audio_features: Optional[torch.Tensor] = None,
+             max_returned_tokens: int = 2048, **kwargs: Any) -> list:
+    """The whole answer of `generate_stream`: 8 lists of tokens (7 audio layers and text) for audio tasks,
+    the list of text tokens for text-only tasks."""
+    if not DECODE_TASKS[task].audio_out:
+        return [text for _, text in generate_stream(model, task, input_ids, audio_features, max_returned_tokens, **kwargs)]
     output = [[] for _ in range(8)]
-    tokens_A, token_T = next_token_A1T2(
-        model,
-        audio_features.to(torch.float32).to(model.device),
-        input_ids,
-        [T - 3],
-        ["A1T2"],
-        input_pos=torch.arange(0, T, device=device),
-        temperature=temperature,
-        top_k=top_k,
-        top_p=top_p,
-    )
-    for i in range(7):
-        output[i].append(tokens_A[i].clone().tolist()[0])
-    output[7].append(token_T.clone().tolist()[0])
-
-    input_pos = torch.tensor([T], device=device)
-
-    text_end = False
-    for _ in tqdm(range(2, max_returned_tokens - T + 1)):
-
-        model_input_ids = []
+    for audio, text in generate_stream(model, task, input_ids, audio_features, max_returned_tokens, **kwargs):
         for i in range(7):
-            model_input_ids.append(
-                layershift(tokens_A[i].clone(), i)
-                .view(1, -1)
-                .to(torch.int32)
-                .to(device)
-            )
-        model_input_ids.append(token_T.clone().view(1, -1).to(torch.int32).to(device))
-
-        tokens_A, token_T = next_token_A1T2(
-            model,
-            None,
-            model_input_ids,
-            None,
-            None,
-            input_pos=input_pos,
-            temperature=temperature,
-            top_k=top_k,
-            top_p=top_p,
-        )
-
-        if text_end:
-            token_T = torch.tensor([pad_id_t], device=device)
-
-        if tokens_A[-1] == eos_id_a:
-            break
-        if token_T == eos_id_t:
-            # print("text_end")
-            text_end = True
-
-        for i in range(7):
-            output[i].append(tokens_A[i].clone().tolist()[0])
-        output[7].append(token_T.clone().tolist()[0])
-        input_pos = input_pos.add_(1)
-
-    return output
-
-
-@torch.inference_mode()
-def generate_ASR(
-    model: GPT,
-    audio_features: torch.Tensor,
-    input_ids: list,
-    leng,
-    task,
-    max_returned_tokens: int = 1200,
-    *,
-    temperature: float = 1.0,
-    top_k: Optional[int] = None,
-    top_p: float = 1.0,
-    eos_id_a: Optional[int] = None,
-    eos_id_t: Optional[int] = None,
-    pad_id_t: Optional[int] = None,
-    shift: Optional[int] = None,
-    include_prompt: bool = True,
-    generate_text=False,
-) -> torch.Tensor:
-
-    T = input_ids[0].size(1)
-    device = input_ids[0].device
-    output = []
-    token_T = next_token_A1T1(
-        model,
-        audio_features.to(torch.float32).to(model.device),
-        input_ids,
-        [T - 3],
-        ["asr"],
-        input_pos=torch.arange(0, T, device=device),
-        temperature=temperature,
-        top_k=top_k,
-        top_p=top_p,
-    )
-    output.append(token_T.clone().tolist()[0])
-    input_pos = torch.tensor([T], device=device)
-    text_end = False
-    for _ in tqdm(range(2, max_returned_tokens - T + 1)):
-        model_input_ids = []
-        for i in range(7):
-            model_input_ids.append(
-                torch.tensor([layershift(snac_config.end_of_audio, i)])
-                .view(1, -1)
-                .to(torch.int32)
-                .to(device)
-            )
-        model_input_ids.append(token_T.clone().view(1, -1).to(torch.int32).to(device))
-        token_T = next_token_A1T1(
-            model,
-            None,
-            model_input_ids,
-            None,
-            None,
-            input_pos=input_pos,
-            temperature=temperature,
-            top_k=top_k,
-            top_p=top_p,
-        )
-        if token_T == eos_id_t:
-            break
-        output.append(token_T.clone().tolist()[0])
-        input_pos = input_pos.add_(1)
+            output[i].append(audio[i])
+        output[7].append(text)
     return output
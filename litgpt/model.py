@@ -58,6 +58,11 @@ class GPT(nn.Module):
             )
         self.max_seq_length = self.config.block_size
         self.mask_cache: Optional[torch.Tensor] = None
+        self.kv_pool: Optional[KVPool] = None
+        self.kv_rows: Optional[slice] = None
+        self.kv_length = 0
+        # kv caches are sized in steps of this many positions
+        self.kv_chunk = 256
         if config.tie_word_embeddings:
             self.lm_head.weight = self.transformer.wte.weight
 
@@ -100,11 +105,11 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def concat_whisper_feat(self, audio_feature, input_ids, T, task):
+    def concat_whisper_feat(self, audio_feature, input_ids, T, task, offset=1):
         for j in range(len(T)):
             if task[j] != "T1T2" and task[j] != "T1A2":
                 for i in range(7):
-                    input_ids[i][j, 1 : T[j] + 1, :] = audio_feature[j][: T[j]].clone()
+                    input_ids[i][j, offset : T[j] + offset, :] = audio_feature[j][: T[j]].clone()
             else:
                 continue
         return input_ids
@@ -116,6 +121,8 @@ class GPT(nn.Module):
         input_pos: Optional[torch.Tensor] = None,
         whisper_lens: Optional[list] = None,
         task: Optional[str] = None,
+        kv_rows: Optional[slice] = None,
+        whisper_offset: int = 1,
     ) -> torch.Tensor:
 
         show = False
@@ -125,7 +132,14 @@ class GPT(nn.Module):
                 f"Cannot forward sequence of length {T}, max seq length is only {self.max_seq_length}."
             )
 
-        if input_pos is not None:  # use the kv cache
+        if input_pos is not None and input_pos.dim() == 2:
+            # per-row positions (B, T): rows of the kv cache decoded side by side at different offsets
+            if self.mask_cache is None:
+                raise TypeError("You need to call `gpt.set_kv_cache()`")
+            cos = self.cos[input_pos].unsqueeze(1)
+            sin = self.sin[input_pos].unsqueeze(1)
+            mask = self.mask_cache[0, 0][input_pos].unsqueeze(1)
+        elif input_pos is not None:  # use the kv cache
             cos = self.cos.index_select(0, input_pos)
             sin = self.sin.index_select(0, input_pos)
             if self.mask_cache is None:
@@ -153,7 +167,7 @@ class GPT(nn.Module):
 
             # concat whisper feature
             input_emb = self.concat_whisper_feat(
-                x_a, [x0, x1, x2, x3, x4, x5, x6, x7], whisper_lens, task
+                x_a, [x0, x1, x2, x3, x4, x5, x6, x7], whisper_lens, task, whisper_offset
             )
             x0, x1, x2, x3, x4, x5, x6, x7 = input_emb
 
@@ -175,7 +189,7 @@ class GPT(nn.Module):
             x = x * (self.config.n_embd**0.5)
 
         for block in self.transformer.h:
-            x = block(x, cos, sin, mask, input_pos)
+            x = block(x, cos, sin, mask, input_pos, kv_rows)
 
 
         text_vocab_size = self.config.text_vocab_size
@@ -188,7 +202,7 @@ class GPT(nn.Module):
 
         if self.config.post_adapter:
             for block in self.transformer.post_adapter:
-                x = block(x, cos, sin, mask, input_pos)
+                x = block(x, cos, sin, mask, input_pos, kv_rows)
             x = self.transformer.post_adapter_audio_ln(x)
             x = self.transformer.post_adapter_audio_lm_head(x)  # (b, t, vocab_size)
             xa = []
@@ -222,21 +236,40 @@ class GPT(nn.Module):
         rope_cache_length: Optional[int] = None,
         device: Optional[torch.device] = None,
         dtype: Optional[torch.dtype] = None,
+        length: Optional[int] = None,
     ) -> None:
+        """Lease `batch_size` rows of the model's `KVPool` to every block until `clear_kv_cache`. The rows of an
+        earlier call are released first: the model holds one lease at a time.
+
+        The rows hold `length` positions (`max_seq_length` by default), rounded up to `kv_chunk`;
+        `grow_kv_cache` makes room for more. The pool is allocated by the first call and only reallocated
+        when a lease needs more rows or positions than it has. The mask is built once.
+
+        The pool is allocated in `dtype`, by default the dtype k and v are computed in: the autocast dtype
+        when autocast is on, the weights' otherwise.
+        """
         if rope_cache_length is None:
             rope_cache_length = self.cos.size(-1)
+        if dtype is None:
+            weight = self.lm_head.weight
+            autocast = weight.is_cuda and torch.is_autocast_enabled()
+            dtype = torch.get_autocast_gpu_dtype() if autocast else weight.dtype
         max_seq_length = self.max_seq_length
-
-        # initialize the kv cache for all blocks
-        for block in self.transformer.h:
-            block.attn.kv_cache = block.attn.build_kv_cache(
-                batch_size, max_seq_length, rope_cache_length, device, dtype
-            )
-        if self.config.post_adapter:
-            for block in self.transformer.post_adapter:
-                block.attn.kv_cache = block.attn.build_kv_cache(
-                    batch_size, max_seq_length, rope_cache_length, device, dtype
-                )
+        length = self._kv_length(length or max_seq_length)
+        self.clear_kv_cache()
+
+        pool = self.kv_pool
+        if pool is None or pool.rows < batch_size:
+            if pool is not None and pool.leased is not None:
+                raise RuntimeError(f"the kv pool has rows leased, it cannot grow to {batch_size} rows")
+            rows = batch_size if pool is None else max(batch_size, pool.rows)
+            # drop the old pool before its replacement is allocated
+            self.kv_pool = pool = None
+            self.kv_pool = pool = KVPool(self._kv_blocks(), rows, length, rope_cache_length, device, dtype)
+        elif pool.length < length:
+            pool.resize(length)
+        self.kv_rows = pool.lease(batch_size)
+        self._lease(length)
 
         if self.mask_cache is None or self.mask_cache.size(3) != max_seq_length:
             # passing `attn_mask` to SDPA disables the flash implementation. since we only need the mask
@@ -244,10 +277,56 @@ class GPT(nn.Module):
             self.mask_cache = build_mask_cache(max_seq_length, device)
 
     def clear_kv_cache(self) -> None:
-        self.mask_cache = None
-        for block in self.transformer.h:
+        """Return the leased rows to the pool. The pool and the mask are kept for the next lease."""
+        if self.kv_rows is not None:
+            self.kv_pool.release(self.kv_rows)
+            self.kv_rows = None
+        self.kv_length = 0
+        for block in self._kv_blocks():
             block.attn.kv_cache = None
 
+    def grow_kv_cache(self, length: int) -> None:
+        """Make the leased rows hold at least `length` positions, keeping the ones written so far.
+
+        Within the pool's positions this only takes longer views. Past them the pool is reallocated, at
+        least doubling, so a model that keeps growing its rows copies the pool a handful of times at most.
+        """
+        if length <= self.kv_length:
+            return
+        length = self._kv_length(length)
+        if length > self.kv_pool.length:
+            self.kv_pool.resize(self._kv_length(max(length, 2 * self.kv_pool.length)))
+        self._lease(length)
+
+    def trim_kv_pool(self) -> None:
+        """Shrink the pool to the positions leased now, e.g. when a server has had no work for a while after
+        a long turn. It costs a copy of the leased positions, and growing again costs another."""
+        if self.kv_rows is not None and self.kv_pool.length > self.kv_length:
+            self.kv_pool.resize(self.kv_length)
+            self._lease(self.kv_length)
+
+    @property
+    def kv_bytes(self) -> int:
+        """Memory of the leased kv rows."""
+        if self.kv_rows is None:
+            return 0
+        rows = self.kv_rows.stop - self.kv_rows.start
+        return self.kv_pool.position_bytes * rows * self.kv_length
+
+    def _kv_length(self, length: int) -> int:
+        return min(self.max_seq_length, -(-length // self.kv_chunk) * self.kv_chunk)
+
+    def _lease(self, length: int) -> None:
+        self.kv_length = length
+        for block, cache in zip(self._kv_blocks(), self.kv_pool.caches):
+            block.attn.kv_cache = cache.rows(self.kv_rows, length)
+
+    def _kv_blocks(self) -> list:
+        blocks = list(self.transformer.h)
+        if self.config.post_adapter:
+            blocks += list(self.transformer.post_adapter)
+        return blocks
+
 
 class Block(nn.Module):
 
@@ -277,6 +356,7 @@ class Block(nn.Module):
         sin: torch.Tensor,
         mask: Optional[torch.Tensor] = None,
         input_pos: Optional[torch.Tensor] = None,
+        kv_rows: Optional[slice] = None,
     ) -> torch.Tensor:
         """
         Non-parallel residual       Parallel residual
@@ -295,7 +375,7 @@ class Block(nn.Module):
         """
 
         x_normed = self.norm_1(x)
-        attention_output = self.attn(x_normed, cos, sin, mask, input_pos)
+        attention_output = self.attn(x_normed, cos, sin, mask, input_pos, kv_rows)
 
         if self.config.parallel_residual:
             x_normed = x_normed if self.config.shared_attention_norm else self.norm_2(x)
@@ -329,6 +409,7 @@ class CausalSelfAttention(nn.Module):
         sin: torch.Tensor,
         mask: Optional[torch.Tensor] = None,
         input_pos: Optional[torch.Tensor] = None,
+        kv_rows: Optional[slice] = None,
     ) -> torch.Tensor:
         B, T, C = (
             x.size()
@@ -372,7 +453,10 @@ class CausalSelfAttention(nn.Module):
         if input_pos is not None:
             if not isinstance(self.kv_cache, KVCache):
                 raise TypeError("You need to call `gpt.set_kv_cache()`")
-            k, v = self.kv_cache(input_pos, k, v)
+            k, v = self.kv_cache(input_pos, k, v, kv_rows)
+            if mask is not None:
+                # the cache may hold fewer positions than the mask was built for
+                mask = mask[..., : k.size(2)]
 
         y = self.scaled_dot_product_attention(q, k, v, mask)
 
@@ -563,20 +647,111 @@ class KVCache(nn.Module):
         )
 
     def forward(
-        self, input_pos: torch.Tensor, k: torch.Tensor, v: torch.Tensor
+        self,
+        input_pos: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        rows: Optional[slice] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
-        # move the buffer to the activation dtype for when AMP is used
-        self.k = self.k.to(k.dtype)
-        self.v = self.v.to(v.dtype)
+        # the buffers may be views of a `KVPool`, they are never replaced. With AMP the activations can come
+        # in another dtype than the cache's: they are cast on the way in, and the cache on the way out
+        dtype = k.dtype
+        k = k.to(self.k.dtype)
+        v = v.to(self.v.dtype)
+        # `rows` selects a contiguous block of batch rows; slicing keeps a view so the update stays in place
+        cache_k = self.k if rows is None else self.k[rows]
+        cache_v = self.v if rows is None else self.v[rows]
         # update the cache
-        k = self.k.index_copy_(2, input_pos, k)
-        v = self.v.index_copy_(2, input_pos, v)
-        return k, v
+        if input_pos.dim() == 2:
+            index = input_pos[:, None, :, None]
+            k = cache_k.scatter_(2, index.expand(-1, k.size(1), -1, k.size(-1)), k)
+            v = cache_v.scatter_(2, index.expand(-1, v.size(1), -1, v.size(-1)), v)
+        else:
+            k = cache_k.index_copy_(2, input_pos, k)
+            v = cache_v.index_copy_(2, input_pos, v)
+        return k.to(dtype), v.to(dtype)
 
     def reset_parameters(self) -> None:
         torch.nn.init.zeros_(self.k)
         torch.nn.init.zeros_(self.v)
 
+    def rows(self, rows: slice, length: Optional[int] = None) -> "KVCache":
+        """A cache over `rows` (and the first `length` positions) of this one that shares its memory."""
+        cache = KVCache.__new__(KVCache)
+        nn.Module.__init__(cache)
+        cache.register_buffer("k", self.k[rows, :, :length], persistent=False)
+        cache.register_buffer("v", self.v[rows, :, :length], persistent=False)
+        return cache
+
+
+class KVPool:
+    """The kv cache memory of a model, allocated once and leased to its blocks a block of rows at a time. It is
+    only reallocated to change its number of positions, see `GPT.grow_kv_cache` and `GPT.trim_kv_pool`.
+
+    The blocks hold views of one lease only, `GPT.kv_rows`, so a lease has to be released before the next
+    one is taken; a second lease would never be read or written.
+
+    Rows are not cleared between leases. A request writes every position before the causal mask lets it
+    be read, so a reused row only needs its positions to start again from 0. The pool is zero-filled once,
+    when it is allocated, so whatever a masked position holds is finite.
+    """
+
+    def __init__(
+        self,
+        blocks: list,
+        rows: int,
+        length: int,
+        rope_cache_length: Optional[int] = None,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ) -> None:
+        self.blocks = blocks
+        self.rows = rows
+        self.length = length
+        self.rope_cache_length = rope_cache_length
+        self.caches = [
+            block.attn.build_kv_cache(rows, length, rope_cache_length, device, dtype) for block in blocks
+        ]
+        # the rows out, if any
+        self.leased: Optional[slice] = None
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.nelement() * t.element_size() for cache in self.caches for t in (cache.k, cache.v))
+
+    @property
+    def position_bytes(self) -> int:
+        """Memory of one position of one row, across all blocks."""
+        return self.nbytes // (self.rows * self.length)
+
+    def resize(self, length: int) -> None:
+        """Reallocate the pool with `length` positions per row, keeping the positions both sizes have. Views
+        handed out before (see `KVCache.rows`) still point at the old memory and have to be taken again."""
+        keep = min(length, self.length)
+        caches = []
+        for block, old in zip(self.blocks, self.caches):
+            cache = block.attn.build_kv_cache(
+                self.rows, length, self.rope_cache_length, old.k.device, old.k.dtype
+            )
+            cache.k[:, :, :keep] = old.k[:, :, :keep]
+            cache.v[:, :, :keep] = old.v[:, :, :keep]
+            caches.append(cache)
+        self.caches = caches
+        self.length = length
+
+    def lease(self, size: int) -> slice:
+        """The first `size` rows."""
+        if self.leased is not None:
+            raise RuntimeError(f"kv rows {self.leased.start}:{self.leased.stop} are leased, release them first")
+        if size > self.rows:
+            raise RuntimeError(f"no {size} kv rows, the pool has {self.rows}")
+        self.leased = slice(0, size)
+        return self.leased
+
+    def release(self, rows: slice) -> None:
+        if rows == self.leased:
+            self.leased = None
+
 
 def build_mask_cache(
     max_seq_length: int, device: Optional[torch.device] = None
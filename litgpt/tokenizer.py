@@ -2,7 +2,7 @@
 
 import json
 from pathlib import Path
-from typing import Optional, Union
+from typing import List, Optional, Union
 
 import torch
 
@@ -144,6 +144,9 @@ class Tokenizer:
             tokens = tokens[:max_length]
         return torch.tensor(tokens, dtype=torch.int, device=device)
 
-    def decode(self, tensor: torch.Tensor) -> str:
-        tokens = [tensor.item()] if tensor.ndim == 0 else tensor.tolist()
-        return self.processor.decode(tokens)
\ No newline at end of file
+    def decode(self, tensor: Union[torch.Tensor, List[int]]) -> str:
+        if isinstance(tensor, list):
+            tokens = tensor
+        else:
+            tokens = [tensor.item()] if tensor.ndim == 0 else tensor.tolist()
+        return self.processor.decode(tokens)
@@ -0,0 +1,361 @@
+import gc
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+
+import torch
+
+from inference import OmniInference
+from scheduler import DecodeScheduler, StreamRequest, SAMPLES_PER_FRAME, MAX_FRAMES, INTERACTIVE, BATCH
+from utils import metrics
+
+# how often workers send their metrics to the parent, in seconds
+METRICS_INTERVAL = 1.0
+# the gauges each worker reports, the parent's `/metrics` combines them
+WORKER_GAUGES = (metrics.KV_OCCUPANCY, metrics.KV_BYTES, metrics.KV_POOL_BYTES)
+
+
+def _worker_main(index, client, max_sessions, threads, kv_answer_budget, max_prefill_tokens, fairness_budget, inbox, outbox):
+    """Inference worker. `client` was inherited through fork, so its weights are the parent's pages."""
+    torch.set_num_threads(threads)
+    try:
+        client.warm_up()
+        scheduler = DecodeScheduler(client, max_sessions=max_sessions, max_prefill_tokens=max_prefill_tokens,
+                                    fairness_budget=fairness_budget, kv_answer_budget=kv_answer_budget)
+    except Exception:
+        outbox.put(("failed", index, traceback.format_exc()))
+        return
+    outbox.put(("ready", index, None))
+    requests = {}
+
+    # observations go to the parent in batches, with the current values of the kv cache gauges
+    observations = deque()
+    metrics.REGISTRY.forward(lambda name, value: observations.append((name, value)))
+
+    def send_metrics():
+        batch = []
+        while observations:
+            batch.append(observations.popleft())
+        outbox.put(("metrics", index, (batch, {gauge.name: gauge.value() for gauge in WORKER_GAUGES})))
+
+    def report():
+        while True:
+            time.sleep(METRICS_INTERVAL)
+            send_metrics()
+
+    threading.Thread(target=report, daemon=True).start()
+
+    def forward(req):
+        error = None
+        first = True
+        try:
+            for chunk in req:
+                if first and isinstance(chunk, bytes):
+                    # stage timings up to the first audio, for the parent's Server-Timing header
+                    outbox.put(("timing", req.id, dict(req.timing)))
+                    first = False
+                outbox.put(("chunk", req.id, chunk))
+        except Exception as e:
+            error = repr(e)
+        underruns = req.underruns
+        requests.pop(req.id, None)
+        stats = dict(
+            encode_time=scheduler.encode_time,
+            prefill_token_time=scheduler.prefill_token_time,
+            step_time=scheduler.step_time,
+            turn_time=scheduler.turn_time,
+        )
+        outbox.put(("done", req.id, (error, stats, underruns, dict(req.timing))))
+
+    def start(req):
+        requests[req.id] = req
+        threading.Thread(target=forward, args=(req,), daemon=True).start()
+
+    while True:
+        msg = inbox.get()
+        if msg is None:
+            break
+        kind, req_id, args = msg
+        try:
+            if kind == "submit":
+                start(scheduler.submit(req_id=req_id, **args))
+            elif kind == "submit_text":
+                start(scheduler.submit_text(req_id=req_id, **args))
+            elif kind == "open":
+                start(scheduler.open_stream(req_id=req_id, **args))
+            elif req_id in requests:
+                req = requests[req_id]
+                if kind == "append":
+                    scheduler.append_audio(req, args)
+                elif kind == "end":
+                    scheduler.end_audio(req)
+                elif kind == "cancel":
+                    scheduler.cancel(req)
+        except Exception as e:
+            print(f"[worker {index}] {kind} id={req_id} failed: {e}")
+            outbox.put(("done", req_id, (repr(e), None, 0, {})))
+    scheduler.close()
+    send_metrics()
+
+
+class _Worker:
+    def __init__(self, index, process, inbox, capacity):
+        self.index = index
+        self.process = process
+        self.inbox = inbox
+        self.capacity = capacity
+        self.inflight = 0
+
+
+class ReplicaPool:
+    """Forked inference workers sharing one copy of the weights.
+
+    The parent loads GPT, Whisper and SNAC once on the CPU and forks `replicas` workers. The weights are
+    only read after that, so the workers keep sharing the parent's pages copy-on-write. Each worker runs
+    its own `DecodeScheduler` with `max_sessions` rows and `threads` intra-op threads, prefilling at most
+    `max_prefill_tokens` (`fairness_budget` for batch turns) prompt tokens between steps, and each turn goes to
+    the worker with the most idle rows, waiting in the parent while every worker is full. Waiting
+    interactive turns go out before batch ones, and batch turns never take the last `reserved_slots` idle
+    rows across the pool.
+
+    The pool has the surface of `DecodeScheduler` the servers and `AdmissionController` use. Scheduler
+    metrics are recorded in the workers and sent to the parent every `METRICS_INTERVAL` seconds, which
+    exports them: kv cache bytes summed over the workers, occupancy averaged.
+
+    The workers are forked, which is only safe before the server starts its threads, so a pool cannot be
+    reloaded (see `Deployment.reloadable`).
+    """
+
+    reloadable = False
+
+    def __init__(self, ckpt_dir="./checkpoint", replicas=2, device="cpu", max_sessions=1, threads=None, reserved_slots=1,
+                 kv_answer_budget=512, max_prefill_tokens=512, fairness_budget=128):
+        if not str(device).startswith("cpu"):
+            raise ValueError("the replica pool shares host memory between forked processes, use device='cpu'")
+        self.max_sessions = replicas * max_sessions
+        self.reserved_slots = max(0, min(reserved_slots, self.max_sessions - 1))
+        threads = threads or max(1, (os.cpu_count() or replicas) // replicas)
+
+        # no model code runs in the parent before the fork, warm-up happens in each worker
+        client = OmniInference(ckpt_dir, device, kv_answer_budget=kv_answer_budget)
+        # objects alive now are never collected, so the collector does not write to the shared pages
+        gc.collect()
+        gc.freeze()
+
+        ctx = mp.get_context("fork")
+        self._outbox = ctx.Queue()
+        self._workers = []
+        for index in range(replicas):
+            inbox = ctx.Queue()
+            process = ctx.Process(
+                target=_worker_main,
+                args=(index, client, max_sessions, threads, kv_answer_budget, max_prefill_tokens, fairness_budget, inbox,
+                      self._outbox),
+                name=f"omni-worker-{index}",
+                daemon=True,
+            )
+            process.start()
+            self._workers.append(_Worker(index, process, inbox, max_sessions))
+        self._wait_ready()
+
+        # same running averages as `DecodeScheduler`, taken from the workers as turns finish
+        self.encode_time = 0.05
+        self.prefill_token_time = 0.0005
+        self.step_time = 0.03
+        self.turn_time = 10.0
+
+        self._lock = threading.Lock()
+        self._backlog = deque()
+        self._assigned = {}
+        self._requests = {}
+        self.num_cancelled = 0
+        metrics.QUEUE_DEPTH.set_function(lambda: len(self._backlog))
+        metrics.ACTIVE_SEQUENCES.set_function(lambda: len(self._assigned))
+        # last gauge values sent by each worker
+        self._gauges = [{} for _ in self._workers]
+        metrics.KV_OCCUPANCY.set_function(lambda: self._gauge(metrics.KV_OCCUPANCY) / len(self._workers))
+        metrics.KV_BYTES.set_function(lambda: self._gauge(metrics.KV_BYTES))
+        metrics.KV_POOL_BYTES.set_function(lambda: self._gauge(metrics.KV_POOL_BYTES))
+
+        self._running = True
+        self._thread = threading.Thread(target=self._read, name="replica-pool", daemon=True)
+        self._thread.start()
+
+    def _wait_ready(self):
+        ready = 0
+        while ready < len(self._workers):
+            try:
+                kind, index, detail = self._outbox.get(timeout=1.0)
+            except queue.Empty:
+                dead = [w.index for w in self._workers if not w.process.is_alive()]
+                if dead:
+                    raise RuntimeError(f"replica workers {dead} exited during start-up")
+                continue
+            if kind == "failed":
+                raise RuntimeError(f"replica worker {index} failed to start:\n{detail}")
+            print(f"[pool] worker {index} ready (pid {self._workers[index].process.pid})")
+            ready += 1
+
+    def submit(self, audio, stream_stride=4, max_returned_tokens=2048, req_id=None, text=False, priority=INTERACTIVE,
+               task="A1A2"):
+        """Queue a turn. `audio` is a file path or 16 kHz float32 samples."""
+        leng = 0
+        if not isinstance(audio, str):
+            leng = min(len(audio) // SAMPLES_PER_FRAME + 1, MAX_FRAMES)
+        req = StreamRequest(req_id or str(uuid.uuid4()), None, leng, stream_stride, max_returned_tokens, priority)
+        req.task = task
+        args = dict(
+            audio=audio, stream_stride=stream_stride, max_returned_tokens=max_returned_tokens, text=text, priority=priority,
+            task=task,
+        )
+        self._enqueue(req, ("submit", req.id, args))
+        return req
+
+    def submit_text(self, prompt, stream_stride=4, max_returned_tokens=2048, req_id=None, text=False,
+                    priority=INTERACTIVE):
+        # the prompt is tokenized in the worker, its length here only feeds the admission estimate
+        req = StreamRequest(req_id or str(uuid.uuid4()), None, len(prompt) // 4, stream_stride, max_returned_tokens,
+                            priority)
+        req.task = "T1A2"
+        args = dict(
+            prompt=prompt, stream_stride=stream_stride, max_returned_tokens=max_returned_tokens, text=text,
+            priority=priority,
+        )
+        self._enqueue(req, ("submit_text", req.id, args))
+        return req
+
+    def open_stream(self, stream_stride=4, max_returned_tokens=2048, req_id=None, chunk_seconds=1.0, text=False,
+                    priority=INTERACTIVE):
+        req = StreamRequest(req_id or str(uuid.uuid4()), None, 0, stream_stride, max_returned_tokens, priority)
+        args = dict(
+            stream_stride=stream_stride, max_returned_tokens=max_returned_tokens, chunk_seconds=chunk_seconds, text=text,
+            priority=priority,
+        )
+        self._enqueue(req, ("open", req.id, args))
+        return req
+
+    def append_audio(self, req, audio):
+        self._send(req, ("append", req.id, audio))
+
+    def end_audio(self, req):
+        self._send(req, ("end", req.id, None))
+
+    def cancel(self, req):
+        if not isinstance(req, StreamRequest):
+            req = self._requests.get(req)
+        if req is None or req.cancelled or req.done:
+            return False
+        req.cancelled = True
+        self.num_cancelled += 1
+        with self._lock:
+            queued = req in self._backlog
+            if queued:
+                self._backlog.remove(req)
+        if queued:
+            metrics.REQUESTS_CANCELLED.inc()
+            self._close(req)
+        else:
+            self._send(req, ("cancel", req.id, None))
+        return True
+
+    def close(self):
+        self._running = False
+        for worker in self._workers:
+            worker.inbox.put(None)
+        for worker in self._workers:
+            worker.process.join(timeout=10)
+        self._outbox.put(("stop", None, None))
+        self._thread.join()
+
+    @property
+    def num_active(self):
+        return len(self._assigned)
+
+    @property
+    def num_open(self):
+        """Turns submitted and not closed yet, queued ones included."""
+        return len(self._requests)
+
+    @property
+    def num_free(self):
+        return sum(w.capacity - w.inflight for w in self._workers)
+
+    def _gauge(self, gauge):
+        return sum(values.get(gauge.name, 0.0) for values in self._gauges)
+
+    def pending_prompt_lengths(self, priority=None):
+        with self._lock:
+            waiting = [req for req in self._backlog if priority is None or req.priority == priority]
+        return [2 if req.message[0] == "open" else req.leng + 3 for req in waiting]
+
+    def _enqueue(self, req, message):
+        # the message that starts the turn on a worker, and the audio that arrives before it is sent
+        req.message = message
+        req.held = []
+        self._requests[req.id] = req
+        with self._lock:
+            self._backlog.append(req)
+        self._dispatch()
+
+    def _send(self, req, message):
+        # audio of a streamed turn still waiting for a worker is held until it is dispatched
+        with self._lock:
+            worker = self._assigned.get(req.id)
+            if worker is None:
+                if req in self._backlog:
+                    req.held.append(message)
+                return
+        worker.inbox.put(message)
+
+    def _dispatch(self):
+        with self._lock:
+            while self._backlog:
+                worker = max(self._workers, key=lambda w: w.capacity - w.inflight)
+                idle = sum(w.capacity - w.inflight for w in self._workers)
+                req = next((r for r in self._backlog if r.priority == INTERACTIVE), self._backlog[0])
+                if idle <= (self.reserved_slots if req.priority == BATCH else 0):
+                    return
+                self._backlog.remove(req)
+                worker.inflight += 1
+                self._assigned[req.id] = worker
+                worker.inbox.put(req.message)
+                for message in req.held:
+                    worker.inbox.put(message)
+
+    def _read(self):
+        while self._running:
+            kind, req_id, payload = self._outbox.get()
+            req = self._requests.get(req_id)
+            if kind == "chunk" and req is not None:
+                req.put(payload)
+            elif kind == "timing" and req is not None:
+                req.timing.update(payload)
+            elif kind == "metrics":
+                observations, gauges = payload
+                for name, value in observations:
+                    metrics.REGISTRY.record(name, value)
+                self._gauges[req_id] = gauges
+            elif kind == "done":
+                error, stats, underruns, timing = payload
+                with self._lock:
+                    worker = self._assigned.pop(req_id, None)
+                    if worker is not None:
+                        worker.inflight -= 1
+                if stats:
+                    for name, value in stats.items():
+                        setattr(self, name, value)
+                if req is not None:
+                    req.underruns = underruns
+                    req.timing.update(timing)
+                    self._close(req, RuntimeError(error) if error and not req.cancelled else None)
+                self._dispatch()
+
+    def _close(self, req, error=None):
+        req.done = True
+        self._requests.pop(req.id, None)
+        req.close(error)
@@ -0,0 +1,332 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import math
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlencode
+
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect
+
+
+# response headers passed back from a node
+FORWARDED_HEADERS = (
+    'content-type', 'content-disposition', 'retry-after', 'server-timing', 'x-request-id', 'cross-origin-opener-policy',
+    'cross-origin-embedder-policy',
+)
+
+
+class HttpBackend:
+    """An `OmniChatServer` reached over plain HTTP."""
+
+    def __init__(self, base_url, timeout=5.0):
+        import httpx
+        self.name = base_url.rstrip('/')
+        self.timeout = timeout
+        self._client = httpx.AsyncClient(base_url=self.name, timeout=httpx.Timeout(timeout, read=None))
+
+    async def load(self):
+        res = await self._client.get('/load')
+        res.raise_for_status()
+        return res.json()
+
+    async def forward(self, method, path, query, headers, body):
+        """Returns (status, headers, body iterator, close coroutine function). The body is streamed."""
+        request = self._client.build_request(method, path, params=query, headers=headers, content=body)
+        res = await self._client.send(request, stream=True)
+        return res.status_code, res.headers, res.aiter_raw(), res.aclose
+
+    async def connect(self, path, query):
+        """Open a WebSocket to the node. Returns a `websockets` client connection."""
+        import websockets
+        url = 'ws' + self.name[len('http'):] + path + (f'?{urlencode(query)}' if query else '')
+        return await websockets.connect(url, open_timeout=self.timeout, max_size=None)
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+class Node:
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+        self.healthy = True
+        # false while the node drains, it finishes its streams but takes no new ones
+        self.ready = True
+        self.failures = 0
+        self.load = 0
+        self.capacity = 1
+
+    def status(self):
+        return {
+            'healthy': self.healthy, 'ready': self.ready, 'failures': self.failures, 'load': self.load,
+            'capacity': self.capacity,
+        }
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+def _utilisation(node):
+    return node.load / node.capacity
+
+
+class Router:
+    """Front door spreading voice sessions over several nodes.
+
+    A session (the `X-Session-Id` header or `?session=`) stays on the node it was first sent to while that
+    node is healthy, for `/stream/*` requests and `/ws` sockets alike. New sessions are placed by consistent
+    hashing with bounded loads: walking the ring from the session's hash, the first healthy node whose load
+    is under `load_factor` times its share of the total, by capacity, gets it. Load is the active plus queued
+    turns each node reports on `/load`, polled every `health_interval` s; `max_failures` failed polls or
+    requests in a row eject a node until a poll succeeds again. Nodes that report they are draining get no
+    new requests.
+
+    Jobs go to the least loaded node, and their status and results are fetched from the node that took
+    them, which this router remembers.
+    """
+
+    def __init__(self, backends, vnodes=64, load_factor=1.25, health_interval=2.0, max_failures=3, session_ttl=600):
+        self.nodes = [Node(backend) for backend in backends]
+        self.load_factor = load_factor
+        self.health_interval = health_interval
+        self.max_failures = max_failures
+        self.session_ttl = session_ttl
+        self._ring = sorted((_hash(f'{node.name}#{i}'), node) for node in self.nodes for i in range(vnodes))
+        self._keys = [key for key, _ in self._ring]
+        # session id -> (node, last used)
+        self._sessions = {}
+        # job id -> node
+        self._jobs = {}
+        self.app = Starlette(routes=[
+            Route('/stream/vad', self.stream_vad, methods=['POST']),
+            Route('/stream/events', self.stream_vad, methods=['POST']),
+            WebSocketRoute('/ws', self.stream_ws),
+            Route('/cancel', self.cancel, methods=['POST']),
+            Route('/jobs', self.create_job, methods=['POST']),
+            Route('/jobs/{job_id}', self.job),
+            Route('/jobs/{job_id}/results/{name}', self.job),
+            Route('/jobs/{job_id}/download', self.job),
+            Route('/health', self.health),
+            Route('/nodes', self.status),
+            Route('/', self.passthrough),
+            Route('/worklet.js', self.passthrough),
+        ], lifespan=self.lifespan)
+
+    @asynccontextmanager
+    async def lifespan(self, app):
+        task = asyncio.create_task(self._poll())
+        yield
+        task.cancel()
+        for node in self.nodes:
+            await node.backend.aclose()
+
+    def pick(self, session_id=None, exclude=()):
+        """The node for a session, or the least loaded one without a session. None if every node is down."""
+        healthy = [node for node in self.nodes if node.healthy and node.ready and node.name not in exclude]
+        if not healthy:
+            return None
+        now = time.monotonic()
+        self._sessions = {s: (n, t) for s, (n, t) in self._sessions.items() if now - t < self.session_ttl}
+        if session_id is None:
+            return min(healthy, key=_utilisation)
+        pinned = self._sessions.get(session_id)
+        if pinned is not None and pinned[0] in healthy:
+            node = pinned[0]
+        else:
+            # each node's bound is its share of the load, new session included, in proportion to its capacity
+            share = self.load_factor * (sum(node.load for node in healthy) + 1) / sum(node.capacity for node in healthy)
+            start = bisect.bisect(self._keys, _hash(session_id))
+            node = None
+            for i in range(len(self._ring)):
+                candidate = self._ring[(start + i) % len(self._ring)][1]
+                if candidate in healthy and candidate.load < math.ceil(share * candidate.capacity):
+                    node = candidate
+                    break
+            node = node or min(healthy, key=_utilisation)
+        self._sessions[session_id] = (node, now)
+        return node
+
+    async def _poll(self):
+        while True:
+            await asyncio.gather(*(self._check(node) for node in self.nodes))
+            await asyncio.sleep(self.health_interval)
+
+    async def _check(self, node):
+        try:
+            report = await node.backend.load()
+        except Exception as e:
+            self._failed(node, e)
+            return
+        if not node.healthy:
+            print(f'[router] node {node.name} is back')
+        node.healthy, node.failures = True, 0
+        node.ready = report.get('state') != 'draining'
+        node.load = report.get('active', 0) + report.get('queued', 0)
+        node.capacity = max(1, report.get('capacity', 1))
+
+    def _failed(self, node, error):
+        node.failures += 1
+        if node.healthy and node.failures >= self.max_failures:
+            node.healthy = False
+            print(f'[router] ejecting node {node.name}: {error}')
+
+    async def _send(self, request, choose, session_id=None):
+        """Send the request to the node `choose(tried names)` returns, then to the next one while nodes fail
+        before answering. Returns (node, status, headers, body iterator, close), or None when out of nodes."""
+        body = await request.body()
+        headers = {k: v for k, v in request.headers.items() if k.lower() in ('content-type', 'x-session-id')}
+        tried = set()
+        while True:
+            node = choose(tried)
+            if node is None:
+                return None
+            tried.add(node.name)
+            try:
+                status, res_headers, chunks, close = await node.backend.forward(
+                    request.method, request.url.path, dict(request.query_params), headers, body
+                )
+            except Exception as e:
+                # nothing was sent to the client yet, so the request can go to another node
+                self._failed(node, e)
+                if session_id is not None:
+                    self._sessions.pop(session_id, None)
+                continue
+            node.failures = 0
+            forwarded = {k: v for k, v in res_headers.items() if k.lower() in FORWARDED_HEADERS}
+            return node, status, forwarded, chunks, close
+
+    async def _forward(self, request, session_id):
+        sent = await self._send(request, lambda tried: self.pick(session_id, exclude=tried), session_id)
+        if sent is None:
+            return JSONResponse({'error':'no healthy node'}, status_code=503, headers={'Retry-After': '1'})
+        node, status, headers, chunks, close = sent
+        # counted until the next load report replaces it
+        node.load += 1
+        return StreamingResponse(chunks, status_code=status, headers=headers, background=BackgroundTask(close))
+
+    async def stream_vad(self, request):
+        session_id = request.headers.get('x-session-id') or request.query_params.get('session')
+        return await self._forward(request, session_id)
+
+    async def stream_ws(self, websocket):
+        """Relay a `/ws` socket to a node, both ways, until either side closes."""
+        session_id = websocket.headers.get('x-session-id') or websocket.query_params.get('session')
+        tried = set()
+        while True:
+            node = self.pick(session_id, exclude=tried)
+            if node is None:
+                # 1013: try again later
+                await websocket.close(code=1013)
+                return
+            tried.add(node.name)
+            try:
+                upstream = await node.backend.connect('/ws', dict(websocket.query_params))
+            except Exception as e:
+                self._failed(node, e)
+                if session_id is not None:
+                    self._sessions.pop(session_id, None)
+                continue
+            break
+        node.failures = 0
+        node.load += 1
+        await websocket.accept()
+
+        async def to_node():
+            while True:
+                msg = await websocket.receive()
+                if msg['type'] == 'websocket.disconnect':
+                    return
+                await upstream.send(msg['bytes'] if msg.get('bytes') is not None else msg['text'])
+
+        async def to_client():
+            async for message in upstream:
+                if isinstance(message, bytes):
+                    await websocket.send_bytes(message)
+                else:
+                    await websocket.send_text(message)
+
+        tasks = [asyncio.create_task(to_node()), asyncio.create_task(to_client())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # the node cancels the turns of a closed socket
+            await upstream.close()
+            try:
+                await websocket.close()
+            except (RuntimeError, WebSocketDisconnect):
+                # the client is gone already
+                pass
+
+    async def create_job(self, request):
+        sent = await self._send(request, lambda tried: self.pick(None, exclude=tried))
+        if sent is None:
+            return JSONResponse({'error':'no healthy node'}, status_code=503, headers={'Retry-After': '1'})
+        node, status, headers, chunks, close = sent
+        body = b''.join([chunk async for chunk in chunks])
+        await close()
+        if status == 202:
+            self._jobs[json.loads(body)['id']] = node
+        return Response(body, status_code=status, headers=headers)
+
+    async def job(self, request):
+        """Status and results of a job, from the node that runs it."""
+        node = self._jobs.get(request.path_params['job_id'])
+        if node is None:
+            return JSONResponse({'error':'unknown job'}, status_code=404)
+        sent = await self._send(request, lambda tried: node if node.healthy and node.name not in tried else None)
+        if sent is None:
+            return JSONResponse({'error':'node down'}, status_code=503, headers={'Retry-After': '5'})
+        _, status, headers, chunks, close = sent
+        return StreamingResponse(chunks, status_code=status, headers=headers, background=BackgroundTask(close))
+
+    async def passthrough(self, request):
+        return await self._forward(request, None)
+
+    async def cancel(self, request):
+        # turn ids are not tracked here, every node gets the cancel and at most one knows the turn
+        body = await request.body()
+        headers = {'content-type': 'application/json'}
+        cancelled = False
+        for node in [node for node in self.nodes if node.healthy]:
+            try:
+                status, _, chunks, close = await node.backend.forward('POST', '/cancel', {}, headers, body)
+                reply = b''.join([chunk async for chunk in chunks])
+                await close()
+                cancelled = cancelled or (status == 200 and b'true' in reply)
+            except Exception as e:
+                self._failed(node, e)
+        return JSONResponse({'cancelled': cancelled})
+
+    async def health(self, request):
+        healthy = any(node.healthy for node in self.nodes)
+        return JSONResponse({'status': 'ok' if healthy else 'down'}, status_code=200 if healthy else 503)
+
+    async def status(self, request):
+        return JSONResponse({
+            'nodes': {node.name: node.status() for node in self.nodes},
+            'sessions': len(self._sessions),
+        })
+
+
+def serve(backends='http://127.0.0.1:60808', ip='0.0.0.0', port=60800, load_factor=1.25, health_interval=2.0):
+    """`backends` is a comma separated list of node base URLs."""
+    import uvicorn
+    if isinstance(backends, str):
+        backends = backends.split(',')
+    router = Router([HttpBackend(url) for url in backends], load_factor=load_factor, health_interval=health_interval)
+    uvicorn.run(router.app, host=ip, port=port)
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(serve)
@@ -0,0 +1,896 @@
+"""Continuous-batching decode scheduler.
+
+All live conversation turns share one kv cache and are advanced together with a
+single `GPT.forward` per decode step. Each turn owns two adjacent cache rows (the
+A1A2 row that produces audio and the A1T2 row that produces text, as in
+`OmniInference.run_AT_batch_stream`). New requests are prefilled into free rows
+between steps and finished ones release their rows.
+
+Turns opened with `open_stream` are prefilled incrementally while the user is still
+speaking: arriving audio is encoded chunk by chunk and appended to the turn's rows,
+so when the utterance ends only the `_eoa`/`_answer_a` tail needs a forward pass.
+
+Turns are either interactive (someone is listening) or batch (offline rendering and
+transcription). Batch turns only get rows and prefill time interactive turns leave over.
+
+Besides spoken answers to speech (A1A2), a turn can answer a text prompt with speech
+(T1A2) or transcribe speech (A1T1), as `generate` does for a single prompt. The row pair
+is used the same way for all three, so they share decode steps.
+"""
+
+import asyncio
+import heapq
+import math
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+
+import numpy as np
+import torch
+import whisper
+
+from inference import (
+    load_audio,
+    get_input_ids_TA,
+    get_input_ids_TT,
+    get_input_ids_whisper,
+    get_input_ids_whisper_ATBatch,
+    _eoa,
+    _eot,
+    _pad_a,
+    _pad_t,
+    _input_a,
+    _input_t,
+    _answer_a,
+    _answer_t,
+    _asr,
+)
+from litgpt.generate.base import DECODE_TASKS, DecodeInput, decode_step, stop_rules
+from utils.snac_utils import layershift, get_snac, generate_audio_data
+from utils import metrics
+from utils.detokenizer import IncrementalDetokenizer
+
+
+_DONE = object()
+
+# every turn decodes on a row pair, audio on the first row and text on the second. Decode steps run all
+# pairs as A1A2_BATCH answers, transcriptions feed padding instead of their audio tokens
+_PAIR = DECODE_TASKS["A1A2_BATCH"]
+_PAIR_TASKS = {"A1A2": _PAIR, "T1A2": _PAIR, "A1T1": DECODE_TASKS["A1T1_BATCH"]}
+
+# priority classes
+INTERACTIVE = "interactive"
+BATCH = "batch"
+PRIORITIES = (INTERACTIVE, BATCH)
+
+# what a turn does: speech in and out, text in and speech out, speech in and text out
+TASKS = ("A1A2", "T1A2", "A1T1")
+
+# SNAC output: 24 kHz PCM16
+OUTPUT_BYTES_PER_SECOND = 2 * 24000
+
+# whisper works on 30 s windows at 16 kHz, one encoder frame per 320 samples (20 ms)
+SAMPLE_RATE = 16000
+SAMPLES_PER_FRAME = 320
+MAX_FRAMES = 1500
+
+
+def _ewma(average, value, alpha=0.1):
+    return (1 - alpha) * average + alpha * value
+
+
+class AudioChunker:
+    """Cuts streamed 16 kHz audio into whisper inputs for incremental prefill.
+
+    Each chunk is encoded together with all the audio before it (whisper always sees a full 30 s
+    window anyway) and only the chunk's own frames are kept, so features get left context but
+    never wait for future audio. Audio past the 30 s window is dropped, like `load_audio` does.
+    Every encode costs a full window, so the scheduler encodes chunks that queued up behind each
+    other once, with the mel of the last one.
+    """
+
+    def __init__(self, chunk_seconds=1.0):
+        self.chunk_frames = max(1, int(chunk_seconds * SAMPLE_RATE) // SAMPLES_PER_FRAME)
+        self.audio = np.zeros(0, dtype=np.float32)
+        self.frames = 0
+
+    def push(self, audio):
+        """Add float32 samples, returns the (mel, start_frame, n_frames) chunks that became complete."""
+        self.audio = np.concatenate([self.audio, audio.astype(np.float32)])[: whisper.audio.N_SAMPLES]
+        chunks = []
+        while (
+            self.frames + self.chunk_frames <= MAX_FRAMES
+            and len(self.audio) >= (self.frames + self.chunk_frames) * SAMPLES_PER_FRAME
+        ):
+            chunks.append(self._chunk(self.chunk_frames))
+        return chunks
+
+    def flush(self):
+        """Last chunk, sized so the total frame count matches `load_audio` for the same audio."""
+        total = min(int(len(self.audio) / SAMPLE_RATE * 1000 / 20) + 1, MAX_FRAMES)
+        return self._chunk(total - self.frames) if total > self.frames else None
+
+    def _chunk(self, n):
+        end = (self.frames + n) * SAMPLES_PER_FRAME
+        mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(self.audio[:end]))
+        chunk = (mel, self.frames, n)
+        self.frames += n
+        return chunk
+
+
+class StreamRequest:
+    """One conversation turn decoded by the `DecodeScheduler`.
+
+    Iterate it (or `async for` it on an event loop) to get the audio chunks as PCM16 bytes, interleaved
+    with text deltas as `str` for turns submitted with `text=True`. A1T1 turns only give text deltas. The scheduler never blocks on a slow
+    consumer, chunks are buffered here until they are read.
+    """
+
+    def __init__(self, req_id, mel, leng, stream_stride=4, max_returned_tokens=2048, priority=INTERACTIVE):
+        if priority not in PRIORITIES:
+            raise ValueError(f"priority must be one of {PRIORITIES}, got {priority}")
+        self.id = req_id
+        self.mel = mel
+        self.leng = leng
+        self.stream_stride = stream_stride
+        self.max_returned_tokens = max_returned_tokens
+        self.priority = priority
+        self.task = "A1A2"
+        # prompt of a T1A2 turn, tokenized on the caller's thread
+        self.input_ids = None
+
+        # decode state, only touched by the scheduler thread
+        self.slot = None
+        # perf_counter timestamps: submitted, input complete (time-to-first-audio starts here), rows assigned
+        self.t_submit = time.perf_counter()
+        self.t_ready = self.t_submit
+        self.t_admit = None
+        self.t_first = None
+
+        # seconds spent in each pipeline stage of this turn, reported as Server-Timing
+        self.timing = {}
+        self.steps = 0
+        self.step_total = 0.0
+        # kv cache memory of the positions the turn's row pair has written, largest and summed over its
+        # decode steps
+        self.kv_peak = 0
+        self.kv_total = 0
+
+        # playback deadline: audio sent so far against wall-clock time since the first chunk
+        self.audio_seconds = 0.0
+        self.underruns = 0
+        self.starved = False
+        self.pos = 0
+        self.list_output = [[] for _ in range(8)]
+        self.index = 1
+        self.current_index = 0
+        self.begin_generate = False
+        self.cancelled = False
+        self.done = False
+
+        # incremental prefill: whisper chunks waiting for the scheduler, `_DONE` once input has ended.
+        # Long submitted prompts are encoded once into `feature` and go in the same way. `held` is a
+        # chunk taken off the queue that has to wait for the next prefill round
+        self.chunker = None
+        self.feature = None
+        self.ingest = queue.Queue()
+        self.held = None
+        self.detokenizer = None
+
+        self._chunks = queue.Queue()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._achunks = None
+
+    def slack(self, now):
+        """Seconds of audio the client has buffered ahead of playback, taken to start with the first chunk.
+        Nobody plays batch turns back, they are never short of audio."""
+        if self.priority == BATCH:
+            return math.inf
+        if self.t_first is None:
+            return 0.0
+        return self.audio_seconds - (now - self.t_first)
+
+    def put(self, chunk):
+        with self._lock:
+            if self._loop is None:
+                self._chunks.put(chunk)
+            else:
+                self._loop.call_soon_threadsafe(self._achunks.put_nowait, chunk)
+
+    def close(self, error=None):
+        self.put(_DONE if error is None else error)
+
+    def __iter__(self):
+        while True:
+            item = self._chunks.get()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    async def __aiter__(self):
+        # hand over to an asyncio queue fed from the scheduler thread, keeping what was produced so far
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            self._achunks = asyncio.Queue()
+            while not self._chunks.empty():
+                self._achunks.put_nowait(self._chunks.get_nowait())
+        while True:
+            item = await self._achunks.get()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+class DecodeScheduler:
+    """Continuous batching of conversation turns over one shared KV cache.
+
+    Turns are ordered by playback slack. While a playing turn has less than `urgent_slack` seconds of
+    audio buffered, new prefills wait (for at most `max_prefill_delay` seconds) and turns more than
+    `max_lead` seconds ahead sit out decode steps, and SNAC decoding always goes most urgent first.
+
+    Between two decode steps at most `max_prefill_tokens` prompt tokens are prefilled, longer prompts go
+    in over several steps. Interactive turns are served first. Batch turns get what is left, no more than
+    `fairness_budget` tokens while interactive turns are live, and never the last `reserved_slots` free
+    row pairs. Having no playback deadline, batch turns also sit out steps whenever a playing turn is
+    urgent.
+
+    The kv cache starts with `kv_answer_budget` positions per row. A prefill makes room for its prompt
+    plus that budget, and the rows grow in chunks as the longest turn gets longer, within memory that
+    at least doubles whenever it runs out. Once no turn is left the rows go back to the budget, and the
+    memory is given back only after `kv_trim_after` seconds without a turn, so that bursts of traffic do
+    not pay for growing it again.
+
+    Each chunk of streamed audio is a full 30 s whisper encode, at most `max_chunk_encodes` of them run
+    between two decode steps. Chunks waiting longer are encoded together.
+    """
+
+    def __init__(self, client, max_sessions=4, temperature=0.9, top_k=1, top_p=1.0,
+                 urgent_slack=0.3, max_lead=3.0, max_prefill_delay=0.25,
+                 max_prefill_tokens=512, fairness_budget=128, reserved_slots=1, kv_answer_budget=512,
+                 kv_trim_after=300.0, max_chunk_encodes=1):
+        self.client = client
+        self.model = client.model
+        self.device = client.device
+        self.max_sessions = max_sessions
+        self.sampling = dict(temperature=temperature, top_k=top_k, top_p=top_p)
+        self.urgent_slack = urgent_slack
+        self.max_lead = max_lead
+        self.max_prefill_delay = max_prefill_delay
+        self._deferred_since = None
+        self.max_prefill_tokens = max_prefill_tokens
+        self.fairness_budget = fairness_budget
+        self.max_chunk_encodes = max_chunk_encodes
+        self._encodes_left = max_chunk_encodes
+        # batch turns can always get at least one pair of rows
+        self.reserved_slots = max(0, min(reserved_slots, max_sessions - 1))
+
+        self.kv_answer_budget = kv_answer_budget
+        with client.fabric.init_tensor():
+            self.model.set_kv_cache(batch_size=2 * max_sessions, device=self.device, length=kv_answer_budget)
+        self._kv_base = self.model.kv_length
+        self.kv_trim_after = kv_trim_after
+        self._idle_since = None
+
+        # decode state of the row pairs, kept on the device between steps: the last sampled tokens, which
+        # pairs answer with audio, whose text has ended, and the input ids the model reads
+        self._tokens_a = torch.full((7, max_sessions), _pad_a, dtype=torch.long, device=self.device)
+        self._token_t = torch.full((1, max_sessions), _pad_t, dtype=torch.long, device=self.device)
+        self._audio_out = torch.ones(1, max_sessions, dtype=torch.bool, device=self.device)
+        self._text_end = torch.zeros(1, max_sessions, dtype=torch.bool, device=self.device)
+        self._inputs = DecodeInput(_PAIR, self.device, groups=max_sessions)
+        # the positions of the rows and the pairs decoded by a step are staged on the host and copied over
+        # together. The host copy is only written again after the step's tokens are read back
+        cuda = str(self.device).startswith("cuda")
+        self._staged = torch.zeros(3 * max_sessions, dtype=torch.long, pin_memory=cuda)
+        self._staged_host = self._staged.numpy()
+        self._step_state = torch.zeros(3 * max_sessions, dtype=torch.long, device=self.device)
+
+        self._pending = {priority: queue.Queue() for priority in PRIORITIES}
+        self._cancelled = queue.Queue()
+        self._requests = {}
+        self.num_cancelled = 0
+        self._free = list(range(max_sessions))
+        self._active = {}
+        self._ingesting = {}
+        self._wakeup = threading.Event()
+
+        # running averages used for admission control, seeded with rough single-GPU figures
+        self.encode_time = 0.05
+        self.prefill_token_time = 0.0005
+        self.step_time = 0.03
+        self.turn_time = 10.0
+
+        metrics.QUEUE_DEPTH.set_function(lambda: len(self.pending_prompt_lengths()))
+        metrics.ACTIVE_SEQUENCES.set_function(lambda: len(self._active) + len(self._ingesting))
+        metrics.KV_OCCUPANCY.set_function(self.kv_occupancy)
+        metrics.KV_BYTES.set_function(lambda: self.model.kv_bytes)
+        metrics.KV_POOL_BYTES.set_function(lambda: self.model.kv_pool.nbytes)
+
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="decode-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, audio, stream_stride=4, max_returned_tokens=2048, req_id=None, text=False, priority=INTERACTIVE,
+               task="A1A2"):
+        """Queue a turn for decoding. `audio` is a file path or 16 kHz float32 samples. Audio is loaded on the
+        caller's thread, the model work happens on the scheduler. `task` is "A1A2" or "A1T1"."""
+        if task not in ("A1A2", "A1T1"):
+            raise ValueError(f"audio turns are A1A2 or A1T1, got {task}")
+        if isinstance(audio, str):
+            assert os.path.exists(audio), f"audio file {audio} not found"
+        t0 = time.perf_counter()
+        mel, leng = load_audio(audio)
+        req = StreamRequest(req_id or str(uuid.uuid4()), mel, leng, stream_stride, max_returned_tokens, priority)
+        req.timing["load_audio"] = time.perf_counter() - t0
+        req.task = task
+        return self._queue(req, text or task == "A1T1")
+
+    def submit_text(self, prompt, stream_stride=4, max_returned_tokens=2048, req_id=None, text=False,
+                    priority=INTERACTIVE):
+        """Queue a T1A2 turn answering the text `prompt` with speech."""
+        tokenizer = self.client.text_tokenizer
+        input_ids = [
+            torch.cat([ta, tt]) for ta, tt in zip(get_input_ids_TA(prompt, tokenizer), get_input_ids_TT(prompt, tokenizer))
+        ]
+        leng = input_ids[0].size(1) - 3
+        req = StreamRequest(req_id or str(uuid.uuid4()), None, leng, stream_stride, max_returned_tokens, priority)
+        req.task = "T1A2"
+        req.input_ids = input_ids
+        return self._queue(req, text)
+
+    def _queue(self, req, text):
+        if text:
+            req.detokenizer = IncrementalDetokenizer(self.client.text_tokenizer)
+        self._requests[req.id] = req
+        self._pending[req.priority].put(req)
+        self._wakeup.set()
+        return req
+
+    def open_stream(self, stream_stride=4, max_returned_tokens=2048, req_id=None, chunk_seconds=1.0, text=False,
+                    priority=INTERACTIVE):
+        """Start a turn whose audio is still arriving. Feed it with `append_audio` and close it with `end_audio`."""
+        req = StreamRequest(req_id or str(uuid.uuid4()), None, 0, stream_stride, max_returned_tokens, priority)
+        req.chunker = AudioChunker(chunk_seconds)
+        return self._queue(req, text)
+
+    def append_audio(self, req, audio):
+        """Add 16 kHz float32 samples to an open turn. The mel spectrogram is computed on the caller's thread."""
+        for chunk in req.chunker.push(audio):
+            req.ingest.put(chunk)
+        self._wakeup.set()
+
+    def end_audio(self, req):
+        req.t_ready = time.perf_counter()
+        chunk = req.chunker.flush()
+        if chunk is not None:
+            req.ingest.put(chunk)
+        req.ingest.put(_DONE)
+        self._wakeup.set()
+
+    def cancel(self, req):
+        """Stop a turn before its next decode step and free its rows. `req` is a `StreamRequest` or its id."""
+        if not isinstance(req, StreamRequest):
+            req = self._requests.get(req)
+        if req is None or req.cancelled or req.done:
+            return False
+        req.cancelled = True
+        self._cancelled.put(req)
+        self._wakeup.set()
+        return True
+
+    def close(self):
+        self._running = False
+        self._wakeup.set()
+        self._thread.join()
+        self.model.clear_kv_cache()
+
+    @property
+    def num_active(self):
+        return len(self._active)
+
+    @property
+    def num_open(self):
+        """Turns submitted and not closed yet, queued ones included."""
+        return len(self._requests)
+
+    @property
+    def num_free(self):
+        return len(self._free)
+
+    def pending_prompt_lengths(self, priority=None):
+        """Prefill lengths of the turns of one priority class (or all) waiting for rows. Streamed turns only
+        have their closing tokens left."""
+        waiting = []
+        for p in PRIORITIES if priority is None else (priority,):
+            with self._pending[p].mutex:
+                waiting += list(self._pending[p].queue)
+        return [req.leng + 3 if req.chunker is None else 2 for req in waiting if not req.cancelled]
+
+    def kv_occupancy(self):
+        """Fraction of the allocated KV cache positions written by live turns."""
+        used = sum(req.pos for req in list(self._active.values()) + list(self._ingesting.values()))
+        return used / (self.max_sessions * self.model.kv_length)
+
+    def _fit_kv(self, length):
+        """Make room for `length` positions in every row."""
+        if length > self.model.kv_length:
+            self.model.grow_kv_cache(length)
+            print(f"[kv] {self.model.kv_length} positions, {self.model.kv_bytes / 2**20:.0f} MiB")
+
+    def _trim_kv(self):
+        # rows still taking audio keep what they prefilled
+        if self._ingesting:
+            self._idle_since = None
+            return
+        now = time.perf_counter()
+        if self._idle_since is None:
+            self._idle_since = now
+        if self.model.kv_length > self._kv_base:
+            # shorter views of the same memory, nothing is copied
+            with self.client.fabric.init_tensor():
+                self.model.set_kv_cache(batch_size=2 * self.max_sessions, device=self.device, length=self._kv_base)
+        if now - self._idle_since >= self.kv_trim_after and self.model.kv_pool.length > self.model.kv_length:
+            self.model.trim_kv_pool()
+            print(f"[kv] idle for {self.kv_trim_after:.0f}s, back to {self.model.kv_length} positions, "
+                  f"{self.model.kv_pool.nbytes / 2**20:.0f} MiB")
+
+    def _sync(self):
+        if str(self.device).startswith("cuda"):
+            torch.cuda.synchronize(self.device)
+
+    @torch.inference_mode()
+    def _loop(self):
+        while self._running:
+            if not self._active and not self._prefill_ready():
+                self._trim_kv()
+                self._wakeup.wait(0.1)
+            else:
+                self._idle_since = None
+            self._wakeup.clear()
+            try:
+                self._reap()
+                if self._prefill_allowed():
+                    self._prefill_round()
+                if self._active:
+                    self._step()
+            except Exception as e:
+                print('scheduler error', e)
+                print(traceback.format_exc())
+                for slot in list(self._active) + list(self._ingesting):
+                    self._close(self._release(slot), e)
+
+    def _urgent(self, now):
+        return any(req.t_first is not None and req.slack(now) < self.urgent_slack for req in self._active.values())
+
+    def _prefill_allowed(self):
+        """Prefill stalls the decode step, so it waits while a playing turn is close to running dry."""
+        now = time.perf_counter()
+        if not self._urgent(now):
+            self._deferred_since = None
+            return True
+        if self._deferred_since is None:
+            self._deferred_since = now
+        if now - self._deferred_since >= self.max_prefill_delay:
+            self._deferred_since = None
+            return True
+        return False
+
+    def _reserve(self, priority):
+        return self.reserved_slots if priority == BATCH else 0
+
+    def _prefill_ready(self):
+        """Whether prefill work is waiting that the loop can do right away."""
+        if any(req.held is not None or not req.ingest.empty() for req in self._ingesting.values()):
+            return True
+        return any(not self._pending[p].empty() and len(self._free) > self._reserve(p) for p in PRIORITIES)
+
+    def _interactive_live(self):
+        live = list(self._active.values()) + list(self._ingesting.values())
+        return not self._pending[INTERACTIVE].empty() or any(req.priority == INTERACTIVE for req in live)
+
+    def _prefill_round(self):
+        """The prefill done between two decode steps, about `max_prefill_tokens` prompt tokens of it."""
+        budget = self.max_prefill_tokens
+        self._encodes_left = self.max_chunk_encodes
+        budget -= self._admit(INTERACTIVE, budget)
+        budget -= self._ingest(INTERACTIVE, budget)
+        if self._interactive_live():
+            budget = min(budget, self.fairness_budget)
+        budget -= self._admit(BATCH, budget)
+        self._ingest(BATCH, budget)
+
+    def _chunk_tokens(self, priority):
+        return min(self.max_prefill_tokens, self.fairness_budget) if priority == BATCH else self.max_prefill_tokens
+
+    def _reap(self):
+        while True:
+            try:
+                req = self._cancelled.get_nowait()
+            except queue.Empty:
+                return
+            if req.done:
+                continue
+            if req.slot is not None:
+                self._release(req.slot)
+            self.num_cancelled += 1
+            metrics.REQUESTS_CANCELLED.inc()
+            print(f"[cancel] id={req.id} tokens={len(req.list_output[-1])}")
+            self._close(req)
+
+    def _admit(self, priority, budget):
+        """Give free rows to waiting turns of one priority class. Returns the prompt tokens prefilled."""
+        pending = self._pending[priority]
+        spent = 0
+        while len(self._free) > self._reserve(priority) and spent < budget:
+            try:
+                req = pending.get_nowait()
+            except queue.Empty:
+                break
+            if req.cancelled:
+                continue
+            if priority == BATCH:
+                # the highest rows drop out of the decoded prefix while their turns sit out a step
+                slot = max(self._free)
+                self._free.remove(slot)
+                heapq.heapify(self._free)
+            else:
+                slot = heapq.heappop(self._free)
+            req.t_admit = time.perf_counter()
+            req.timing["queue"] = req.t_admit - req.t_submit
+            # only speech-to-speech prompts are cut into chunks
+            if req.chunker is None and (req.task != "A1A2" or req.leng + 3 <= self._chunk_tokens(priority)):
+                try:
+                    self._prefill(req, slot)
+                except Exception as e:
+                    heapq.heappush(self._free, slot)
+                    self._close(req, e)
+                    continue
+                spent += req.pos
+                continue
+            req.slot = slot
+            self._ingesting[slot] = req
+            if req.chunker is None:
+                try:
+                    self._split(req)
+                except Exception as e:
+                    self._close(self._release(slot), e)
+        return spent
+
+    def _split(self, req):
+        """Chunked prefill of a submitted turn: whisper runs once and the frames are queued like streamed audio."""
+        t0 = time.perf_counter()
+        with torch.no_grad():
+            req.feature = self.client.whispermodel.embed_audio(req.mel.unsqueeze(0).to(self.device))[0][: req.leng]
+        self._sync()
+        encode = time.perf_counter() - t0
+        metrics.WHISPER_ENCODE.observe(encode)
+        self.encode_time = _ewma(self.encode_time, encode)
+        req.timing["whisper"] = encode
+        T, size = req.feature.size(0), self._chunk_tokens(req.priority)
+        for start in range(0, T, size):
+            req.ingest.put((None, start, min(size, T - start)))
+        req.ingest.put(_DONE)
+        # counted again as the chunks go in
+        req.leng = 0
+
+    def _ingest(self, priority, budget):
+        """Feed queued chunks of ingesting turns of one priority class. Returns the prompt tokens prefilled."""
+        spent = 0
+        for slot, req in list(self._ingesting.items()):
+            if req.priority != priority:
+                continue
+            try:
+                while spent < budget:
+                    chunk = self._take_chunk(req)
+                    if chunk is None:
+                        break
+                    if chunk is _DONE:
+                        self._prefill_tail(req)
+                        spent += 2
+                        break
+                    mel, start, n = chunk
+                    if mel is not None:
+                        if self._encodes_left <= 0:
+                            req.held = chunk
+                            break
+                        # the chunks queued up behind this one are covered by one encode of the last one's window
+                        while spent + n < budget:
+                            following = self._take_chunk(req)
+                            if following is None:
+                                break
+                            if following is _DONE or following[0] is None:
+                                req.held = following
+                                break
+                            mel, n = following[0], n + following[2]
+                        self._encodes_left -= 1
+                    spent += self._prefill_chunk(req, mel, start, n)
+            except Exception as e:
+                self._close(self._release(slot), e)
+        return spent
+
+    @staticmethod
+    def _take_chunk(req):
+        """The turn's next chunk, or None when none has arrived yet."""
+        chunk, req.held = req.held, None
+        if chunk is None:
+            try:
+                chunk = req.ingest.get_nowait()
+            except queue.Empty:
+                pass
+        return chunk
+
+    def _prefill_chunk(self, req, mel, start, n):
+        """Append `n` whisper frames to the turn's rows, preceded by `_input_a` for the first chunk. `mel` is
+        None when the turn's features were encoded up front. Returns the number of positions written."""
+        if mel is None:
+            feature = req.feature[start : start + n]
+        else:
+            t0 = time.perf_counter()
+            with torch.no_grad():
+                feature = self.client.whispermodel.embed_audio(mel.unsqueeze(0).to(self.device))[0][start : start + n]
+            self._sync()
+            encode = time.perf_counter() - t0
+            metrics.WHISPER_ENCODE.observe(encode)
+            req.timing["whisper"] = req.timing.get("whisper", 0.0) + encode
+        t0 = time.perf_counter()
+        first = req.pos == 0
+        head_a = [[layershift(_input_a, i)] if first else [] for i in range(7)]
+        head_t = [_input_t] if first else []
+        ids = [head_a[i] + [layershift(_pad_a, i)] * n for i in range(7)] + [head_t + [_pad_t] * n]
+        L = n + first
+        self._fit_kv(req.pos + L)
+        ids = torch.tensor(ids, dtype=torch.int32, device=self.device).view(8, 1, L).expand(8, 2, L)
+        self.model(
+            feature.to(torch.float32).unsqueeze(0).expand(2, -1, -1),
+            list(ids),
+            torch.arange(req.pos, req.pos + L, device=self.device),
+            whisper_lens=[n, n],
+            task=["A1T2", "A1T2"],
+            kv_rows=slice(2 * req.slot, 2 * req.slot + 2),
+            whisper_offset=1 if first else 0,
+        )
+        self._sync()
+        req.timing["prefill"] = req.timing.get("prefill", 0.0) + time.perf_counter() - t0
+        req.pos += L
+        req.leng += n
+        return L
+
+    def _prefill_tail(self, req):
+        """Close the prompt with `_eoa` and the answer tokens, then move the turn to decoding."""
+        T = req.pos + 2
+        self._check_length(req, T)
+        self._fit_kv(T + self.kv_answer_budget)
+        t0 = time.perf_counter()
+        input_ids = [
+            torch.tensor(
+                [[layershift(_eoa, i), layershift(_answer_a, i)], [layershift(_eoa, i), layershift(_pad_a, i)]],
+                device=self.device,
+            )
+            for i in range(7)
+        ] + [torch.tensor([[_eot, _answer_t], [_eot, _answer_t]], device=self.device)]
+        tokens_A, token_T = decode_step(
+            self.model,
+            _PAIR,
+            None,
+            input_ids,
+            torch.arange(req.pos, T, device=self.device),
+            kv_rows=slice(2 * req.slot, 2 * req.slot + 2),
+            **self.sampling,
+        )
+        del self._ingesting[req.slot]
+        req.feature = None
+        req.pos = T
+        self._start(req, req.slot, tokens_A, token_T)
+        req.timing["prefill"] = req.timing.get("prefill", 0.0) + time.perf_counter() - t0
+
+    def _prefill(self, req, slot):
+        model = self.model
+        t0 = time.perf_counter()
+        if req.task == "T1A2":
+            audio_feature, input_ids = None, req.input_ids
+        elif req.task == "A1T1":
+            audio_feature, input_ids = get_input_ids_whisper(
+                req.mel, req.leng, self.client.whispermodel, self.device, special_token_a=_pad_a, special_token_t=_asr
+            )
+            audio_feature = audio_feature.expand(2, -1, -1)
+            input_ids = [ids.expand(2, -1) for ids in input_ids]
+        else:
+            audio_feature, input_ids = get_input_ids_whisper_ATBatch(
+                req.mel, req.leng, self.client.whispermodel, self.device
+            )
+        input_ids = [ids.to(self.device) for ids in input_ids]
+        T = input_ids[0].size(1)
+        self._check_length(req, T)
+        self._fit_kv(T + self.kv_answer_budget)
+        self._sync()
+        t1 = time.perf_counter()
+        if audio_feature is not None:
+            metrics.WHISPER_ENCODE.observe(t1 - t0)
+            self.encode_time = _ewma(self.encode_time, t1 - t0)
+            req.timing["whisper"] = t1 - t0
+            audio_feature = audio_feature.to(torch.float32).to(model.device)
+
+        tokens_A, token_T = decode_step(
+            model,
+            _PAIR_TASKS[req.task],
+            audio_feature,
+            input_ids,
+            torch.arange(0, T, device=self.device),
+            None if audio_feature is None else [T - 3, T - 3],
+            kv_rows=slice(2 * slot, 2 * slot + 2),
+            **self.sampling,
+        )
+        req.pos = T
+        self._start(req, slot, tokens_A, token_T)
+        req.timing["prefill"] = time.perf_counter() - t1
+        self.prefill_token_time = _ewma(self.prefill_token_time, req.timing["prefill"] / T)
+
+    def _start(self, req, slot, tokens_A, token_T):
+        """Move a prefilled turn to decoding, with the answer tokens its prompt sampled."""
+        self._tokens_a[:, slot] = _pad_a if tokens_A is None else tokens_A.view(7)
+        self._token_t[:, slot] = token_T.view(1)
+        self._audio_out[:, slot] = req.task != "A1T1"
+        self._text_end[:, slot] = False
+        req.slot = slot
+        self._active[slot] = req
+        tokens = torch.cat([self._tokens_a[:, slot], self._token_t[:, slot]]).tolist()
+        self._record(req, tokens[:7], tokens[7])
+
+    def _check_length(self, req, T):
+        if req.max_returned_tokens <= T:
+            raise ValueError(f"max_returned_tokens {req.max_returned_tokens} should be greater than audio length {T}")
+        if self.model.max_seq_length < req.max_returned_tokens - 1:
+            raise NotImplementedError(
+                f"max_seq_length {self.model.max_seq_length} needs to be >= {req.max_returned_tokens - 1}"
+            )
+
+    def _step(self):
+        t0 = time.perf_counter()
+        # most urgent first. When a playing turn is about to run dry, turns far ahead of playback sit out
+        order = sorted(self._active, key=lambda slot: self._active[slot].slack(t0))
+        if self._urgent(t0):
+            order = [slot for slot in order if self._active[slot].slack(t0) <= self.max_lead]
+        slots = sorted(order)
+        n = 2 * (slots[-1] + 1)
+        parked = dict(self._ingesting)
+        parked.update((slot, req) for slot, req in self._active.items() if slot not in order)
+
+        # every pair inside the decoded prefix goes through the step and only the ones in `order` keep their
+        # tokens. Free rows write at position 0, rows still ingesting audio or sitting out at their next
+        # position, which is overwritten when they move on
+        m, g = self.max_sessions, n // 2
+        staged = self._staged_host
+        staged[:] = 0
+        for slot, req in parked.items():
+            staged[2 * slot : 2 * slot + 2] = req.pos
+        for slot in slots:
+            staged[2 * slot : 2 * slot + 2] = self._active[slot].pos
+            staged[2 * m + slot] = 1
+        self._fit_kv(int(staged[:n].max()) + 1)
+        self._step_state.copy_(self._staged, non_blocking=True)
+        input_pos = self._step_state[:n].view(n, 1)
+        live = self._step_state[2 * m : 2 * m + g].view(1, g) != 0
+
+        layers = self._inputs.update(self._tokens_a, self._token_t)
+        tokens_a, token_t = decode_step(
+            self.model, _PAIR, None, [layer[:n] for layer in layers], input_pos, kv_rows=slice(0, n), **self.sampling
+        )
+        audio_out = self._audio_out[:, :g]
+        token_t, ended = stop_rules(
+            tokens_a, token_t, self._text_end[:, :g], audio_out, _eoa, _eot, _pad_t, live=live
+        )
+        tokens_a = tokens_a.masked_fill(~audio_out, _pad_a)
+        self._tokens_a[:, :g] = torch.where(live, tokens_a, self._tokens_a[:, :g])
+        self._token_t[:, :g] = torch.where(live, token_t, self._token_t[:, :g])
+        # the one read of the step: its tokens and which answers ended. Unlike `generate_stream` it is not
+        # deferred, the host needs them every step to cut audio chunks, order turns by slack and free the rows
+        # of ended answers before the next step is packed
+        tokens = torch.cat([self._tokens_a[:, :g], self._token_t[:, :g], ended.long()]).tolist()
+        dt = time.perf_counter() - t0
+        metrics.STEP_LATENCY.observe(dt)
+
+        # a turn's kv memory is the positions its row pair has written, prompt and answer
+        position_bytes = 2 * self.model.kv_pool.position_bytes
+        for slot in order:
+            req = self._active[slot]
+            req.steps += 1
+            req.step_total += dt
+            turn_bytes = (req.pos + 1) * position_bytes
+            req.kv_peak = max(req.kv_peak, turn_bytes)
+            req.kv_total += turn_bytes
+            if req.steps == 1:
+                req.timing["first_step"] = dt
+            self._advance(req, [tokens[i][slot] for i in range(7)], tokens[7][slot], tokens[8][slot])
+        self.step_time = _ewma(self.step_time, time.perf_counter() - t0)
+
+    def _advance(self, req, tokens_A, token_T, ended):
+        """Take a decode step's tokens of a turn, stopped by the rules of `stop_rules`."""
+        if ended:
+            self._finish(req)
+            return
+
+        self._record(req, tokens_A, token_T)
+        if req.task == "A1T1":
+            req.pos += 1
+            if req.pos >= req.max_returned_tokens - 1:
+                self._finish(req)
+            return
+
+        if req.index == 7:
+            req.begin_generate = True
+
+        if req.begin_generate:
+            req.current_index += 1
+            if req.current_index == req.stream_stride:
+                req.current_index = 0
+                snac = get_snac(req.list_output, req.index, req.stream_stride)
+                t0 = time.perf_counter()
+                audio = generate_audio_data(snac, self.client.snacmodel, self.device)
+                now = time.perf_counter()
+                metrics.SNAC_DECODE.observe(now - t0)
+                if req.t_first is None:
+                    req.t_first = now
+                    req.timing["first_snac"] = now - t0
+                    req.timing["ttfa"] = now - req.t_ready
+                    if req.priority == INTERACTIVE:
+                        metrics.TTFA.observe(now - req.t_ready)
+                elif req.slack(now) < 0:
+                    # the client has played everything it had before this chunk arrived
+                    if not req.starved:
+                        req.underruns += 1
+                        metrics.UNDERRUNS.inc()
+                    req.starved = True
+                else:
+                    req.starved = False
+                req.audio_seconds += len(audio) / OUTPUT_BYTES_PER_SECOND
+                req.put(audio)
+
+        req.pos += 1
+        req.index += 1
+        if req.pos >= req.max_returned_tokens - 1:
+            self._finish(req)
+
+    def _record(self, req, tokens_A, token_T):
+        for i in range(7):
+            req.list_output[i].append(tokens_A[i])
+        req.list_output[7].append(token_T)
+        metrics.TOKENS_GENERATED.inc()
+        if req.detokenizer is not None and token_T < _eot:
+            delta = req.detokenizer.add(token_T)
+            if delta:
+                req.put(delta)
+
+    def _release(self, slot):
+        req = self._active.pop(slot, None) or self._ingesting.pop(slot)
+        heapq.heappush(self._free, slot)
+        return req
+
+    def _finish(self, req):
+        self._release(req.slot)
+        if req.steps:
+            req.timing["step_avg"] = req.step_total / req.steps
+            metrics.KV_SESSION_PEAK.observe(req.kv_peak)
+            metrics.KV_SESSION_AVERAGE.observe(req.kv_total / req.steps)
+        self.turn_time = _ewma(self.turn_time, time.perf_counter() - req.t_admit)
+        if req.detokenizer is not None:
+            rest = req.detokenizer.flush()
+            if rest:
+                req.put(rest)
+        text = self.client.text_tokenizer.decode(torch.tensor(req.list_output[-1]))
+        kv = f"kv_peak={req.kv_peak / 2**20:.1f}MiB kv_avg={req.kv_total / max(1, req.steps) / 2**20:.1f}MiB"
+        print(f"[done] id={req.id} underruns={req.underruns} {kv} text output: {text}")
+        self._close(req)
+
+    def _close(self, req, error=None):
+        req.done = True
+        metrics.REQUEST_DURATION.observe(time.perf_counter() - req.t_submit)
+        self._requests.pop(req.id, None)
+        req.close(error)
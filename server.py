@@ -1,77 +1,760 @@
-import sys, os, base64, tempfile, traceback, struct, time, uuid
-from flask import Flask, Response, stream_with_context, render_template_string, jsonify, request
+import sys, os, base64, traceback, struct, time, uuid, json, asyncio
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from flask import Flask, Response, stream_with_context, render_template_string, jsonify, request, send_file
+from starlette.applications import Starlette
+from starlette.responses import FileResponse, HTMLResponse, JSONResponse, StreamingResponse
+from starlette.responses import Response as StarletteResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect
 from inference import OmniInference
+from scheduler import DecodeScheduler, INTERACTIVE, PRIORITIES
+from pool import ReplicaPool
+from admission import AdmissionController
+from jobs import JobManager
+from deploy import Deployment, Draining
+from utils.vad import StreamingEndpointer, VadOptions
+from utils import metrics
+from utils.opus import OggOpusEncoder
+from utils.audio_decode import decode_audio, pcm16_to_float
 
-REALTIME_HTML = r'''<!DOCTYPE html><html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1"><title>Mini-Omni Realtime</title><style>body{font-family:system-ui,Arial,sans-serif;background:#0f172a;color:#e2e8f0;margin:0;padding:24px} .card{max-width:1100px;margin:0 auto;background:#111827;border:1px solid #1f2937;border-radius:16px;padding:24px} h1{margin:0 0 12px} .grid{display:grid;grid-template-columns:1fr 320px;gap:16px} .btn{padding:10px 16px;border:none;border-radius:9999px;color:#fff;background:#2563eb;cursor:pointer} .status{padding:8px 10px;border-radius:10px;margin:10px 0;background:#064e3b;border:1px solid #10b981} audio{width:100%;margin-top:10px} .panel{background:#0b1220;border-radius:10px;padding:12px} .row{display:flex;gap:8px;align-items:center} .bar{height:8px;background:#1f2937;border-radius:8px;overflow:hidden} .bar>span{display:block;height:100%;background:#22c55e;width:0%} label{font-size:12px;color:#93a3af}</style></head><body><div class="card"><h1>🎙️ Mini-Omni Realtime</h1><div class="grid"><div><div id="status" class="status">Mic off</div><div class="row"><button id="toggle" class="btn">Enable Mic</button><button id="force" class="btn" style="background:#7c3aed">Force Send</button></div><div class="panel" style="margin-top:10px"><div class="row" style="justify-content:space-between"><label>VAD sensitivity</label><input id="sens" type="range" min="2000" max="20000" step="500" value="5000"/><span id="sensVal">5000</span></div><div class="row" style="justify-content:space-between"><label>Silence hangover (frames)</label><input id="hang" type="range" min="3" max="25" step="1" value="10"/><span id="hangVal">10</span></div><div class="row" style="gap:12px"><label>Energy</label><div class="bar" style="flex:1"><span id="energy"></span></div><span id="state">silence</span></div></div><audio id="player" controls></audio></div><div class="panel"><div style="font-weight:700;margin-bottom:6px">Logs</div><pre id="log" style="white-space:pre-wrap;max-height:420px;overflow:auto"></pre></div></div></div><script type="module">const statusEl=document.getElementById('status');const btn=document.getElementById('toggle');const player=document.getElementById('player');const log=document.getElementById('log');const forceBtn=document.getElementById('force');const energyBar=document.getElementById('energy');const stateEl=document.getElementById('state');const sens=document.getElementById('sens');const sensVal=document.getElementById('sensVal');const hang=document.getElementById('hang');const hangVal=document.getElementById('hangVal');let mediaStream, audioCtx, source, workletNode;function ts(){return new Date().toISOString().split('T')[1].replace('Z','');}function logln(t){log.textContent += `[${ts()}] ${t}\n`;log.scrollTop=log.scrollHeight;}sens.addEventListener('input',()=>{sensVal.textContent=sens.value; if(workletNode) workletNode.port.postMessage({cmd:'cfg', sens:+sens.value});});hang.addEventListener('input',()=>{hangVal.textContent=hang.value; if(workletNode) workletNode.port.postMessage({cmd:'cfg', hang:+hang.value});});async function start(){try{ audioCtx=new (window.AudioContext||window.webkitAudioContext)({sampleRate:16000}); await audioCtx.audioWorklet.addModule('/worklet.js'); mediaStream=await navigator.mediaDevices.getUserMedia({audio:{channelCount:1,sampleRate:16000}}); source=audioCtx.createMediaStreamSource(mediaStream); workletNode=new AudioWorkletNode(audioCtx,'pcm-capture'); source.connect(workletNode); workletNode.connect(audioCtx.destination); workletNode.port.postMessage({cmd:'cfg', sens:+sens.value, hang:+hang.value}); workletNode.port.onmessage = async (ev)=>{ const m=ev.data; if(!m) return; if(m.type==='meter'){ const pct=Math.min(100, Math.round(m.energy/30000*100)); energyBar.style.width=pct+'%'; stateEl.textContent=m.state; } else if(m.type==='emit'){ const reqId=crypto.randomUUID(); logln(`VAD emit → uploading segment id=${reqId} frames=${m.size}`); workletNode.port.postMessage({cmd:'pop', id:reqId}); } else if(m.type==='frames'){ const reqId=m.id||'noid'; const frames = new Int16Array(m.data); const bytes=frames.length*2; logln(`upload id=${reqId} bytes=${bytes}`); const b64 = base64FromInt16(frames); const t0=performance.now(); const res = await fetch('/stream/vad',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({pcm16:b64, id:reqId})}); if(!res.ok){ logln(`server ${reqId} HTTP ${res.status}`); return;} const blob = await res.blob(); logln(`server ${reqId} responded in ${Math.round(performance.now()-t0)} ms, size=${blob.size}`); player.src=URL.createObjectURL(blob); await player.play().catch(()=>{}); logln(`play ${reqId} start`); } }; statusEl.textContent='Mic on (realtime VAD)'; btn.textContent='Disable Mic'; logln('mic enabled'); }catch(e){ logln('start error: '+e.message);} } async function stop(){ try{ if(workletNode){workletNode.disconnect(); workletNode=null;} if(source){source.disconnect(); source=null;} if(mediaStream){mediaStream.getTracks().forEach(t=>t.stop()); mediaStream=null;} if(audioCtx){await audioCtx.close(); audioCtx=null;} statusEl.textContent='Mic off'; btn.textContent='Enable Mic'; logln('mic disabled'); }catch(e){ logln('stop error: '+e.message);} } function base64FromInt16(int16){ const bytes = new Uint8Array(int16.buffer, int16.byteOffset, int16.byteLength); let binary=''; const step=0x8000; for(let i=0;i<bytes.length;i+=step){ binary+=String.fromCharCode.apply(null, bytes.subarray(i,i+step)); } return btoa(binary);} btn.addEventListener('click', async()=>{ if(!audioCtx){ await start(); } else { await stop(); } }); forceBtn.addEventListener('click',()=>{ if(workletNode) workletNode.port.postMessage({cmd:'force'}); });</script></body></html>'''
+REALTIME_HTML = r'''<!DOCTYPE html><html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1"><title>Mini-Omni Realtime</title><style>body{font-family:system-ui,Arial,sans-serif;background:#0f172a;color:#e2e8f0;margin:0;padding:24px} .card{max-width:1100px;margin:0 auto;background:#111827;border:1px solid #1f2937;border-radius:16px;padding:24px} h1{margin:0 0 12px} .grid{display:grid;grid-template-columns:1fr 320px;gap:16px} .btn{padding:10px 16px;border:none;border-radius:9999px;color:#fff;background:#2563eb;cursor:pointer} .status{padding:8px 10px;border-radius:10px;margin:10px 0;background:#064e3b;border:1px solid #10b981} audio{width:100%;margin-top:10px} .panel{background:#0b1220;border-radius:10px;padding:12px} .row{display:flex;gap:8px;align-items:center} .bar{height:8px;background:#1f2937;border-radius:8px;overflow:hidden} .bar>span{display:block;height:100%;background:#22c55e;width:0%} label{font-size:12px;color:#93a3af}</style></head><body><div class="card"><h1>🎙️ Mini-Omni Realtime</h1><div class="grid"><div><div id="status" class="status">Mic off</div><div class="row"><button id="toggle" class="btn">Enable Mic</button><button id="force" class="btn" style="background:#7c3aed">Force Send</button></div><div class="panel" style="margin-top:10px"><div class="row" style="justify-content:space-between"><label>VAD sensitivity</label><input id="sens" type="range" min="2000" max="20000" step="500" value="5000"/><span id="sensVal">5000</span></div><div class="row" style="justify-content:space-between"><label>Silence hangover (frames)</label><input id="hang" type="range" min="3" max="25" step="1" value="10"/><span id="hangVal">10</span></div><div class="row" style="gap:12px"><label>Energy</label><div class="bar" style="flex:1"><span id="energy"></span></div><span id="state">silence</span></div></div><div class="row" style="gap:12px;margin-top:10px"><label>Playback buffer</label><div class="bar" style="flex:1"><span id="buffered"></span></div></div></div><div class="panel"><div style="font-weight:700;margin-bottom:6px">Logs</div><pre id="log" style="white-space:pre-wrap;max-height:420px;overflow:auto"></pre></div></div></div><script type="module">const statusEl=document.getElementById('status');const btn=document.getElementById('toggle');const bufferedBar=document.getElementById('buffered');const log=document.getElementById('log');const forceBtn=document.getElementById('force');const energyBar=document.getElementById('energy');const stateEl=document.getElementById('state');const sens=document.getElementById('sens');const sensVal=document.getElementById('sensVal');const hang=document.getElementById('hang');const hangVal=document.getElementById('hangVal');let mediaStream, audioCtx, source, workletNode, playCtx, playerNode, inflight=null, shared=null, readPos=0;const RING=16000*10;function ts(){return new Date().toISOString().split('T')[1].replace('Z','');}function logln(t){log.textContent += `[${ts()}] ${t}\n`;log.scrollTop=log.scrollHeight;}sens.addEventListener('input',()=>{sensVal.textContent=sens.value; if(workletNode) workletNode.port.postMessage({cmd:'cfg', sens:+sens.value});});hang.addEventListener('input',()=>{hangVal.textContent=hang.value; if(workletNode) workletNode.port.postMessage({cmd:'cfg', hang:+hang.value});});async function start(){try{audioCtx=new (window.AudioContext||window.webkitAudioContext)({sampleRate:16000});await audioCtx.audioWorklet.addModule('/worklet.js');mediaStream=await navigator.mediaDevices.getUserMedia({audio:{channelCount:1,sampleRate:16000}});source=audioCtx.createMediaStreamSource(mediaStream);shared=(window.crossOriginIsolated&&typeof SharedArrayBuffer!=='undefined')?new SharedArrayBuffer(16+RING*2):null; readPos=0;workletNode=new AudioWorkletNode(audioCtx,'pcm-capture',{processorOptions:{sab:shared, size:RING}});source.connect(workletNode); workletNode.connect(audioCtx.destination);workletNode.port.postMessage({cmd:'cfg', sens:+sens.value, hang:+hang.value});playCtx=new (window.AudioContext||window.webkitAudioContext)({sampleRate:24000});await playCtx.audioWorklet.addModule('/worklet.js');playerNode=new AudioWorkletNode(playCtx,'pcm-player',{outputChannelCount:[1]});playerNode.connect(playCtx.destination);playerNode.port.onmessage=(ev)=>{ const m=ev.data; if(!m) return; if(m.type==='level'){ bufferedBar.style.width=Math.min(100, Math.round(m.buffered/24000*100))+'%'; } else if(m.type==='underrun'){ logln('playback underrun, rebuffering'); } };await playCtx.resume();workletNode.port.onmessage = (ev)=>{ const m=ev.data; if(!m) return;if(m.type==='meter'){ const pct=Math.min(100, Math.round(m.energy/30000*100)); energyBar.style.width=pct+'%'; stateEl.textContent=m.state; }else if(m.type==='emit'){ const reqId=crypto.randomUUID(); logln(`VAD emit → uploading segment id=${reqId} frames=${m.size}`); if(playerNode) playerNode.port.postMessage({cmd:'clear'}); if(shared){ upload(reqId, readShared(m.end)); } else { workletNode.port.postMessage({cmd:'pop', id:reqId}); } }else if(m.type==='frames'){ upload(m.id||'noid', new Int16Array(m.data)); } };statusEl.textContent='Mic on (realtime VAD)'; btn.textContent='Disable Mic'; logln(`mic enabled (${shared?'shared ring':'transferred buffers'})`);}catch(e){ logln('start error: '+e.message);} }function readShared(end){ const ring=new Int16Array(shared,16); const cap=ring.length; const n=Math.max(0, Math.min(end-readPos, cap-4096)); const first=(end-n)%cap; const k=Math.min(n, cap-first); const out=new Int16Array(n); out.set(ring.subarray(first, first+k)); if(n>k) out.set(ring.subarray(0, n-k), k); readPos=end; return out; }async function upload(reqId, frames){logln(`upload id=${reqId} bytes=${frames.byteLength}`);if(inflight){ inflight.abort(); logln('barge-in: cancelling previous answer'); }const ctl=new AbortController(); inflight=ctl; const t0=performance.now(); let total=0;try{ const res = await fetch('/stream/vad?id='+encodeURIComponent(reqId),{method:'POST',headers:{'Content-Type':'audio/L16; rate=16000'},body:frames,signal:ctl.signal});if(!res.ok){ logln(`server ${reqId} HTTP ${res.status}`); return;}const reader=res.body.getReader(); let header=44, carry=null;while(true){ const {done, value}=await reader.read(); if(done) break; let bytes=value;if(header>0){ const skip=Math.min(header, bytes.length); header-=skip; bytes=bytes.subarray(skip);}if(carry){ const joined=new Uint8Array(carry.length+bytes.length); joined.set(carry); joined.set(bytes, carry.length); bytes=joined; carry=null;}if(bytes.length%2){ carry=bytes.slice(bytes.length-1); bytes=bytes.subarray(0, bytes.length-1);}if(!bytes.length) continue;if(total===0) logln(`first audio ${reqId} after ${Math.round(performance.now()-t0)} ms`);total+=bytes.length; const pcm=new Int16Array(bytes.slice().buffer); playerNode.port.postMessage({cmd:'push', data:pcm}, [pcm.buffer]); }playerNode.port.postMessage({cmd:'end'});}catch(e){ if(e.name==='AbortError'){ logln(`cancelled ${reqId}`); return;} logln(`upload ${reqId} failed: ${e.message}`); return; }finally{ if(inflight===ctl) inflight=null; }logln(`server ${reqId} done in ${Math.round(performance.now()-t0)} ms, bytes=${total}`); }async function stop(){ try{ if(workletNode){workletNode.disconnect(); workletNode=null;} if(source){source.disconnect(); source=null;} if(mediaStream){mediaStream.getTracks().forEach(t=>t.stop()); mediaStream=null;} if(audioCtx){await audioCtx.close(); audioCtx=null;} if(playCtx){await playCtx.close(); playCtx=null; playerNode=null;} shared=null; statusEl.textContent='Mic off'; btn.textContent='Enable Mic'; logln('mic disabled'); }catch(e){ logln('stop error: '+e.message);} }btn.addEventListener('click', async()=>{ if(!audioCtx){ await start(); } else { await stop(); } });forceBtn.addEventListener('click',()=>{ if(!workletNode) return; if(shared){ upload(crypto.randomUUID(), readShared(Atomics.load(new Int32Array(shared,0,4),0))); } else { workletNode.port.postMessage({cmd:'force'}); } });</script></body></html>'''
 
-WORKLET_JS = r'''class RingQ{constructor(cap){this.buf=new Int16Array(cap);this.head=0;this.tail=0;this.size=0;}push(arr){for(let i=0;i<arr.length;i++){this.buf[this.head]=arr[i];this.head=(this.head+1)%this.buf.length;if(this.size<this.buf.length){this.size++;}else{this.tail=(this.tail+1)%this.buf.length;}}}popAll(){const out=new Int16Array(this.size);for(let i=0;i<this.size;i++){out[i]=this.buf[(this.tail+i)%this.buf.length];}this.head=0;this.tail=0;const s=this.size;this.size=0;return out;}}class PcmProcessor extends AudioWorkletProcessor{constructor(){super();this.ring=new RingQ(16000*10);this.state='silence';this.hang=10;this.sens=5000;this.tmp=null;this.frameCount=0;this.port.onmessage=(ev)=>{const m=ev.data;if(!m)return;if(m.cmd==='cfg'){if(m.sens) this.sens=m.sens;if(m.hang) this.hang=m.hang;}else if(m.cmd==='pop'){const frames=this.ring.popAll();this.port.postMessage({type:'frames',data:frames,id:m.id});}else if(m.cmd==='force'){const frames=this.ring.popAll();this.port.postMessage({type:'frames',data:frames,id:(Math.random()+'')});}};}process(inputs){const input=inputs[0];if(!input||!input[0]) return true;const f32=input[0];if(!this.tmp||this.tmp.length!==f32.length){this.tmp=new Int16Array(f32.length);}let energy=0;for(let i=0;i<f32.length;i++){const s=Math.max(-1,Math.min(1,f32[i]));const q=(s<0?s*0x8000:s*0x7FFF)|0;this.tmp[i]=q;energy+=q*q;}energy/=this.tmp.length;const talking=energy>this.sens;if(talking){this.state='speech';this.sil=0;}else{this.sil=(this.sil||0)+1;if(this.state==='speech'&&this.sil>=this.hang){this.port.postMessage({type:'emit',size:this.ring.size});this.state='silence';this.sil=0;}}this.ring.push(this.tmp);this.port.postMessage({type:'meter',energy, state:this.state});return true;}}registerProcessor('pcm-capture',PcmProcessor);'''
+WORKLET_JS = r'''class PcmProcessor extends AudioWorkletProcessor{constructor(options){super(); const o=(options&&options.processorOptions)||{}; const size=o.size||16000*10;this.ctl=o.sab?new Int32Array(o.sab,0,4):null; this.ring=o.sab?new Int16Array(o.sab,16,size):new Int16Array(size);this.w=0; this.start=0; this.state='silence'; this.hang=10; this.sens=5000; this.sil=0; this.peak=0; this.quanta=0; this.meterEvery=8;this.port.onmessage=(ev)=>{const m=ev.data; if(!m) return; if(m.cmd==='cfg'){ if(m.sens) this.sens=m.sens; if(m.hang) this.hang=m.hang; } else if(m.cmd==='pop'){ this.pop(m.id); } else if(m.cmd==='force'){ this.pop(Math.random()+''); } }; }pop(id){ const cap=this.ring.length; const n=Math.min(this.w-this.start, cap); const first=(this.w-n)%cap; const k=Math.min(n, cap-first); const out=new Int16Array(n); out.set(this.ring.subarray(first, first+k)); if(n>k) out.set(this.ring.subarray(0, n-k), k); this.start=this.w; this.port.postMessage({type:'frames', data:out.buffer, id}, [out.buffer]); }process(inputs){ const input=inputs[0]; if(!input||!input[0]) return true; const f32=input[0]; const cap=this.ring.length; let pos=this.w%cap, i=0, energy=0;while(i<f32.length){ const k=Math.min(f32.length-i, cap-pos); for(let j=0;j<k;j++){ const s=Math.max(-1,Math.min(1,f32[i+j])); const q=(s<0?s*0x8000:s*0x7FFF)|0; this.ring[pos+j]=q; energy+=q*q; } pos=(pos+k)%cap; i+=k; }this.w+=f32.length; if(this.ctl) Atomics.store(this.ctl,0,this.w);energy/=f32.length; const before=this.state;if(energy>this.sens){ this.state='speech'; this.sil=0; } else { this.sil++; if(this.state==='speech'&&this.sil>=this.hang){ this.port.postMessage({type:'emit', size:Math.min(this.w-this.start, cap), end:this.w}); this.state='silence'; this.sil=0; } }this.peak=Math.max(this.peak, energy);if(++this.quanta>=this.meterEvery||this.state!==before){ this.port.postMessage({type:'meter', energy:this.peak, state:this.state}); this.quanta=0; this.peak=0; }return true; } }registerProcessor('pcm-capture',PcmProcessor);class PcmPlayer extends AudioWorkletProcessor{constructor(){super();this.buf=new Float32Array(24000*60);this.r=0;this.w=0;this.n=0;this.prebuffer=2400;this.playing=false;this.ending=false;this.quanta=0;this.port.onmessage=(ev)=>{const m=ev.data;if(!m)return;if(m.cmd==='push'){this.push(m.data);}else if(m.cmd==='end'){this.ending=true;}else if(m.cmd==='clear'){this.r=0;this.w=0;this.n=0;this.playing=false;this.ending=false;}else if(m.cmd==='cfg'&&m.prebuffer){this.prebuffer=m.prebuffer;}};}push(pcm){const cap=this.buf.length;this.ending=false;if(pcm.length>cap-this.n){const drop=pcm.length-(cap-this.n);this.r=(this.r+drop)%cap;this.n-=drop;}let i=0;while(i<pcm.length){const k=Math.min(pcm.length-i,cap-this.w);for(let j=0;j<k;j++){this.buf[this.w+j]=pcm[i+j]/32768;}this.w=(this.w+k)%cap;i+=k;}this.n+=pcm.length;}process(inputs,outputs){const out=outputs[0][0];if(!out)return true;if(!this.playing&&(this.n>=this.prebuffer||(this.ending&&this.n>0))){this.playing=true;}let k=0;if(this.playing){const cap=this.buf.length;k=Math.min(out.length,this.n);const a=Math.min(k,cap-this.r);out.set(this.buf.subarray(this.r,this.r+a));if(k>a){out.set(this.buf.subarray(0,k-a),a);}this.r=(this.r+k)%cap;this.n-=k;if(this.n===0){this.playing=false;if(!this.ending){this.port.postMessage({type:'underrun'});}}}out.fill(0,k);if(++this.quanta%24===0){this.port.postMessage({type:'level',buffered:this.n});}return true;}}registerProcessor('pcm-player',PcmPlayer);'''
 
-class OmniChatServer:
-    def __init__(self, ip='0.0.0.0', port=60808, run_app=True, ckpt_dir='./checkpoint', device='cuda:0'):
+# cross-origin isolation, which the page needs for the SharedArrayBuffer capture ring
+ISOLATION_HEADERS = {'Cross-Origin-Opener-Policy': 'same-origin', 'Cross-Origin-Embedder-Policy': 'require-corp'}
+
+DRAINING = ({'error':'draining'}, 503, {'Retry-After': '5'})
+
+
+class ChatService:
+    """The part of the server both front-ends share: the deployment with its admission control and jobs,
+    and the request logic. Handlers return (JSON payload, status, headers) for the front-end to send."""
+
+    def __init__(self, ckpt_dir='./checkpoint', device='cuda:0', max_sessions=4, ttfa_slo=2.0, max_queue=16,
+                 opus_bitrate=32000, opus_frame_ms=20, replicas=0, max_prefill_tokens=512, fairness_budget=128,
+                 reserved_slots=1, jobs_dir='./output/jobs', kv_answer_budget=512):
+        self.opus_options = dict(bitrate=opus_bitrate, frame_ms=opus_frame_ms)
+        self.scheduler = Deployment(partial(make_scheduler, device=device, max_sessions=max_sessions, replicas=replicas,
+                                            max_prefill_tokens=max_prefill_tokens, fairness_budget=fairness_budget,
+                                            reserved_slots=reserved_slots, kv_answer_budget=kv_answer_budget), ckpt_dir)
+        self.admission = AdmissionController(self.scheduler, ttfa_slo=ttfa_slo, max_queue=max_queue)
+        self.jobs = JobManager(self.scheduler, results_dir=jobs_dir, admission=self.admission)
+
+    def _load(self):
+        return load_report(self.scheduler, self.admission), 200, {}
+
+    def _ready(self):
+        """Readiness: 200 while new turns are taken (`warm`, or `loading` a new model), 503 when `draining`."""
+        return self.scheduler.report(), 200 if self.scheduler.accepting else 503, {}
+
+    def _drain(self):
+        self.scheduler.drain()
+        return self.scheduler.report(), 200, {}
+
+    def _undrain(self):
+        self.scheduler.undrain()
+        return self.scheduler.report(), 200, {}
+
+    def _reload(self, body):
+        if not self.scheduler.reloadable:
+            return {'error':'a replica pool cannot be reloaded, restart the server instead'}, 409, {}
+        payload = json.loads(body) if body else {}
+        if not self.scheduler.reload(payload.get('ckpt_dir'), drain=bool(payload.get('drain'))):
+            return {'error':'a reload is already running'}, 409, {}
+        return self.scheduler.report(), 202, {}
+
+    def _cancel(self, body):
+        return {'cancelled': self.scheduler.cancel(json.loads(body).get('id'))}, 200, {}
+
+    def _create_job(self, body):
+        if not self.scheduler.accepting:
+            return DRAINING
+        try:
+            job = self.jobs.create(json.loads(body))
+        except ValueError as e:
+            return {'error':'bad job','message':str(e)}, 400, {}
+        return job.report(), 202, {}
+
+    def _job_status(self, job_id):
+        report = self.jobs.get(job_id)
+        if report is None:
+            return {'error':'unknown job'}, 404, {}
+        return report, 200, {}
+
+    def _stream_options(self, query, events):
+        """Returns (error or None, output format, priority) for a `/stream/*` query string."""
+        fmt = query.get('format', 'pcm16' if events else 'wav')
+        priority = query.get('priority', INTERACTIVE)
+        if fmt not in (EVENT_FORMATS if events else OUTPUT_FORMATS):
+            return ({'error':f'unknown format {fmt}'}, 400, {}), fmt, priority
+        if not self.scheduler.accepting:
+            return DRAINING, fmt, priority
+        if priority not in PRIORITIES:
+            return ({'error':f'unknown priority {priority}'}, 400, {}), fmt, priority
+        return None, fmt, priority
+
+    def _prepare(self, body, content_type, query, text=False, priority=INTERACTIVE):
+        """Decode an upload and queue its turn. Returns (error or None, turn or None)."""
+        t0 = time.perf_counter()
+        try:
+            req_id, audio = decode_upload(body, content_type, query)
+        except ValueError as e:
+            return ({'error':'bad audio','message':str(e)}, 400, {}), None
+        decode = time.perf_counter() - t0
+        if audio is None:
+            return ({'error':'missing pcm16'}, 400, {}), None
+        retry_after = self.admission.check(len(audio) / 16000, stream_stride=4, req_id=req_id, priority=priority)
+        if retry_after is not None:
+            return ({'error':'overloaded','retry_after':retry_after}, 503, {'Retry-After': str(retry_after)}), None
+        try:
+            req = self.scheduler.submit(audio, stream_stride=4, req_id=req_id, text=text, priority=priority)
+        except Draining:
+            return DRAINING, None
+        req.timing['decode'] = decode
+        return None, req
+
+    def _answer(self, req, fmt, events, t0):
+        return AnswerBody(self.scheduler, req, output_encoder(fmt, **self.opus_options), fmt, events, t0)
+
+
+class OmniChatServer(ChatService):
+    def __init__(self, ip='0.0.0.0', port=60808, run_app=True, ckpt_dir='./checkpoint', device='cuda:0', max_sessions=4, ttfa_slo=2.0, max_queue=16,
+                 opus_bitrate=32000, opus_frame_ms=20, replicas=0, max_prefill_tokens=512, fairness_budget=128, reserved_slots=1,
+                 jobs_dir='./output/jobs', kv_answer_budget=512):
+        super().__init__(ckpt_dir=ckpt_dir, device=device, max_sessions=max_sessions, ttfa_slo=ttfa_slo,
+                         max_queue=max_queue, opus_bitrate=opus_bitrate, opus_frame_ms=opus_frame_ms, replicas=replicas,
+                         max_prefill_tokens=max_prefill_tokens, fairness_budget=fairness_budget,
+                         reserved_slots=reserved_slots, jobs_dir=jobs_dir, kv_answer_budget=kv_answer_budget)
         app = Flask(__name__)
-        self.client = OmniInference(ckpt_dir, device)
-        self.client.warm_up()
         self.app = app
         app.add_url_rule('/', view_func=self.realtime)
         app.add_url_rule('/worklet.js', view_func=self.worklet)
         app.add_url_rule('/stream/vad', methods=['POST'], view_func=self.stream_vad)
+        app.add_url_rule('/stream/events', methods=['POST'], view_func=self.stream_events)
+        app.add_url_rule('/cancel', methods=['POST'], view_func=self.cancel)
         app.add_url_rule('/health', view_func=self.health)
+        app.add_url_rule('/metrics', view_func=self.metrics)
+        app.add_url_rule('/load', view_func=self.load)
+        app.add_url_rule('/ready', view_func=self.ready)
+        app.add_url_rule('/drain', methods=['POST'], view_func=self.drain)
+        app.add_url_rule('/undrain', methods=['POST'], view_func=self.undrain)
+        app.add_url_rule('/reload', methods=['POST'], view_func=self.reload)
+        app.add_url_rule('/jobs', methods=['POST'], view_func=self.create_job)
+        app.add_url_rule('/jobs/<job_id>', view_func=self.job_status)
+        app.add_url_rule('/jobs/<job_id>/results/<name>', view_func=self.job_result)
+        app.add_url_rule('/jobs/<job_id>/download', view_func=self.job_download)
         if run_app:
-            app.run(host=ip, port=port, threaded=False)
+            app.run(host=ip, port=port, threaded=True)
+
+    @staticmethod
+    def _send(response):
+        payload, status, headers = response
+        return jsonify(payload), status, headers
 
     def realtime(self):
-        return render_template_string(REALTIME_HTML)
+        return render_template_string(REALTIME_HTML), 200, ISOLATION_HEADERS
 
     def worklet(self):
-        return Response(WORKLET_JS, mimetype='application/javascript')
+        return Response(WORKLET_JS, mimetype='application/javascript', headers=ISOLATION_HEADERS)
 
     def health(self):
         return jsonify({'status':'ok'})
 
+    def metrics(self):
+        return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+    def load(self):
+        return self._send(self._load())
+
+    def ready(self):
+        return self._send(self._ready())
+
+    def drain(self):
+        return self._send(self._drain())
+
+    def undrain(self):
+        return self._send(self._undrain())
+
+    def reload(self):
+        return self._send(self._reload(request.get_data()))
+
+    def cancel(self):
+        return self._send(self._cancel(request.get_data()))
+
+    def create_job(self):
+        return self._send(self._create_job(request.get_data()))
+
+    def job_status(self, job_id):
+        return self._send(self._job_status(job_id))
+
+    def job_result(self, job_id, name):
+        path = self.jobs.path(job_id, name)
+        if path is None:
+            return jsonify({'error':'not found'}), 404
+        return send_file(os.path.abspath(path))
+
+    def job_download(self, job_id):
+        archive = self.jobs.archive(job_id)
+        if archive is None:
+            return jsonify({'error':'unknown job'}), 404
+        return Response(archive, mimetype='application/zip',
+                        headers={'Content-Disposition': f'attachment; filename="{job_id}.zip"'})
+
     def stream_vad(self):
+        return self._stream(events=False)
+
+    def stream_events(self):
+        return self._stream(events=True)
+
+    def _stream(self, events):
+        t0 = time.time()
+        error, fmt, priority = self._stream_options(request.args, events)
+        if error is not None:
+            return self._send(error)
         try:
-            t0=time.time();
-            payload = request.get_json(force=True)
-            req_id = payload.get('id') or str(uuid.uuid4())
-            raw_b64 = payload.get('pcm16')
-            if not raw_b64:
-                return jsonify({'error':'missing pcm16'}), 400
-            raw = base64.b64decode(raw_b64.encode('utf-8'))
-            print(f"[recv] id={req_id} bytes={len(raw)}")
-            with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as f:
-                f.write(self._pcm16_to_wav(raw, 16000))
-                path = f.name
-            gen = self.client.run_AT_batch_stream(path, stream_stride=4)
-            def wav_bytes():
-                header = b'RIFF' + struct.pack('<I', 36) + b'WAVEfmt ' + struct.pack('<IHHIIHH',16,1,1,24000,24000*2,2,16) + b'data' + struct.pack('<I', 0)
-                yield header
-                first=True
-                for chunk in gen:
-                    if first:
-                        print(f"[first] id={req_id} dt={int((time.time()-t0)*1000)}ms")
-                        first=False
-                    try:
-                        yield chunk if isinstance(chunk, (bytes,bytearray)) else bytes(chunk)
-                    except Exception:
-                        pass
-            return Response(stream_with_context(wav_bytes()), mimetype='audio/wav')
+            error, gen = self._prepare(request.get_data(), request.mimetype, request.args, events, priority)
+            if error is not None:
+                return self._send(error)
+            answer = self._answer(gen, fmt, events, t0)
+            chunks = iter(gen)
+            if not events:
+                # the headers wait for the first audio chunk, so Server-Timing covers every stage up to it.
+                # Event streams send text before that and get the timings in their `end` event instead
+                try:
+                    answer.first(next(chunks, None))
+                except Exception:
+                    self.scheduler.cancel(gen)
+                    raise
+            headers = answer.headers()
+            def audio_bytes():
+                try:
+                    yield answer.start()
+                    for chunk in chunks:
+                        yield answer.encode(chunk)
+                    yield answer.flush()
+                finally:
+                    answer.close()
+            return Response(stream_with_context(audio_bytes()), content_type=answer.content_type, headers=headers)
         except Exception as e:
             print('stream_vad error', e)
             print(traceback.format_exc())
             return jsonify({'error':'internal','message':str(e)}), 500
 
+
+class AsyncOmniChatServer(ChatService):
+    """ASGI front-end. Network I/O stays on the event loop, upload decoding and `load_audio` run on a
+    bounded executor and the model itself is driven by the `DecodeScheduler` thread."""
+
+    def __init__(self, ckpt_dir='./checkpoint', device='cuda:0', max_sessions=4, workers=2, max_queue=16, ttfa_slo=2.0,
+                 vad_threshold=0.5, vad_hangover_ms=700, vad_min_speech_ms=250, opus_bitrate=32000, opus_frame_ms=20,
+                 replicas=0, max_prefill_tokens=512, fairness_budget=128, reserved_slots=1, jobs_dir='./output/jobs',
+                 kv_answer_budget=512):
+        super().__init__(ckpt_dir=ckpt_dir, device=device, max_sessions=max_sessions, ttfa_slo=ttfa_slo,
+                         max_queue=max_queue, opus_bitrate=opus_bitrate, opus_frame_ms=opus_frame_ms, replicas=replicas,
+                         max_prefill_tokens=max_prefill_tokens, fairness_budget=fairness_budget,
+                         reserved_slots=reserved_slots, jobs_dir=jobs_dir, kv_answer_budget=kv_answer_budget)
+        # server-side endpointing for `/ws?vad=1`, 512-sample windows keep the decision latency at 32 ms
+        self.vad_options = VadOptions(
+            threshold=vad_threshold,
+            min_speech_duration_ms=vad_min_speech_ms,
+            min_silence_duration_ms=vad_hangover_ms,
+            window_size_samples=512,
+            speech_pad_ms=300,
+        )
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='omni-prep')
+        self.max_pending = workers + max_queue
+        self._pending = 0
+        self.app = Starlette(routes=[
+            Route('/', self.realtime),
+            Route('/worklet.js', self.worklet),
+            Route('/stream/vad', self.stream_vad, methods=['POST']),
+            Route('/stream/events', self.stream_events, methods=['POST']),
+            Route('/cancel', self.cancel, methods=['POST']),
+            Route('/health', self.health),
+            Route('/metrics', self.metrics),
+            Route('/load', self.load),
+            Route('/ready', self.ready),
+            Route('/drain', self.drain, methods=['POST']),
+            Route('/undrain', self.undrain, methods=['POST']),
+            Route('/reload', self.reload, methods=['POST']),
+            Route('/jobs', self.create_job, methods=['POST']),
+            Route('/jobs/{job_id}', self.job_status),
+            Route('/jobs/{job_id}/results/{name}', self.job_result),
+            Route('/jobs/{job_id}/download', self.job_download),
+            WebSocketRoute('/ws', self.stream_ws),
+        ])
+
     @staticmethod
-    def _pcm16_to_wav(pcm_bytes: bytes, sr: int) -> bytes:
-        data_size = len(pcm_bytes)
-        header = b'RIFF' + struct.pack('<I', 36+data_size) + b'WAVEfmt ' + struct.pack('<IHHIIHH',16,1,1,sr,sr*2,2,16) + b'data' + struct.pack('<I', data_size)
-        return header + pcm_bytes
+    def _send(response):
+        payload, status, headers = response
+        return JSONResponse(payload, status_code=status, headers=headers)
+
+    async def realtime(self, request):
+        return HTMLResponse(REALTIME_HTML, headers=ISOLATION_HEADERS)
+
+    async def worklet(self, request):
+        return StarletteResponse(WORKLET_JS, media_type='application/javascript', headers=ISOLATION_HEADERS)
+
+    async def health(self, request):
+        return JSONResponse({'status':'ok'})
+
+    async def metrics(self, request):
+        return StarletteResponse(metrics.REGISTRY.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+    async def load(self, request):
+        return self._send(self._load())
+
+    async def ready(self, request):
+        return self._send(self._ready())
+
+    async def drain(self, request):
+        return self._send(self._drain())
+
+    async def undrain(self, request):
+        return self._send(self._undrain())
+
+    async def reload(self, request):
+        return self._send(self._reload(await request.body()))
+
+    async def cancel(self, request):
+        return self._send(self._cancel(await request.body()))
+
+    async def run_in_executor(self, fn, *args):
+        """Run `fn` on the executor, or return None straight away when its queue is full."""
+        if self._pending >= self.max_pending:
+            return None
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self._pending -= 1
+
+    async def stream_vad(self, request):
+        return await self._stream(request, events=False)
+
+    async def stream_events(self, request):
+        """Server-sent events interleaving the answer's text deltas with its audio, see `EventStream`."""
+        return await self._stream(request, events=True)
+
+    async def _stream(self, request, events):
+        t0 = time.time()
+        error, fmt, priority = self._stream_options(request.query_params, events)
+        if error is not None:
+            return self._send(error)
+        body = await request.body()
+        try:
+            content_type = request.headers.get('content-type', '').split(';')[0].strip().lower()
+            prepared = await self.run_in_executor(self._prepare, body, content_type, request.query_params, events,
+                                                  priority)
+            if prepared is None:
+                return JSONResponse({'error':'busy'}, status_code=503, headers={'Retry-After': '1'})
+            error, gen = prepared
+            if error is not None:
+                return self._send(error)
+            answer = self._answer(gen, fmt, events, t0)
+        except Exception as e:
+            print('stream_vad error', e)
+            print(traceback.format_exc())
+            return JSONResponse({'error':'internal','message':str(e)}, status_code=500)
+        chunks = gen.__aiter__()
+        if not events:
+            # as in the Flask server, the headers wait for the first audio chunk to carry Server-Timing
+            try:
+                answer.first(await chunks.__anext__())
+            except StopAsyncIteration:
+                answer.first(None)
+            except Exception as e:
+                self.scheduler.cancel(gen)
+                print('stream_vad error', e)
+                return JSONResponse({'error':'internal','message':str(e)}, status_code=500)
+        headers = answer.headers()
+
+        async def audio_bytes():
+            try:
+                yield answer.start()
+                async for chunk in chunks:
+                    yield answer.encode(chunk)
+                yield answer.flush()
+            finally:
+                answer.close()
+        return StreamingResponse(audio_bytes(), headers={'Content-Type': answer.content_type, **headers})
+
+    async def create_job(self, request):
+        body = await request.body()
+        # large payloads, parsed off the event loop
+        response = await self.run_in_executor(self._create_job, body)
+        if response is None:
+            return JSONResponse({'error':'busy'}, status_code=503, headers={'Retry-After': '1'})
+        return self._send(response)
+
+    async def job_status(self, request):
+        return self._send(self._job_status(request.path_params['job_id']))
+
+    async def job_result(self, request):
+        path = self.jobs.path(request.path_params['job_id'], request.path_params['name'])
+        if path is None:
+            return JSONResponse({'error':'not found'}, status_code=404)
+        return FileResponse(path)
+
+    async def job_download(self, request):
+        job_id = request.path_params['job_id']
+        archive = await self.run_in_executor(self.jobs.archive, job_id)
+        if archive is None:
+            return JSONResponse({'error':'unknown job'}, status_code=404)
+        return StarletteResponse(archive, media_type='application/zip',
+                                 headers={'Content-Disposition': f'attachment; filename="{job_id}.zip"'})
+
+    async def stream_ws(self, websocket):
+        """Full-duplex voice socket.
+
+        The client sends binary frames of raw little-endian 16 kHz PCM16 and the answer comes back on the
+        same socket as binary frames of raw 24 kHz PCM16 (Ogg/Opus pages with `?format=opus`), framed by
+        `start`/`end` JSON text messages. With `?text=1` the answer's text arrives alongside as
+        `{"type": "text", "delta": ...}` messages.
+        Audio is prefilled into the model as it arrives.
+
+        With `?vad=1` the server finds the utterances itself: the client streams the microphone
+        continuously and gets `speech_start`/`speech_end` messages. Otherwise the client marks each
+        utterance, optionally with a `{"type": "start", "id": ...}` text frame before the audio, and
+        always with a `{"type": "end"}` text frame after it. Utterances turned away by admission control get
+        an `error` message with `retry_after` and their audio is dropped.
+        """
+        fmt = websocket.query_params.get('format', 'pcm16')
+        if fmt not in ('pcm16', 'opus'):
+            await websocket.close(code=1003)
+            return
+        await websocket.accept()
+        loop = asyncio.get_running_loop()
+        text = websocket.query_params.get('text') == '1'
+        endpointer = StreamingEndpointer(self.vad_options) if websocket.query_params.get('vad') == '1' else None
+        req, req_id, rest = None, None, b''
+        turn, answering = None, None
+        # a turn refused by admission control drops its audio up to the client's `end`
+        shed = False
+        received = 0
+
+        async def open_turn(turn_id):
+            nonlocal received
+            received = 0
+            # barge-in: the user talking again cancels the answer that is still being spoken
+            if turn is not None and not turn.done():
+                self.scheduler.cancel(answering)
+                turn.cancel()
+                await websocket.send_json({'type':'barge_in','id':answering.id})
+            if not self.scheduler.accepting:
+                await websocket.send_json({'type':'error','id':turn_id,'error':'draining'})
+                return None
+            retry_after = self.admission.check(0, stream_stride=4, req_id=turn_id)
+            if retry_after is not None:
+                await websocket.send_json({'type':'error','id':turn_id,'error':'overloaded','retry_after':retry_after})
+                return None
+            return self.scheduler.open_stream(stream_stride=4, req_id=turn_id, text=text)
+
+        async def append(audio):
+            nonlocal received
+            received += len(audio)
+            # mel spectrograms are computed off the event loop, one append at a time to keep the order
+            await loop.run_in_executor(self.executor, self.scheduler.append_audio, req, audio)
+
+        async def end_turn():
+            print(f"[recv] id={req.id} samples={received}")
+            await loop.run_in_executor(self.executor, self.scheduler.end_audio, req)
+            return asyncio.create_task(self._ws_answer(websocket, req, turn, fmt))
+
+        try:
+            while True:
+                msg = await websocket.receive()
+                if msg['type'] == 'websocket.disconnect':
+                    break
+                if msg.get('bytes') is not None:
+                    data = rest + msg['bytes']
+                    cut = len(data) - len(data) % 2
+                    rest = data[cut:]
+                    audio = np.frombuffer(data[:cut], dtype='<i2').astype(np.float32) / 32768.0
+                    if endpointer is None:
+                        if req is None and not shed:
+                            req = await open_turn(req_id or str(uuid.uuid4()))
+                            shed = req is None
+                        if req is not None:
+                            await append(audio)
+                        continue
+                    for kind, segment in await loop.run_in_executor(self.executor, endpointer.feed, audio):
+                        if kind == 'start':
+                            req = await open_turn(str(uuid.uuid4()))
+                            if req is None:
+                                continue
+                            await websocket.send_json({'type':'speech_start','id':req.id})
+                            await append(segment)
+                        elif kind == 'audio' and req is not None:
+                            await append(segment)
+                        elif kind == 'end' and req is not None:
+                            await websocket.send_json({'type':'speech_end','id':req.id})
+                            turn, answering = await end_turn(), req
+                            req = None
+                    continue
+                event = json.loads(msg.get('text') or '{}')
+                if event.get('type') == 'start':
+                    req_id = event.get('id')
+                elif event.get('type') == 'end':
+                    if req is not None:
+                        turn, answering = await end_turn(), req
+                    req, req_id, rest, shed = None, None, b'', False
+        except WebSocketDisconnect:
+            pass
+        finally:
+            # the socket is gone: free the rows of the utterance in progress and of the answer being sent
+            if req is not None:
+                self.scheduler.cancel(req)
+            if turn is not None:
+                turn.cancel()
+
+    async def _ws_answer(self, websocket, req, previous, fmt='pcm16'):
+        t0 = time.time()
+        try:
+            encoder = OggOpusEncoder(24000, **self.opus_options) if fmt == 'opus' else None
+            if previous is not None:
+                # answers on one socket are sent in order. A barged-in answer was cancelled, its
+                # cancellation must not end this one
+                await asyncio.wait([previous])
+            await websocket.send_json({'type':'start','id':req.id,'sample_rate':24000,'format':fmt})
+            if encoder is not None:
+                await websocket.send_bytes(encoder.header())
+            first = True
+            async for chunk in req:
+                if first:
+                    print(f"[first] id={req.id} dt={int((time.time()-t0)*1000)}ms")
+                    first = False
+                if isinstance(chunk, str):
+                    await websocket.send_json({'type':'text','id':req.id,'delta':chunk})
+                    continue
+                if encoder is not None:
+                    chunk = encoder.encode(chunk)
+                if chunk:
+                    await websocket.send_bytes(chunk)
+            if encoder is not None:
+                await websocket.send_bytes(encoder.flush())
+            await websocket.send_json({'type':'end','id':req.id,'underruns':req.underruns,'timing':timing_ms(req.timing)})
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            print('stream_ws error', e)
+            print(traceback.format_exc())
+        finally:
+            self.scheduler.cancel(req)
+
+
+def pcm16_to_wav(pcm_bytes: bytes, sr: int) -> bytes:
+    data_size = len(pcm_bytes)
+    header = b'RIFF' + struct.pack('<I', 36+data_size) + b'WAVEfmt ' + struct.pack('<IHHIIHH',16,1,1,sr,sr*2,2,16) + b'data' + struct.pack('<I', data_size)
+    return header + pcm_bytes
+
+
+def wav_stream_header(sr: int = 24000) -> bytes:
+    """WAV header with a zero data length, for responses whose size is not known upfront."""
+    return b'RIFF' + struct.pack('<I', 36) + b'WAVEfmt ' + struct.pack('<IHHIIHH',16,1,1,sr,sr*2,2,16) + b'data' + struct.pack('<I', 0)
+
+
+OUTPUT_FORMATS = {'wav': 'audio/wav', 'opus': 'audio/ogg; codecs=opus'}
+
+
+EVENT_FORMATS = ('pcm16', 'opus')
+
+
+class WavStream:
+    """Streaming WAV output with the interface of `OggOpusEncoder`: a header, then the PCM16 as is.
+    Without `wav_header` it is bare PCM16."""
+
+    def __init__(self, sample_rate=24000, wav_header=True):
+        self.sample_rate = sample_rate
+        self.wav_header = wav_header
+
+    def header(self):
+        return wav_stream_header(self.sample_rate) if self.wav_header else b''
+
+    def encode(self, pcm):
+        return pcm
+
+    def flush(self):
+        return b''
+
+
+def output_encoder(fmt, bitrate=32000, frame_ms=20):
+    if fmt == 'opus':
+        return OggOpusEncoder(24000, bitrate=bitrate, frame_ms=frame_ms)
+    return WavStream(24000, wav_header=fmt == 'wav')
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+
+
+class EventStream:
+    """Server-sent events for one turn, with the encoder interface so it drops into the audio responses.
+
+    `start` carries the audio format, `text` events the text deltas, `audio` events base64 audio (PCM16 or
+    Ogg/Opus pages) and `end` the full text, the turn's playback underruns and its stage timings in ms.
+    Text and audio come in the order they were generated.
+    """
+
+    def __init__(self, req, encoder, fmt):
+        self.req = req
+        self.req_id = req.id
+        self.encoder = encoder
+        self.fmt = fmt
+        self.text = []
+
+    def _audio(self, data):
+        return sse('audio', {'data': base64.b64encode(data).decode('ascii')}) if data else b''
+
+    def header(self):
+        start = sse('start', {'id': self.req_id, 'sample_rate': 24000, 'format': self.fmt})
+        return start + self._audio(self.encoder.header())
+
+    def encode(self, item):
+        if isinstance(item, str):
+            self.text.append(item)
+            return sse('text', {'delta': item})
+        return self._audio(self.encoder.encode(item))
+
+    def flush(self):
+        end = {'id': self.req_id, 'text': ''.join(self.text), 'underruns': self.req.underruns, 'timing': timing_ms(self.req.timing)}
+        return self._audio(self.encoder.flush()) + sse('end', end)
+
+
+class AnswerBody:
+    """The bytes of one streamed `/stream/*` answer, in the order the front-ends' generators yield them:
+    `start`, `encode` for each chunk, `flush`, and `close` however the response ends."""
+
+    def __init__(self, scheduler, req, encoder, fmt, events, t0):
+        self.scheduler = scheduler
+        self.req = req
+        self.encoder = EventStream(req, encoder, fmt) if events else encoder
+        self.content_type = 'text/event-stream' if events else OUTPUT_FORMATS[fmt]
+        self.t0 = t0
+        self.pending = None
+        self.announced = False
+
+    def _announce(self):
+        if not self.announced:
+            print(f"[first] id={self.req.id} dt={int((time.time()-self.t0)*1000)}ms")
+            self.announced = True
+
+    def first(self, chunk):
+        """The first chunk, read before the response headers are sent."""
+        self._announce()
+        self.pending = chunk
+
+    def headers(self):
+        return {'Server-Timing': server_timing(self.req.timing), 'X-Request-Id': self.req.id}
+
+    def start(self):
+        data = self.encoder.header()
+        if self.pending is not None:
+            data += self.encoder.encode(self.pending)
+            self.pending = None
+        return data
+
+    def encode(self, chunk):
+        self._announce()
+        return self.encoder.encode(chunk)
+
+    def flush(self):
+        print(f"[timing] id={self.req.id} {server_timing(self.req.timing)}")
+        return self.encoder.flush()
+
+    def close(self):
+        # the client went away (or generation failed): stop decoding and free the rows
+        self.scheduler.cancel(self.req)
+
+
+def timing_ms(timing):
+    """A turn's stage timings, from seconds to rounded ms."""
+    return {name: round(seconds * 1000, 1) for name, seconds in timing.items()}
+
+
+def server_timing(timing):
+    """`Server-Timing` header value for a turn's stage timings."""
+    return ', '.join(f'{name};dur={ms}' for name, ms in timing_ms(timing).items())
+
+
+def decode_upload(body, content_type, query):
+    """Decode a `/stream/vad` body into 16 kHz float32 samples, in memory. Returns (req_id, audio or None).
+
+    `audio/l16` bodies are raw 16 kHz PCM16, other `audio/*` bodies are compressed recordings as browsers
+    make them (WebM or Ogg Opus, ...), both sent as is with the id in the query string. Anything else is the
+    JSON payload with base64 PCM16 in `pcm16`.
+    """
+    if content_type == 'audio/l16':
+        req_id = query.get('id') or str(uuid.uuid4())
+        print(f"[recv] id={req_id} bytes={len(body)}")
+        return req_id, pcm16_to_float(body)
+    if content_type.startswith('audio/'):
+        req_id = query.get('id') or str(uuid.uuid4())
+        print(f"[recv] id={req_id} bytes={len(body)} type={content_type}")
+        return req_id, decode_audio(body)
+    payload = json.loads(body)
+    req_id = payload.get('id') or str(uuid.uuid4())
+    raw_b64 = payload.get('pcm16')
+    if not raw_b64:
+        return req_id, None
+    raw = base64.b64decode(raw_b64.encode('utf-8'))
+    print(f"[recv] id={req_id} bytes={len(raw)}")
+    return req_id, pcm16_to_float(raw)
+
+
+def load_report(scheduler, admission):
+    """What `/load` tells the router: turns holding rows, turns waiting for them and the row capacity."""
+    return {
+        'active': scheduler.num_active,
+        'queued': len(scheduler.pending_prompt_lengths()),
+        'free': scheduler.num_free,
+        'capacity': scheduler.max_sessions,
+        'predicted_ttfa': round(admission.predict_ttfa(0), 3),
+        'state': scheduler.state,
+    }
+
+
+def make_scheduler(ckpt_dir, device, max_sessions, replicas=0, max_prefill_tokens=512, fairness_budget=128, reserved_slots=1,
+                   kv_answer_budget=512):
+    """One `DecodeScheduler` on `device`, or with `replicas` a pool of forked CPU workers sharing the weights."""
+    if replicas:
+        return ReplicaPool(ckpt_dir, replicas, device, max_sessions, reserved_slots=reserved_slots,
+                           kv_answer_budget=kv_answer_budget, max_prefill_tokens=max_prefill_tokens,
+                           fairness_budget=fairness_budget)
+    client = OmniInference(ckpt_dir, device, kv_answer_budget=kv_answer_budget)
+    client.warm_up()
+    return DecodeScheduler(client, max_sessions=max_sessions, max_prefill_tokens=max_prefill_tokens,
+                           fairness_budget=fairness_budget, reserved_slots=reserved_slots,
+                           kv_answer_budget=kv_answer_budget)
 
 
 def create_app():
     return OmniChatServer(run_app=False).app
 
-def serve(ip='0.0.0.0', port=60808, device='cuda:0'):
-    OmniChatServer(ip, port, True, './checkpoint', device)
+def serve(ip='0.0.0.0', port=60808, device='cuda:0', max_sessions=4, asgi=False, workers=2, vad_hangover_ms=700,
+          ttfa_slo=2.0, max_queue=16, opus_bitrate=32000, opus_frame_ms=20, replicas=0, max_prefill_tokens=512,
+          fairness_budget=128, reserved_slots=1, jobs_dir='./output/jobs', kv_answer_budget=512):
+    options = dict(device=device, max_sessions=max_sessions, ttfa_slo=ttfa_slo, max_queue=max_queue,
+                   opus_bitrate=opus_bitrate, opus_frame_ms=opus_frame_ms, replicas=replicas,
+                   max_prefill_tokens=max_prefill_tokens, fairness_budget=fairness_budget,
+                   reserved_slots=reserved_slots, jobs_dir=jobs_dir, kv_answer_budget=kv_answer_budget)
+    if asgi:
+        return serve_async(ip=ip, port=port, workers=workers, vad_hangover_ms=vad_hangover_ms, **options)
+    OmniChatServer(ip=ip, port=port, run_app=True, ckpt_dir='./checkpoint', **options)
+
+def serve_async(ip='0.0.0.0', port=60808, device='cuda:0', max_sessions=4, workers=2, vad_hangover_ms=700,
+                ttfa_slo=2.0, max_queue=16, opus_bitrate=32000, opus_frame_ms=20, replicas=0, max_prefill_tokens=512,
+                fairness_budget=128, reserved_slots=1, jobs_dir='./output/jobs', kv_answer_budget=512):
+    import uvicorn
+    server = AsyncOmniChatServer(ckpt_dir='./checkpoint', device=device, max_sessions=max_sessions, workers=workers,
+                                 max_queue=max_queue, ttfa_slo=ttfa_slo, vad_hangover_ms=vad_hangover_ms,
+                                 opus_bitrate=opus_bitrate, opus_frame_ms=opus_frame_ms, replicas=replicas, max_prefill_tokens=max_prefill_tokens,
+                                 fairness_budget=fairness_budget, reserved_slots=reserved_slots, jobs_dir=jobs_dir,
+                                 kv_answer_budget=kv_answer_budget)
+    uvicorn.run(server.app, host=ip, port=port)
 
 if __name__=='__main__':
     import fire
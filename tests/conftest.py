@@ -0,0 +1,152 @@
+import contextlib
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from litgpt.model import GPT, Config
+from scheduler import StreamRequest
+
+
+class FakeScheduler:
+    """The surface of `DecodeScheduler` the servers use, without a model. Streamed turns answer with one
+    audio chunk once their audio ends; with `hold_first`, the first answer keeps talking until cancelled."""
+
+    max_sessions = 4
+    encode_time = 0.01
+    prefill_token_time = 0.0001
+    step_time = 0.01
+    turn_time = 1.0
+
+    def __init__(self, ckpt_dir="./checkpoint", hold_first=False):
+        self.ckpt_dir = ckpt_dir
+        self.hold_first = hold_first
+        self.streams = []
+        self.closed = False
+
+    @property
+    def num_open(self):
+        return sum(not req.done for req in self.streams)
+
+    @property
+    def num_active(self):
+        return self.num_open
+
+    @property
+    def num_free(self):
+        return self.max_sessions - self.num_open
+
+    def pending_prompt_lengths(self, priority=None):
+        return []
+
+    def submit_text(self, prompt, stream_stride=4, max_returned_tokens=2048, req_id=None, text=False,
+                    priority="interactive"):
+        req = StreamRequest(req_id, None, len(prompt), stream_stride, max_returned_tokens, priority)
+        self.streams.append(req)
+        return req
+
+    def open_stream(self, stream_stride=4, max_returned_tokens=2048, req_id=None, chunk_seconds=1.0, text=False,
+                    priority="interactive"):
+        req = StreamRequest(req_id, None, 0, stream_stride, max_returned_tokens, priority)
+        self.streams.append(req)
+        return req
+
+    def append_audio(self, req, audio):
+        pass
+
+    def end_audio(self, req):
+        req.put(b"\x01\x00" * 480)
+        if not (self.hold_first and req is self.streams[0]):
+            self.finish(req)
+
+    def finish(self, req):
+        req.done = True
+        req.close()
+
+    def cancel(self, req):
+        if req.done:
+            return False
+        req.cancelled = True
+        self.finish(req)
+        return True
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def deployment():
+    """A `Deployment` of `FakeScheduler`s."""
+    from deploy import Deployment
+
+    deployment = Deployment(FakeScheduler, "./checkpoint")
+    yield deployment
+    deployment.close()
+
+
+@pytest.fixture
+def fake_scheduler(monkeypatch):
+    """Servers built in the test get `FakeScheduler`s instead of loading a model. Returns the ones made."""
+    import server
+
+    made = []
+
+    def make_scheduler(ckpt_dir, **kwargs):
+        made.append(FakeScheduler(ckpt_dir, hold_first=not made))
+        return made[-1]
+
+    monkeypatch.setattr(server, "make_scheduler", make_scheduler)
+    return made
+
+
+class FakeTokenizer:
+    """Text to ids and back without a vocabulary: one id per character."""
+
+    def encode(self, text):
+        return torch.tensor([100 + ord(c) for c in text])
+
+    def decode(self, ids):
+        return "".join(chr(i - 100) if 100 <= i < 100 + 0x110000 else "" for i in torch.as_tensor(ids).tolist())
+
+
+class FakeSnac:
+    """Decodes every SNAC window to 2048 samples of silence."""
+
+    def decode(self, codes):
+        return torch.zeros(1, 1, 2048)
+
+
+@pytest.fixture
+def tiny_model():
+    """A two-layer GPT with the vocabulary layout of the real checkpoint, on the CPU. Its kv cache grows
+    in steps of 16 positions."""
+    torch.manual_seed(0)
+    config = Config(
+        block_size=512,
+        n_layer=2,
+        n_head=4,
+        n_embd=32,
+        rotary_percentage=1.0,
+        vocab_size=181120,
+        padded_vocab_size=181120,
+        text_vocab_size=152000,
+        audio_vocab_size=4160,
+        asr_adapter="mlp",
+    )
+    model = GPT(config).eval()
+    model.kv_chunk = 16
+    return model
+
+
+@pytest.fixture
+def tiny_client(tiny_model):
+    """What `DecodeScheduler` uses of `OmniInference`, around `tiny_model`. There is no whisper model,
+    turns have to be T1A2."""
+    return SimpleNamespace(
+        model=tiny_model,
+        device="cpu",
+        fabric=SimpleNamespace(init_tensor=contextlib.nullcontext),
+        whispermodel=None,
+        snacmodel=FakeSnac(),
+        text_tokenizer=FakeTokenizer(),
+    )
@@ -0,0 +1,58 @@
+import time
+
+import pytest
+from starlette.testclient import TestClient
+
+from deploy import DRAINING, WARM, Draining
+from server import AsyncOmniChatServer
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_drain_reload_ready(fake_scheduler, tmp_path):
+    server = AsyncOmniChatServer(jobs_dir=str(tmp_path))
+    client = TestClient(server.app)
+    assert client.get("/ready").status_code == 200
+
+    assert client.post("/reload", json={"ckpt_dir": "./next", "drain": True}).status_code == 202
+    wait_for(lambda: not server.scheduler.loading)
+    ready = client.get("/ready")
+    assert ready.status_code == 200
+    assert ready.json()["state"] == WARM
+    assert ready.json()["ckpt_dir"] == "./next"
+    assert server.scheduler.current is fake_scheduler[1]
+    assert server.scheduler.open_stream(req_id="after").owner is fake_scheduler[1]
+
+
+def test_drained_node_stays_drained_through_reload(fake_scheduler, tmp_path):
+    server = AsyncOmniChatServer(jobs_dir=str(tmp_path))
+    client = TestClient(server.app)
+    assert client.post("/drain").json()["state"] == DRAINING
+    assert client.get("/ready").status_code == 503
+
+    assert client.post("/reload", json={"ckpt_dir": "./next", "drain": True}).status_code == 202
+    wait_for(lambda: not server.scheduler.loading)
+    ready = client.get("/ready")
+    assert ready.status_code == 503
+    assert ready.json()["ckpt_dir"] == "./next"
+
+
+def test_undrain(deployment):
+    deployment.drain()
+    assert not deployment.accepting
+    deployment.undrain()
+    assert deployment.accepting
+    assert deployment.state == WARM
+
+
+def test_accepted_turns_pass_a_drain(deployment):
+    deployment.drain()
+    with pytest.raises(Draining):
+        deployment.submit_text("hello")
+    req = deployment.submit_text("hello", req_id="job-input", accepted=True)
+    assert req.owner is deployment.current
@@ -0,0 +1,45 @@
+import random
+
+from utils.detokenizer import IncrementalDetokenizer
+
+TEXT = "Hello, 世界! naïve café — 🙂👍🏽 done.\nZürich 東京"
+
+
+class ByteTokenizer:
+    """Byte-level tokens like the BPE vocabulary's: each id is a run of UTF-8 bytes that can end or start in
+    the middle of a character, and decoding replaces incomplete sequences with U+FFFD."""
+
+    def __init__(self):
+        self.pieces = []
+
+    def encode(self, text, rng):
+        data, ids, start = text.encode("utf-8"), [], 0
+        while start < len(data):
+            end = min(len(data), start + rng.randint(1, 4))
+            self.pieces.append(data[start:end])
+            ids.append(len(self.pieces) - 1)
+            start = end
+        return ids
+
+    def decode(self, ids):
+        return b"".join(self.pieces[i] for i in ids).decode("utf-8", errors="replace")
+
+
+def test_deltas_concatenate_to_the_full_decode():
+    tokenizer = ByteTokenizer()
+    for seed in range(50):
+        ids = tokenizer.encode(TEXT, random.Random(seed))
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        deltas = [detokenizer.add(token) for token in ids]
+        deltas.append(detokenizer.flush())
+        assert "".join(deltas) == tokenizer.decode(ids) == TEXT
+        assert not any("�" in delta for delta in deltas)
+
+
+def test_flush_releases_a_partial_character():
+    tokenizer = ByteTokenizer()
+    # the answer stops two bytes into "世"
+    tokenizer.pieces = [b"ok ", "世".encode("utf-8")[:1], "世".encode("utf-8")[1:2]]
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    assert [detokenizer.add(token) for token in range(3)] == ["ok ", "", ""]
+    assert detokenizer.flush() == "�"
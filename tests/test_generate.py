@@ -0,0 +1,82 @@
+import pytest
+import torch
+
+import baseline_generate as baseline
+from litgpt.generate.base import DECODE_TASKS, generate
+from utils.snac_utils import layershift
+
+# special tokens, as in inference.py
+_eot, _pad_t, _input_t, _answer_t, _asr = 151936, 151937, 151938, 151939, 151940
+_eoa, _pad_a, _input_a, _answer_a = 4096, 4097, 4098, 4099
+
+SAMPLING = dict(temperature=0.9, top_k=1, top_p=1.0, eos_id_a=_eoa, eos_id_t=_eot, pad_id_t=_pad_t)
+ANSWER = 40
+
+
+def audio_prompt(frames, answer_a=_answer_a, answer_t=_answer_t):
+    """The layers of `get_input_ids_whisper`."""
+    ids = [
+        torch.tensor([[layershift(_input_a, i)] + [layershift(_pad_a, i)] * frames + [layershift(_eoa, i), layershift(answer_a, i)]])
+        for i in range(7)
+    ]
+    return ids + [torch.tensor([[_input_t] + [_pad_t] * frames + [_eot, answer_t]])]
+
+
+def text_prompt(tokens, audio_answer):
+    """The layers of `get_input_ids_TA`, or of `get_input_ids_TT` without `audio_answer`."""
+    if audio_answer:
+        audio = [[layershift(_pad_a, i)] * (len(tokens) + 2) + [layershift(_answer_a, i)] for i in range(7)]
+    else:
+        audio = [[layershift(_pad_a, i)] * (len(tokens) + 3) for i in range(7)]
+    return [torch.tensor([layer]) for layer in audio] + [torch.tensor([[_input_t] + tokens + [_eot, _answer_t]])]
+
+
+def rows(*prompts):
+    return [torch.cat(layers) for layers in zip(*prompts)]
+
+
+@pytest.fixture
+def model(tiny_model):
+    # Fabric's wrapper gives the model its device
+    tiny_model.device = torch.device("cpu")
+    return tiny_model
+
+
+def cases():
+    """task -> (prompt layers, features, the pre-refactor loop and its extra arguments, its prompt layers and features)"""
+    torch.manual_seed(1)
+    frames = 12
+    features = torch.randn(1, frames, 768)
+    text = torch.randint(100, 5000, (9,)).tolist()
+    spoken = audio_prompt(frames)
+    spoken_text = audio_prompt(frames, answer_a=_pad_a)
+    spoken_asr = audio_prompt(frames, answer_a=_pad_a, answer_t=_asr)
+    batch = rows(spoken, spoken_text)
+    return {
+        "A1A2": (spoken, features, baseline.generate_AA, {}, spoken, features),
+        "A1A2_BATCH": (batch, features.expand(2, -1, -1), baseline.generate_TA_BATCH, {"shift": 152000}, batch,
+                       features.expand(2, -1, -1)),
+        "T1A2": (text_prompt(text, True), None, baseline.generate_TA, {}, text_prompt(text, True), None),
+        "A1T2": (spoken_text, features, baseline.generate_AT, {}, spoken_text, features),
+        "A1T1": (spoken_asr, features, baseline.generate_ASR, {}, spoken_asr, features),
+        # no loop decoded two rows for text, the answer of the second row is the one of A1T1
+        "A1T1_BATCH": (rows(spoken_asr, spoken_asr), features.expand(2, -1, -1), baseline.generate_ASR, {},
+                       spoken_asr, features),
+        "T1T2": (text_prompt(text, False), None, baseline.generate_TT, {}, text_prompt(text, False), None),
+    }
+
+
+@pytest.mark.parametrize("task", list(DECODE_TASKS))
+def test_engine_matches_the_task_loops(model, task):
+    input_ids, features, loop, extra, loop_ids, loop_features = cases()[task]
+    T = input_ids[0].size(1)
+
+    model.set_kv_cache(batch_size=loop_ids[0].size(0), length=T + ANSWER)
+    expected = loop(model, loop_features, loop_ids, T - 3, None, T + ANSWER, **extra, **SAMPLING)
+
+    # a short cache, grown as the answer gets longer
+    model.set_kv_cache(batch_size=DECODE_TASKS[task].rows, length=T + 1)
+    answer = generate(model, task, input_ids, features, T + ANSWER, **SAMPLING)
+    model.clear_kv_cache()
+
+    assert answer == expected
@@ -0,0 +1,87 @@
+import struct
+import sys
+from itertools import cycle
+from types import SimpleNamespace
+
+from utils.opus import OggOpusEncoder, ogg_crc
+
+# packet lengths around the 255-byte lacing boundaries
+SIZES = (255, 254, 256, 510, 0, 1, 1000, 765)
+
+
+class FixedSizeEncoder:
+    """Stands in for `opuslib.Encoder`, returning packets of the sizes in `SIZES` in turn."""
+
+    lookahead = 156
+
+    def __init__(self, sample_rate, channels, application):
+        self.sizes = cycle(SIZES)
+        self.packets = []
+
+    def encode(self, frame, frame_size):
+        size = next(self.sizes)
+        packet = bytes([len(self.packets) % 256]) * size
+        self.packets.append(packet)
+        return packet
+
+
+def crc_bitwise(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+            crc &= 0xFFFFFFFF
+    return crc
+
+
+def read_pages(data):
+    """Split an Ogg stream into pages, checking each page's CRC. Returns (header_type, granule, sequence,
+    packets) per page."""
+    pages, offset = [], 0
+    while offset < len(data):
+        assert data[offset : offset + 4] == b"OggS"
+        _, header_type, granule, _, sequence, crc, segments = struct.unpack_from("<BBqIIIB", data, offset + 4)
+        lacing = data[offset + 27 : offset + 27 + segments]
+        size = 27 + segments + sum(lacing)
+        page = bytearray(data[offset : offset + size])
+        page[22:26] = b"\0\0\0\0"
+        assert crc == crc_bitwise(page)
+        body, packets, packet = offset + 27 + segments, [], b""
+        for value in lacing:
+            packet += data[body : body + value]
+            body += value
+            if value < 255:
+                packets.append(packet)
+                packet = b""
+        assert packet == b"", "packets are not split across pages"
+        pages.append((header_type, granule, sequence, packets))
+        offset += size
+    return pages
+
+
+def test_crc():
+    # CRC-32/POSIX without its final inversion
+    assert ogg_crc(b"123456789") == 0x765E7680 ^ 0xFFFFFFFF
+    data = bytes(range(256)) * 3
+    assert ogg_crc(data) == crc_bitwise(data)
+
+
+def test_segmentation(monkeypatch):
+    monkeypatch.setitem(sys.modules, "opuslib", SimpleNamespace(Encoder=FixedSizeEncoder))
+    encoder = OggOpusEncoder(24000, frame_ms=20)
+    frame = b"\0\0" * encoder.frame_size
+    stream = encoder.header() + encoder.encode(frame * 300) + encoder.encode(frame[:100]) + encoder.flush()
+    pages = read_pages(stream)
+
+    assert [page[2] for page in pages] == list(range(len(pages)))
+    assert pages[0][0] == 0x02 and pages[0][3][0].startswith(b"OpusHead")
+    assert pages[1][3][0].startswith(b"OpusTags")
+    assert pages[-1][0] == 0x04
+    audio = pages[2:]
+    # 300 packets of up to 4 lacing values do not fit in one page
+    assert len(audio) > 1
+    assert [packet for page in audio for packet in page[3]] == encoder._encoder.packets
+    granules = [page[1] for page in audio]
+    assert granules == sorted(granules)
+    assert granules[-1] == encoder.pre_skip + (300 * encoder.frame_size + 50) * 2
@@ -0,0 +1,38 @@
+from scheduler import BATCH, DecodeScheduler
+
+
+def decode(client, turns, max_sessions):
+    """Submit (prompt, max_returned_tokens) T1A2 turns together and return the tokens of each, and the
+    turns. Batch turns have no playback deadline, so no turn sits out a step."""
+    scheduler = DecodeScheduler(client, max_sessions=max_sessions, reserved_slots=0, kv_answer_budget=16)
+    try:
+        reqs = [scheduler.submit_text(prompt, max_returned_tokens=n, priority=BATCH) for prompt, n in turns]
+        for req in reqs:
+            for _ in req:
+                pass
+        return [req.list_output for req in reqs], reqs
+    finally:
+        scheduler.close()
+
+
+def test_concurrent_turns_match_single_turns(tiny_client):
+    turns = [("hello", 40), ("a longer question", 90)]
+    together, reqs = decode(tiny_client, turns, max_sessions=2)
+    assert {req.slot for req in reqs} == {0, 1}
+    for turn, tokens in zip(turns, together):
+        alone, _ = decode(tiny_client, [turn], max_sessions=1)
+        assert tokens == alone[0]
+    # the turns ran to different lengths, past the kv answer budget
+    assert len(together[0][-1]) != len(together[1][-1])
+    assert max(len(tokens[-1]) for tokens in together) > 16
+
+
+def test_freed_rows_are_reused(tiny_client):
+    # two row pairs for three turns: the third one gets the rows of the first while the second is decoding
+    turns = [("hi", 24), ("a long answer", 120), ("third", 60)]
+    together, reqs = decode(tiny_client, turns, max_sessions=2)
+    assert reqs[2].slot == reqs[0].slot
+    assert reqs[2].t_admit >= reqs[0].t_admit
+    for turn, tokens in zip(turns, together):
+        alone, _ = decode(tiny_client, [turn], max_sessions=1)
+        assert tokens == alone[0]
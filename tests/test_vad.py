@@ -0,0 +1,60 @@
+import numpy as np
+
+from utils import vad
+from utils.vad import StreamingEndpointer, VadOptions
+
+
+class SmoothedEnergy:
+    """Stands in for silero: the speech probability is a running average of window energies kept in the
+    state, so an endpointer that dropped its state between `feed` calls would decide differently."""
+
+    def get_initial_state(self, batch_size):
+        return np.zeros(batch_size, dtype=np.float32)
+
+    def __call__(self, x, state, sr):
+        state = 0.5 * state + 0.5 * (np.abs(x).mean() > 0.05)
+        return state, state
+
+
+def utterances():
+    rng = np.random.default_rng(0)
+    parts = []
+    for speech, silence in ((0.6, 0.9), (0.1, 1.0), (1.2, 1.1)):
+        parts.append(0.01 * rng.standard_normal(int(silence * 16000)))
+        parts.append(0.5 * rng.standard_normal(int(speech * 16000)))
+    parts.append(np.zeros(16000))
+    return np.concatenate(parts).astype(np.float32)
+
+
+def run(audio, sizes):
+    endpointer = StreamingEndpointer(VadOptions(min_silence_duration_ms=700, window_size_samples=512))
+    events, start = [], 0
+    for size in sizes:
+        events += endpointer.feed(audio[start : start + size])
+        start += size
+    events += endpointer.feed(audio[start:])
+    # consecutive audio events of one segment are merged within a call only, merge them across calls too
+    merged = []
+    for kind, data in events:
+        if kind == "audio" and merged and merged[-1][0] in ("start", "audio"):
+            merged[-1] = (merged[-1][0], np.concatenate([merged[-1][1], data]))
+        else:
+            merged.append((kind, data))
+    return merged
+
+
+def test_feed_carries_state(monkeypatch):
+    monkeypatch.setattr(vad, "get_vad_model", SmoothedEnergy)
+    audio = utterances()
+    whole = run(audio, [])
+    # the 0.1 s burst is too short to count as speech
+    assert [kind for kind, _ in whole] == ["start", "end", "start", "end"]
+
+    rng = np.random.default_rng(1)
+    pieces = run(audio, rng.integers(1, 3000, size=len(audio) // 1500))
+    assert [kind for kind, _ in pieces] == [kind for kind, _ in whole]
+    for (_, a), (_, b) in zip(pieces, whole):
+        if a is None:
+            assert b is None
+        else:
+            np.testing.assert_array_equal(a, b)
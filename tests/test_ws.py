@@ -0,0 +1,42 @@
+import json
+
+from starlette.testclient import TestClient
+
+from server import AsyncOmniChatServer
+
+
+def receive_until(ws, kind):
+    """Messages up to and including the first JSON message of type `kind`."""
+    messages = []
+    while True:
+        msg = ws.receive()
+        if msg.get("text") is not None:
+            messages.append(json.loads(msg["text"]))
+            if messages[-1]["type"] == kind:
+                return messages
+        else:
+            messages.append(msg["bytes"])
+
+
+def test_barge_in_then_second_answer(fake_scheduler, tmp_path):
+    server = AsyncOmniChatServer(jobs_dir=str(tmp_path))
+    silence = b"\x00\x00" * 1600
+    with TestClient(server.app).websocket_connect("/ws") as ws:
+        ws.send_json({"type": "start", "id": "first"})
+        ws.send_bytes(silence)
+        ws.send_json({"type": "end"})
+        # the first answer starts talking and does not stop on its own
+        assert receive_until(ws, "start")[-1]["id"] == "first"
+        assert isinstance(ws.receive_bytes(), bytes)
+
+        ws.send_json({"type": "start", "id": "second"})
+        ws.send_bytes(silence)
+        assert receive_until(ws, "barge_in")[-1]["id"] == "first"
+        ws.send_json({"type": "end"})
+
+        messages = receive_until(ws, "end")
+        assert messages[-1]["id"] == "second"
+        start = next(i for i, m in enumerate(messages) if isinstance(m, dict) and m.get("type") == "start")
+        assert messages[start]["id"] == "second"
+        assert any(isinstance(m, bytes) and m for m in messages[start:])
+    assert fake_scheduler[0].streams[0].cancelled
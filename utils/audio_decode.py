@@ -0,0 +1,34 @@
+import io
+
+import numpy as np
+
+
+def pcm16_to_float(raw, sample_rate=16000):
+    """Raw little-endian PCM16 (already at the model's 16 kHz) to float32 samples in [-1, 1)."""
+    return np.frombuffer(raw[: len(raw) - len(raw) % 2], dtype="<i2").astype(np.float32) / 32768.0
+
+
+def decode_audio(data, sample_rate=16000):
+    """Decode a compressed container held in memory (WebM/Opus, Ogg/Opus, MP3, WAV, ...) to mono float32
+    samples at `sample_rate`. Uses libav through PyAV, so no ffmpeg process is started per request."""
+    try:
+        import av
+    except ImportError as e:
+        raise RuntimeError("compressed uploads need PyAV: pip install av") from e
+
+    resampler = av.AudioResampler(format="flt", layout="mono", rate=sample_rate)
+    chunks = []
+    with av.open(io.BytesIO(data), mode="r") as container:
+        stream = next((s for s in container.streams if s.type == "audio"), None)
+        if stream is None:
+            raise ValueError("upload has no audio stream")
+        for frame in container.decode(stream):
+            # frames from MediaRecorder carry timestamps that can jump, resample on samples alone
+            frame.pts = None
+            for out in resampler.resample(frame):
+                chunks.append(out.to_ndarray().reshape(-1))
+        for out in resampler.resample(None):
+            chunks.append(out.to_ndarray().reshape(-1))
+    if not chunks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks).astype(np.float32, copy=False)
@@ -0,0 +1,31 @@
+class IncrementalDetokenizer:
+    """Turns text tokens into text deltas as they are generated.
+
+    Each step decodes only the tokens from `prefix_offset` on, instead of the whole answer so far. A delta
+    is released once the decoded text grows past the already emitted window and does not end in a partial
+    UTF-8 sequence, the way multi-byte characters split over several byte-level tokens show up.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.tokens = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def add(self, token):
+        """Append one token id and return the text it completes, possibly empty."""
+        self.tokens.append(token)
+        prefix = self.tokenizer.decode(self.tokens[self.prefix_offset : self.read_offset])
+        text = self.tokenizer.decode(self.tokens[self.prefix_offset :])
+        if len(text) <= len(prefix) or text.endswith("\ufffd"):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.tokens)
+        return text[len(prefix) :]
+
+    def flush(self):
+        """Whatever is still held back at the end of the answer."""
+        prefix = self.tokenizer.decode(self.tokens[self.prefix_offset : self.read_offset])
+        text = self.tokenizer.decode(self.tokens[self.prefix_offset :])
+        self.prefix_offset = self.read_offset = len(self.tokens)
+        return text[len(prefix) :]
@@ -0,0 +1,163 @@
+import bisect
+import threading
+
+
+# seconds, from a single decode step up to a long turn
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# bytes, 1 MiB to 8 GiB
+BYTE_BUCKETS = tuple(float(2**n) for n in range(20, 34))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        # see `Registry.forward`
+        self.forward = None
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return lines + self._samples()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation):
+        super().__init__(name, documentation)
+        self._value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+        if self.forward is not None:
+            self.forward(self.name, amount)
+
+    def _samples(self):
+        return [f"{self.name} {self._value}"]
+
+
+class Gauge(_Metric):
+    """A value that goes up and down. With `set_function` it is read when the metrics are scraped."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation):
+        super().__init__(name, documentation)
+        self._value = 0.0
+        self._function = None
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def value(self):
+        return float(self._function() if self._function is not None else self._value)
+
+    def _samples(self):
+        return [f"{self.name} {self.value()}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sum += value
+        if self.forward is not None:
+            self.forward(self.name, value)
+
+    def _samples(self):
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation):
+        return self.register(Counter(name, documentation))
+
+    def gauge(self, name, documentation):
+        return self.register(Gauge(name, documentation))
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, buckets))
+
+    def forward(self, send):
+        """Also hand every counter increment and histogram observation made in this process to
+        `send(name, value)`, for a process whose metrics another one exports (see `record`)."""
+        for metric in self._metrics.values():
+            metric.forward = send
+
+    def record(self, name, value):
+        """Apply an increment or observation forwarded from another process."""
+        metric = self._metrics[name]
+        if isinstance(metric, Counter):
+            metric.inc(value)
+        else:
+            metric.observe(value)
+
+    def render(self):
+        """The Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REGISTRY = Registry()
+
+TTFA = REGISTRY.histogram("omni_time_to_first_audio_seconds", "Time from the end of the user's audio to the first audio chunk.")
+STEP_LATENCY = REGISTRY.histogram(
+    "omni_decode_step_seconds", "Latency of one batched decode step.",
+    buckets=(0.005, 0.01, 0.015, 0.02, 0.03, 0.04, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0),
+)
+WHISPER_ENCODE = REGISTRY.histogram("omni_whisper_encode_seconds", "Whisper encoder time per prefill or audio chunk.")
+SNAC_DECODE = REGISTRY.histogram("omni_snac_decode_seconds", "SNAC decoder time per audio chunk.")
+REQUEST_DURATION = REGISTRY.histogram("omni_request_duration_seconds", "Time from submission until a turn is closed.")
+
+QUEUE_DEPTH = REGISTRY.gauge("omni_queue_depth", "Turns waiting for a pair of KV rows.")
+ACTIVE_SEQUENCES = REGISTRY.gauge("omni_active_sequences", "Turns holding KV rows, decoding or still receiving audio.")
+KV_OCCUPANCY = REGISTRY.gauge("omni_kv_occupancy_ratio", "Fraction of KV cache positions holding live tokens.")
+KV_BYTES = REGISTRY.gauge("omni_kv_cache_bytes", "Memory of the KV cache rows in use.")
+KV_POOL_BYTES = REGISTRY.gauge("omni_kv_pool_bytes", "Memory allocated for the KV cache, in use or not.")
+KV_SESSION_PEAK = REGISTRY.histogram(
+    "omni_kv_session_peak_bytes", "Largest KV cache memory written by a turn, prompt and answer.", buckets=BYTE_BUCKETS
+)
+KV_SESSION_AVERAGE = REGISTRY.histogram(
+    "omni_kv_session_average_bytes", "KV cache memory written by a turn, averaged over its decode steps.",
+    buckets=BYTE_BUCKETS,
+)
+
+TOKENS_GENERATED = REGISTRY.counter("omni_tokens_generated_total", "Decode steps taken across all turns.")
+REQUESTS_CANCELLED = REGISTRY.counter("omni_requests_cancelled_total", "Turns cancelled before they finished.")
+UNDERRUNS = REGISTRY.counter("omni_audio_underruns_total", "Audio chunks that reached a client after its playback ran dry.")
+REQUESTS_REJECTED = REGISTRY.counter("omni_requests_rejected_total", "Turns turned away by admission control.")
@@ -0,0 +1,112 @@
+import random
+import struct
+
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        r = i << 24
+        for _ in range(8):
+            r = ((r << 1) ^ 0x04C11DB7) if r & 0x80000000 else (r << 1)
+        table.append(r & 0xFFFFFFFF)
+    return table
+
+
+_CRC_TABLE = _crc_table()
+
+# frame durations Opus accepts, in ms
+FRAME_MS = (2.5, 5, 10, 20, 40, 60)
+
+
+def ogg_crc(data):
+    """CRC-32 of an Ogg page: polynomial 0x04C11DB7, not reflected, zero initial value."""
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ _CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+
+class OggOpusEncoder:
+    """Incremental Ogg/Opus encoder for mono PCM16 streams.
+
+    The Opus encoder state lives across calls, so chunks from `generate_audio_data` can be fed as they
+    come and the returned bytes concatenate into one valid Ogg/Opus file. `header()` gives the two header
+    pages, `encode()` the pages for the complete frames buffered so far and `flush()` the last page.
+    """
+
+    def __init__(self, sample_rate=24000, bitrate=32000, frame_ms=20, application="voip", serial=None):
+        try:
+            import opuslib
+        except ImportError as e:
+            raise RuntimeError("Opus output needs the opuslib package and libopus: pip install opuslib") from e
+        if frame_ms not in FRAME_MS:
+            raise ValueError(f"frame_ms must be one of {FRAME_MS}, got {frame_ms}")
+        self.sample_rate = sample_rate
+        self.frame_size = int(sample_rate * frame_ms / 1000)
+        self._encoder = opuslib.Encoder(sample_rate, 1, application)
+        self._encoder.bitrate = bitrate
+        self._lookahead = self._encoder.lookahead
+        # granule positions are always counted at 48 kHz
+        self._scale = 48000 // sample_rate
+        self.pre_skip = self._lookahead * self._scale
+        self._serial = random.getrandbits(32) if serial is None else serial
+        self._sequence = 0
+        self._pending = b""
+        self._samples_in = 0
+        self._samples_out = 0
+
+    def header(self):
+        head = b"OpusHead" + struct.pack("<BBHIhB", 1, 1, self.pre_skip, self.sample_rate, 0, 0)
+        vendor = b"mini-omni"
+        tags = b"OpusTags" + struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", 0)
+        return self._page([head], 0, bos=True) + self._page([tags], 0)
+
+    def encode(self, pcm):
+        """Encode PCM16 bytes. Samples that do not fill a whole frame are kept for the next call."""
+        self._samples_in += len(pcm) // 2
+        self._pending += pcm
+        return self._pages(self._frames())
+
+    def flush(self):
+        """Encode what is left, padded with silence past the encoder delay, and end the stream."""
+        frame_bytes = 2 * self.frame_size
+        padding = 2 * self._lookahead + (-(len(self._pending) + 2 * self._lookahead)) % frame_bytes
+        self._pending += b"\x00" * padding
+        granule = self.pre_skip + self._samples_in * self._scale
+        return self._pages(self._frames(), eos=True, granule=granule)
+
+    def _frames(self):
+        frame_bytes = 2 * self.frame_size
+        packets = []
+        while len(self._pending) >= frame_bytes:
+            frame, self._pending = self._pending[:frame_bytes], self._pending[frame_bytes:]
+            packets.append(self._encoder.encode(frame, self.frame_size))
+        return packets
+
+    def _pages(self, packets, eos=False, granule=None):
+        out = b""
+        # one page holds at most 255 lacing values
+        while packets or eos:
+            batch, lacing = [], 0
+            while packets and lacing + len(packets[0]) // 255 + 1 <= 255:
+                lacing += len(packets[0]) // 255 + 1
+                batch.append(packets.pop(0))
+            self._samples_out += len(batch) * self.frame_size * self._scale
+            last = not packets
+            position = granule if (granule is not None and last) else self._samples_out
+            if batch or (eos and last):
+                out += self._page(batch, position, eos=eos and last)
+            if last:
+                break
+        return out
+
+    def _page(self, packets, granule, bos=False, eos=False):
+        lacing = b""
+        for packet in packets:
+            lacing += b"\xff" * (len(packet) // 255) + bytes([len(packet) % 255])
+        header_type = (0x02 if bos else 0) | (0x04 if eos else 0)
+        header = b"OggS" + struct.pack("<BBqIIIB", 0, header_type, granule, self._serial, self._sequence, 0, len(lacing))
+        page = bytearray(header + lacing + b"".join(packets))
+        struct.pack_into("<I", page, 22, ogg_crc(page))
+        self._sequence += 1
+        return bytes(page)
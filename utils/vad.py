@@ -232,6 +232,111 @@ class SpeechTimestampsMap:
         )
 
 
+class StreamingEndpointer:
+    """Per-session speech start/end detection over streamed 16 kHz audio.
+
+    Silero's (h, c) state is carried from one `feed` call to the next. `feed` returns a list of events:
+
+      ("start", audio): speech has lasted `min_speech_duration_ms`. The audio starts `speech_pad_ms`
+        before its onset.
+      ("audio", audio): more audio of the current speech segment, trailing silence included.
+      ("end", None): `min_silence_duration_ms` of silence followed the speech (the hangover).
+
+    Speech that stops before `min_speech_duration_ms` is dropped without emitting anything.
+    """
+
+    def __init__(self, vad_options: Optional[VadOptions] = None, **kwargs):
+        if vad_options is None:
+            vad_options = VadOptions(**kwargs)
+
+        self.sampling_rate = 16000
+        self.window_size_samples = vad_options.window_size_samples
+        self.threshold = vad_options.threshold
+        self.neg_threshold = vad_options.threshold - 0.15
+        self.min_speech_samples = self.sampling_rate * vad_options.min_speech_duration_ms / 1000
+        self.min_silence_samples = self.sampling_rate * vad_options.min_silence_duration_ms / 1000
+        self.speech_pad_samples = int(self.sampling_rate * vad_options.speech_pad_ms / 1000)
+
+        self.model = get_vad_model()
+        self.reset()
+
+    def reset(self):
+        self.state = self.model.get_initial_state(batch_size=1)
+        # samples that do not fill a window yet
+        self.pending = np.zeros(0, dtype=np.float32)
+        # most recent audio outside speech, used as pre-roll
+        self.history = np.zeros(0, dtype=np.float32)
+        # windows since a possible speech onset that is not confirmed yet
+        self.candidate = None
+        self.triggered = False
+        self.speech_samples = 0
+        self.silence_samples = 0
+
+    def feed(self, audio: np.ndarray) -> List[tuple]:
+        audio = np.concatenate([self.pending, audio.astype(np.float32)])
+        n = len(audio) // self.window_size_samples * self.window_size_samples
+        self.pending = audio[n:]
+
+        events = []
+        for start in range(0, n, self.window_size_samples):
+            chunk = audio[start : start + self.window_size_samples]
+            speech_prob, self.state = self.model(chunk, self.state, self.sampling_rate)
+            self._update(float(np.squeeze(speech_prob)), chunk, events)
+
+        # merge consecutive audio events
+        merged = []
+        for kind, data in events:
+            if kind == "audio" and merged and merged[-1][0] in ("start", "audio"):
+                merged[-1] = (merged[-1][0], np.concatenate([merged[-1][1], data]))
+            else:
+                merged.append((kind, data))
+        return merged
+
+    def _update(self, speech_prob, chunk, events):
+        window = self.window_size_samples
+        if self.triggered:
+            events.append(("audio", chunk))
+            if speech_prob >= self.threshold:
+                self.silence_samples = 0
+            elif speech_prob < self.neg_threshold:
+                self.silence_samples += window
+                if self.silence_samples >= self.min_silence_samples:
+                    events.append(("end", None))
+                    self.triggered = False
+                    self.silence_samples = 0
+                    self.history = np.zeros(0, dtype=np.float32)
+            return
+
+        if self.candidate is not None:
+            self.candidate.append(chunk)
+            if speech_prob >= self.threshold:
+                self.speech_samples += window
+                self.silence_samples = 0
+            elif speech_prob < self.neg_threshold:
+                self.silence_samples += window
+            if self.speech_samples >= self.min_speech_samples:
+                events.append(("start", np.concatenate([self.history] + self.candidate)))
+                self.triggered = True
+                self.candidate = None
+                self.silence_samples = 0
+            elif self.silence_samples >= self.min_silence_samples:
+                # too short to be speech, discard it
+                self.history = self._preroll(np.concatenate([self.history] + self.candidate))
+                self.candidate = None
+                self.silence_samples = 0
+            return
+
+        if speech_prob >= self.threshold:
+            self.candidate = [chunk]
+            self.speech_samples = window
+            self.silence_samples = 0
+        else:
+            self.history = self._preroll(np.concatenate([self.history, chunk]))
+
+    def _preroll(self, audio):
+        return audio[max(0, len(audio) - self.speech_pad_samples) :]
+
+
 @functools.lru_cache
 def get_vad_model():
     """Returns the VAD model instance."""